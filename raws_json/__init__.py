@@ -33,14 +33,51 @@ __author__ = 'api.jscudder (Jeffrey Scudder)'
        used to specify information about the request.
 """
 import os
+import collections
+import ctypes
+import ctypes.util
+import errno
+import hashlib
 import httplib
+import logging
+import mmap
 import urllib
 import re
 import base64
 import socket
+import select
+import ssl
+import StringIO
+import sys
+import threading
+import time
+import weakref
+import zlib
 
 URL_REGEX = re.compile('http(s)?\://([\w\.-]*)(\:(\d+))?(/.*)?')
 
+# Path segments which UriTemplate reports as '{id}': numbers, long hex
+# strings and UUIDs.
+ID_SEGMENT_REGEX = re.compile(r'^(\d+|[0-9a-fA-F]{16,}|'
+    r'[0-9a-fA-F]{8}(-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12})$')
+
+# Number of bytes read from a response at a time when it is streamed.
+READ_CHUNK_SIZE = 65536
+
+# Default number of bytes of a MediaSource sent at a time when its file can't
+# be handed to the kernel with sendfile.
+UPLOAD_CHUNK_SIZE = 1048576
+
+# Accept-Encoding sent when compress_responses is set, and the content codings
+# that can be decoded.
+ACCEPT_ENCODING = 'gzip, deflate'
+DECODED_ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+# Methods whose request can be sent again when its response was lost, and
+# the errors of a connection which the server has closed.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+CLOSED_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
 class JsonService(object):
   """Performs Atom Publishing Protocol CRUD operations.
   
@@ -54,6 +91,42 @@ class JsonService(object):
   # If debug is True, the HTTPConnection will display debug information
   debug = False
 
+  # ConnectionPool used to keep connections alive between requests, None
+  # opens a new connection for every request.
+  connection_pool = None
+
+  # TransferStats which counts the requests and connections, if not None.
+  stats = None
+
+  # SSLContext for https connections (see CreateSslContext), None uses the
+  # one shared by the process.
+  ssl_context = None
+
+  # DnsCache through which host names are resolved, None resolves them on
+  # every new connection.
+  dns_cache = None
+
+  # If True, responses are requested gzip or deflate compressed and
+  # transparently decompressed while they are read.
+  compress_responses = True
+
+  # BandwidthLimiters which cap the throughput of request and response
+  # bodies, None doesn't limit them.
+  upload_limit = None
+  download_limit = None
+
+  # HeaderDict shared with other services (eg. those of a Session), sent
+  # along with additional_headers, which take precedence.
+  base_headers = None
+
+  # Functions called with the RequestTiming of every request (see
+  # TimingBuffer and SlowRequestLog), None or empty times nothing.
+  request_observers = None
+
+  # Function which turns the uri of a request into the one reported in its
+  # RequestTiming, None uses UriTemplate.
+  uri_template = None
+
   def __init__(self, server=None, additional_headers=None):
     """Creates a new JsonService client.
     
@@ -66,7 +139,7 @@ class JsonService(object):
     """
 
     self.server = server
-    self.additional_headers = additional_headers or {}
+    self.additional_headers = HeaderDict(additional_headers or {})
 
     self.additional_headers['User-Agent'] = 'Python Google Data Client Lib'
 
@@ -273,7 +346,8 @@ class JsonService(object):
 
 
 def HttpRequest(service, operation, data, uri, extra_headers=None, 
-      url_params=None, escape_params=True, content_type='application/atom+xml'):
+      url_params=None, escape_params=True, content_type='application/atom+xml',
+      progress=None):
     """Performs an HTTP call to the server, supports GET, POST, PUT, and DELETE.
 
     Usage example, perform and HTTP GET on http://www.google.com/:
@@ -313,100 +387,1511 @@ def HttpRequest(service, operation, data, uri, extra_headers=None,
           (Special characters converted to %XX form.)
       content_type: str The MIME type for the data being sent. Defaults to
           'application/atom+xml', this is only used if data is set.
+      progress: TransferProgress or func (optional) Follows the sending of
+          data, see TransferProgress. A function is called with the number
+          of bytes sent and the length of data.
     """
     full_uri = BuildUri(uri, url_params, escape_params)
-    (connection, full_uri) = PrepareConnection(service, full_uri)
 
-    if extra_headers is None:
-      extra_headers = {}
+    extra_headers = _PrepareHeaders(service, data, extra_headers, content_type)
 
-    # Turn on debug mode if the debug member is set.
-    if service.debug:
-      connection.debuglevel = 1
+    if service.stats is not None:
+      service.stats.add('requests')
+    if data:
+      progress = _UploadProgress(service, progress, extra_headers)
+    timing = _StartTiming(service, operation, full_uri)
+
+    positions = __DataPositions(data)
+    while True:
+      (connection, request_uri) = PrepareConnection(service, full_uri)
+      connection.timing = timing
+      connection.request_sent = False
+      if progress is not None:
+        sent = progress.bytes
+      try:
+        response = __SendRequest(service, connection, operation, request_uri,
+            extra_headers, data, progress)
+        connection.timing = None
+        break
+      except (socket.error, httplib.HTTPException), e:
+        connection.timing = None
+        connection.close()
+        # A pooled connection may have been closed by the server while it was
+        # idle, in which case the request is sent again on the next one.
+        if (not getattr(connection, 'reused', False) or positions is None or
+            not _ClosedWhileIdle(operation, e, connection.request_sent)):
+          if timing is not None:
+            timing.finish(error=e)
+          raise
+        for (data_part, position) in positions:
+          data_part.seek(position)
+        if progress is not None:
+          progress.rewind(progress.bytes - sent)
+    if data and progress is not None:
+      progress.finish()
+
+    if isinstance(response, PooledHTTPResponse):
+      response.decode_content = _AcceptsCompressed(service, extra_headers)
+      response.stats = service.stats
+      response.download_limit = getattr(service, 'download_limit', None)
+      response.limit_host = connection.limit_host
+      response.timing = timing
+    elif timing is not None:
+      timing.finish(response.status)
+
+    pool = getattr(service, 'connection_pool', None)
+    if pool is not None and isinstance(response, PooledHTTPResponse):
+      response.pool = pool
+      response.connection = connection
+      if response.length == 0:
+        # Nothing to drain (HEAD, 204, ...), hand the connection back now.
+        response.read()
 
-    connection.putrequest(operation, full_uri)
+    # Return the HTTP Response from the server.
+    return response
+
+
+def _PrepareHeaders(service, data, extra_headers, content_type):
+    """Completes the per-request headers with Content-Length and Content-Type.
+
+    Returns:
+      The extra_headers dict, or a new one if extra_headers was None.
+    """
+    if extra_headers is None:
+      extra_headers = {}
 
     # If the list of headers does not include a Content-Length, attempt to 
-    # calculate it based on the data object.
-    if (data and not service.additional_headers.has_key('Content-Length') and 
-        not extra_headers.has_key('Content-Length')):
+    # calculate it based on the data object. Data of unknown length, like a
+    # pipe or a generator, is sent chunked.
+    if (data and not _HasHeader(service, extra_headers, 'Content-Length') and
+        not _HasHeader(service, extra_headers, 'Transfer-Encoding')):
       content_length = __CalculateDataLength(data)
-      if content_length:
+      if content_length is not None:
         extra_headers['Content-Length'] = str(content_length)
       else:
-        extra_headers['Content-Length'] = "0"
+        extra_headers['Transfer-Encoding'] = 'chunked'
 
     if content_type:
       extra_headers['Content-Type'] = content_type 
 
-    # Send the HTTP headers.
-    if isinstance(service.additional_headers, dict):
-      for header in service.additional_headers:
-        connection.putheader(header, service.additional_headers[header])
+    return extra_headers
+
+
+def __SendRequest(service, connection, operation, full_uri, extra_headers,
+      data, progress=None):
+    # Turn on debug mode if the debug member is set.
+    if service.debug:
+      connection.debuglevel = 1
+
+    timing = getattr(connection, 'timing', None)
+    if timing is not None:
+      timing.reused = getattr(connection, 'reused', False)
+      if connection.sock is None:
+        # Connect before the request, so connecting isn't timed as sending.
+        connection.connect()
+      timing.sending()
+
+    compress = _AcceptsCompressed(service, extra_headers)
+    connection.putrequest(operation, full_uri, skip_accept_encoding=(
+        compress or _HasHeader(service, extra_headers, 'Accept-Encoding')))
+    if compress:
+      connection.putheader('Accept-Encoding', ACCEPT_ENCODING)
+
+    # Send the HTTP headers, the ones of the service are formatted already.
+    lines = _HeaderBlock(service)[0]
+    if hasattr(connection, 'putheaderlines'):
+      connection.putheaderlines(lines)
+    else:
+      for line in lines:
+        connection.putheader(*line.split(': ', 1))
     if isinstance(extra_headers, dict):
       for header in extra_headers:
         connection.putheader(header, extra_headers[header])
-    connection.endheaders()
+    # If there is data, send it in the request. The strings at its start
+    # go out in the same send as the headers.
+    if isinstance(data, list):
+      parts = list(data)
+    elif data:
+      parts = [data]
+    else:
+      parts = []
+    if _IsChunked(extra_headers):
+      connection.endheaders()
+      for chunk in _EncodeChunked(_IterDataParts(parts)):
+        connection.send(chunk)
+        _Sent(connection, progress, len(chunk))
+    else:
+      head = []
+      while parts and isinstance(parts[0], str):
+        head.append(parts.pop(0))
+      head = ''.join(head)
+      connection.endheaders(head)
+      _Sent(connection, progress, len(head))
+      for data_part in parts:
+        __SendDataPart(data_part, connection, progress)
+
+    connection.request_sent = True
+    if timing is None:
+      return connection.getresponse()
+    timing.waiting()
+    response = connection.getresponse()
+    timing.receiving()
+    return response
+
+
+def _ClosedWhileIdle(operation, error, sent):
+    """Checks if a request on a reused connection failed because the server
+    had closed the connection while it was idle.
+
+    This is the case when the connection was reset while the request was
+    being sent, so the server didn't take it. Once the request has been sent
+    the server may have acted on it, so only an idempotent request is sent
+    again, and only if the connection ended before any byte of a response
+    arrived. Timeouts are never retried.
 
-    # If there is data, send it in the request.
-    if data:
-      if isinstance(data, list):
-        for data_part in data:
-          __SendDataPart(data_part, connection)
+    Args:
+      operation: str The HTTP method of the request.
+      error: The socket.error or httplib.HTTPException of the request.
+      sent: bool Whether the request was sent completely.
+    """
+    if isinstance(error, ClosedBeforeResponse):
+      return operation in IDEMPOTENT_METHODS
+    if not isinstance(error, socket.error) or \
+        isinstance(error, socket.timeout):
+      return False
+    if not error.args or error.args[0] not in CLOSED_ERRNOS:
+      return False
+    return not sent or operation in IDEMPOTENT_METHODS
+
+
+def _Sent(connection, progress, length):
+    """Accounts for length bytes sent over connection, waiting for its
+    upload_limit if there is one."""
+    if not length:
+      return
+    if progress is not None:
+      progress.update(length)
+    timing = getattr(connection, 'timing', None)
+    if timing is not None:
+      timing.request_bytes += length
+    limiter = getattr(connection, 'upload_limit', None)
+    if limiter is not None:
+      limiter.wait(length, getattr(connection, 'limit_host', None))
+
+
+def _PieceSize(connection, size):
+    """Returns size, or less when the connection has an upload_limit, so
+    the bytes of a single send fit in its burst."""
+    limiter = getattr(connection, 'upload_limit', None)
+    if limiter is None:
+      return size
+    return limiter.cap(size)
+
+
+def _UploadProgress(service, progress, extra_headers):
+    """Returns the TransferProgress which follows the body of a request.
+
+    Returns:
+      None if there is neither a progress nor service.stats to update.
+    """
+    stats = getattr(service, 'stats', None)
+    if progress is None and stats is None:
+      return None
+    length = extra_headers.get('Content-Length')
+    if length is not None:
+      length = int(length)
+    return MakeProgress(progress, 'upload', stats, length)
+
+
+def _IsChunked(extra_headers):
+    """Checks if the request body is to be sent with chunked transfer-coding."""
+    return (isinstance(extra_headers, dict) and
+        extra_headers.get('Transfer-Encoding', '').lower() == 'chunked')
+
+
+def _IterDataParts(parts, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Yields the request body made of parts as a sequence of strings.
+
+    A part can be a string, a MediaSource, a file-like object (which is read
+    until its end) or any other iterable of strings, like a generator.
+    """
+    for part in parts:
+      if isinstance(part, MediaSource) and \
+          not hasattr(part.file_handle, 'read'):
+        # A MediaSource of a generator.
+        part = part.file_handle
+      if isinstance(part, str):
+        if part:
+          yield part
+      elif hasattr(part, 'read'):
+        # A MediaSource reads from its mapping, if it has one.
+        size = getattr(part, 'chunk_size', chunk_size)
+        while True:
+          data = part.read(size)
+          if not data:
+            break
+          yield data
+      elif hasattr(part, '__iter__'):
+        for data in part:
+          if data:
+            yield str(data)
       else:
-        __SendDataPart(data, connection)
+        yield str(part)
 
-    # Return the HTTP Response from the server.
-    return connection.getresponse()
+
+def _EncodeChunked(pieces):
+    """Frames a sequence of strings for Transfer-Encoding: chunked."""
+    for data in pieces:
+      yield '%x\r\n%s\r\n' % (len(data), data)
+    yield '0\r\n\r\n'
+
+
+def _HasHeader(service, extra_headers, name):
+    """Checks if the request headers of the service or call include name."""
+    name = name.lower()
+    if name in _HeaderBlock(service)[1]:
+      return True
+    if isinstance(extra_headers, dict):
+      for header in extra_headers:
+        if header.lower() == name:
+          return True
+    return False
+
+
+# The checks of httplib's putheader(), for headers formatted in advance.
+_LEGAL_HEADER_NAME = re.compile(r'\A[^:\s][^:\r\n]*\Z')
+_ILLEGAL_HEADER_VALUE = re.compile(r'\n(?![ \t])|\r(?![ \t\n])')
+
+
+def _HeaderBlock(service):
+    """Formats the additional_headers of a service for sending.
+
+    The base_headers of the service, if any, are sent as well, unless
+    additional_headers has a header of the same name. The result is kept on
+    the service until its headers change, which is noticed through the
+    version of a HeaderDict. Plain dicts are formatted again for every
+    request.
+
+    Returns:
+      A tuple with the list of 'Name: value' header lines and a frozenset of
+      the lowercased header names.
+
+    Raises:
+      ValueError: A header name or value would break the request, like
+          httplib's putheader() checks.
+    """
+    headers = service.additional_headers
+    if not isinstance(headers, dict):
+      headers = {}
+    base = getattr(service, 'base_headers', None)
+    if base is None:
+      base = _NO_HEADERS
+    elif not isinstance(base, dict):
+      base = {}
+    version = (getattr(headers, 'version', None),
+        getattr(base, 'version', None))
+    cache = getattr(service, '_header_cache', None)
+    if (None not in version and cache is not None and cache[0] is headers and
+        cache[1] is base and cache[2] == version):
+      return cache[3]
+    names = frozenset([header.lower() for header in headers])
+    pairs = [(header, base[header]) for header in base
+        if header.lower() not in names]
+    pairs.extend(headers.items())
+    lines = []
+    for (header, value) in pairs:
+      value = str(value)
+      if not _LEGAL_HEADER_NAME.match(header):
+        raise ValueError('Invalid header name %r' % (header,))
+      if _ILLEGAL_HEADER_VALUE.search(value):
+        raise ValueError('Invalid header value %r' % (value,))
+      lines.append('%s: %s' % (header, value))
+    block = (lines, names | frozenset([header.lower() for header in base]))
+    if None not in version:
+      service._header_cache = (headers, base, version, block)
+    return block
+
+
+class HeaderDict(dict):
+  """A dict of request headers which counts its modifications.
+
+  The version attribute changes whenever a header is added, removed or gets
+  a different value, so formatted headers can be cached until then.
+  """
+
+  version = 0
+
+  def __setitem__(self, key, value):
+    if key not in self or self[key] != value:
+      dict.__setitem__(self, key, value)
+      self.version += 1
+
+  def __delitem__(self, key):
+    dict.__delitem__(self, key)
+    self.version += 1
+
+  def update(self, *args, **kwargs):
+    dict.update(self, *args, **kwargs)
+    self.version += 1
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self.version += 1
+    return dict.setdefault(self, key, default)
+
+  def pop(self, *args):
+    self.version += 1
+    return dict.pop(self, *args)
+
+  def popitem(self):
+    self.version += 1
+    return dict.popitem(self)
+
+  def clear(self):
+    dict.clear(self)
+    self.version += 1
 
 
-def __SendDataPart(data, connection):
+# The base_headers of services which have none, it is never changed.
+_NO_HEADERS = HeaderDict()
+
+
+def _AcceptsCompressed(service, extra_headers):
+    """Checks if a compressed response is to be negotiated for a request.
+
+    This is the case when the service has compress_responses set and the
+    caller didn't ask for a specific Accept-Encoding himself.
+    """
+    return (getattr(service, 'compress_responses', False) and
+        not _HasHeader(service, extra_headers, 'Accept-Encoding'))
+
+
+def __DataPositions(data):
+    """Records the read position of the file-like parts in data.
+
+    Returns:
+      A list of (file, position) tuples which can be used to rewind the data
+      before it is sent again, or None if a part can not be rewound.
+    """
+    positions = []
+    if isinstance(data, list):
+      parts = data
+    else:
+      parts = [data]
+    for data_part in parts:
+      if hasattr(data_part, 'read'):
+        try:
+          positions.append((data_part, data_part.tell()))
+        except (AttributeError, IOError, OSError):
+          return None
+      elif hasattr(data_part, '__iter__'):
+        # A generator can't be replayed.
+        return None
+    return positions
+
+
+def __SendDataPart(data, connection, progress=None):
     if isinstance(data, str):
       #TODO add handling for unicode.
       connection.send(data)
+      _Sent(connection, progress, len(data))
       return
     # NEXT SECTION COMMENTED OUT, replace by json.decode() if desired
     # elif ElementTree.iselement(data):
     #   connection.send(ElementTree.tostring(data))
     #   return
+    elif getattr(data, 'mapping', None) is not None:
+      # A mapped file or range of one is sent from slices of the mapping.
+      for view in data.iterViews(_PieceSize(connection, UPLOAD_CHUNK_SIZE)):
+        connection.sock.sendall(view)
+        _Sent(connection, progress, len(view))
+      return
+    elif isinstance(data, MediaSource):
+      _SendFile(connection, data.file_handle,
+          _PieceSize(connection, data.chunk_size), progress)
+      return
     # Check to see if data is a file-like object that has a read method.
     elif hasattr(data, 'read'):
       # Read the file and send it a chunk at a time.
       while 1:
-        binarydata = data.read(100000)
+        binarydata = data.read(_PieceSize(connection, 100000))
         if binarydata == '': break
         connection.send(binarydata)
+        _Sent(connection, progress, len(binarydata))
+      return
+    elif hasattr(data, '__iter__'):
+      # An iterable of strings, like a generator.
+      for binarydata in _IterDataParts([data]):
+        connection.send(binarydata)
+        _Sent(connection, progress, len(binarydata))
       return
     else:
       # The data object was not a file.
       # Try to convert to a string and send the data.
-      connection.send(str(data))
+      data = str(data)
+      connection.send(data)
+      _Sent(connection, progress, len(data))
+      return
+
+
+def _MappedView(mapping, offset, length):
+    """Returns a slice of a memory map which shares its memory."""
+    try:
+      return memoryview(mapping)[offset:offset + length]
+    except TypeError:
+      # Python 2 maps only have the old buffer interface.
+      return buffer(mapping, offset, length)
+
+
+def _LoadSendFile():
+    """Returns the sendfile(2) function of the C library, None if there is
+    none. Python 2 has neither os.sendfile nor socket.sendfile, so it is
+    called through ctypes, on Linux only (other systems have another
+    signature)."""
+    if not sys.platform.startswith('linux'):
+      return None
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+          use_errno=True)
+      sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+      return None
+    sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    sendfile.restype = ctypes.c_ssize_t
+    return sendfile
+
+
+_sendfile = _LoadSendFile()
+
+
+def _SendFile(connection, file_handle, chunk_size, progress=None):
+    """Sends the rest of an open file over the connection.
+
+    Over plain http a real file is copied by the kernel with sendfile(2),
+    where the platform has it (see _LoadSendFile). Otherwise, and always for
+    TLS, the file is read into one reused buffer of chunk_size bytes which is
+    sent through a memoryview, so no new string is made for each chunk.
+    """
+    sock = connection.sock
+    try:
+      fileno = file_handle.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+      fileno = None
+    if (fileno is not None and _sendfile is not None and
+        not isinstance(sock, ssl.SSLSocket) and
+        _SendFileKernel(connection, file_handle, fileno, chunk_size,
+            progress)):
       return
+    if not hasattr(file_handle, 'readinto'):
+      while True:
+        data = file_handle.read(chunk_size)
+        if not data:
+          break
+        sock.sendall(data)
+        _Sent(connection, progress, len(data))
+      return
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+      size = file_handle.readinto(buf)
+      if not size:
+        break
+      sock.sendall(view[:size])
+      _Sent(connection, progress, size)
+
+
+def _SendFileKernel(connection, file_handle, fileno, chunk_size, progress):
+    """Sends the rest of a file with sendfile(2).
+
+    Returns:
+      False if the file can't be sent this way and nothing has been sent.
+    """
+    sock = connection.sock
+    start = file_handle.tell()
+    offset = ctypes.c_int64(start)
+    while True:
+      sent = _sendfile(sock.fileno(), fileno, ctypes.byref(offset),
+          chunk_size)
+      if sent < 0:
+        error = ctypes.get_errno()
+        if error == errno.EINTR:
+          continue
+        if error == errno.EAGAIN:
+          # A socket with a timeout is non-blocking underneath.
+          if not select.select([], [sock], [], sock.gettimeout())[1]:
+            raise socket.timeout('timed out')
+          continue
+        if error in (errno.EINVAL, errno.ENOSYS) and offset.value == start:
+          return False
+        raise socket.error(error, os.strerror(error))
+      if not sent:
+        break
+      _Sent(connection, progress, sent)
+    file_handle.seek(offset.value)
+    return True
 
 
 def __CalculateDataLength(data):
     """Attempts to determine the length of the data to send. 
 
-    This method will respond with a length only if the data is a string or
-    and ElementTree element.
+    This method will respond with a length only if the data is a string, a
+    MediaSource with a content_length, or a list of those.
 
     Args:
-      data: object If this is not a string or ElementTree element this funtion
-          will return None.
+      data: object If the length of this can not be known up front, like
+          for a file-like object or a generator, this function will return
+          None.
     """
     if isinstance(data, str):
       return len(data)
     elif isinstance(data, list):
-      return None
-    elif ElementTree.iselement(data):
-      return len(ElementTree.tostring(data))
-    elif hasattr(data, 'read'):
-      # If this is a file-like object, don't try to guess the length.
+      length = 0
+      for data_part in data:
+        part_length = __CalculateDataLength(data_part)
+        if part_length is None:
+          return None
+        length += part_length
+      return length
+    elif isinstance(data, MediaSource):
+      if data.content_length is None:
+        return None
+      return int(data.content_length)
+    elif hasattr(data, 'read') or hasattr(data, '__iter__'):
+      # If this is a file-like object or a generator, don't try to guess the
+      # length.
       return None
     else:
       return len(str(data))
 
 
+def CreateSslContext(cafile=None, certfile=None, keyfile=None, ciphers=None,
+    verify=True):
+  """Creates the SSLContext with which https connections are made.
+
+  This is where the certificate and cipher settings of a Session or service
+  are made. The context is meant to be created once and shared by all
+  connections.
+
+  Args:
+    cafile: str (optional) File with the CA certificates to trust instead of
+            the ones of the system.
+    certfile: str (optional) File with the client certificate chain.
+    keyfile: str (optional) File with the private key of certfile.
+    ciphers: str (optional) OpenSSL cipher list.
+    verify: bool (optional) Set to False to skip the verification of the
+            server certificate and host name.
+
+  Returns:
+    An ssl.SSLContext.
+  """
+  context = ssl.create_default_context(cafile=cafile)
+  if not verify:
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+  if certfile:
+    context.load_cert_chain(certfile, keyfile)
+  if ciphers:
+    context.set_ciphers(ciphers)
+  return context
+
+
+_default_ssl_context = None
+
+def DefaultSslContext():
+  """Returns the SSLContext of services which weren't given their own."""
+  global _default_ssl_context
+  if _default_ssl_context is None:
+    _default_ssl_context = CreateSslContext()
+  return _default_ssl_context
+
+
+def _NoDelay(sock):
+  """Disables the Nagle algorithm, the body parts which follow the headers
+  shouldn't wait for the server's acknowledgement."""
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def _TimeConnect(connection, started):
+  """Records how long connection took to look up and connect to the server
+  in its RequestTiming, if it has one."""
+  timing = getattr(connection, 'timing', None)
+  if timing is None:
+    return
+  timing.dns = getattr(connection._create_connection, 'lookup_time', None)
+  timing.connect = time.time() - started - (timing.dns or 0.0)
+
+
+class _HeaderLines:
+  """Lets a connection send header lines which were formatted before."""
+
+  def putheaderlines(self, lines):
+    """Sends 'Name: value' lines, as returned by _HeaderBlock, which checked
+    them like putheader() does."""
+    self._buffer.extend(lines)
+
+
+class PooledHTTPConnection(_HeaderLines, httplib.HTTPConnection):
+  """HTTPConnection which sends small writes without Nagle delay."""
+
+  timing = None
+
+  def connect(self):
+    started = time.time()
+    httplib.HTTPConnection.connect(self)
+    _NoDelay(self.sock)
+    _TimeConnect(self, started)
+
+
+class PooledHTTPSConnection(_HeaderLines, httplib.HTTPSConnection):
+  """HTTPSConnection which sends small writes without Nagle delay and times
+  the TLS handshake."""
+
+  timing = None
+
+  def connect(self):
+    started = time.time()
+    httplib.HTTPConnection.connect(self)
+    _NoDelay(self.sock)
+    _TimeConnect(self, started)
+    started = time.time()
+    if self._tunnel_host:
+      key = (self._tunnel_host, self._tunnel_port)
+    else:
+      key = (self.host, self.port)
+    self.sock = self._context.wrap_socket(self.sock, server_hostname=key[0])
+    if self.timing is not None:
+      self.timing.tls = time.time() - started
+
+
+class ClosedBeforeResponse(httplib.BadStatusLine):
+  """The connection was closed before any byte of the response arrived."""
+
+
+class PooledHTTPResponse(httplib.HTTPResponse):
+  """An HTTPResponse which hands its connection back to a ConnectionPool.
+
+  The connection is only released once the body has been read completely,
+  so a following request on the same connection never sees left-over bytes
+  of this response. Responses which are closed before they are drained close
+  their connection.
+
+  If decode_content is set, a gzip or deflate encoded body is decompressed
+  while it is read. wire_bytes and decoded_bytes count the body bytes as
+  received and as returned by read(). The RequestTiming of the request, if
+  any, is finished once the body has been read completely.
+  """
+
+  pool = None
+  connection = None
+  decode_content = False
+  stats = None
+  download_limit = None
+  limit_host = None
+  timing = None
+  wire_bytes = 0
+  decoded_bytes = 0
+  _decoder = None
+  _reading = False
+
+  def _read_status(self):
+    # Nothing at all means that the server closed the connection before it
+    # answered, unlike a garbled status line.
+    line = self.fp.readline(httplib._MAXLINE + 1)
+    if not line:
+      raise ClosedBeforeResponse('')
+    (fp, self.fp) = (self.fp, StringIO.StringIO(line))
+    try:
+      return httplib.HTTPResponse._read_status(self)
+    finally:
+      if isinstance(self.fp, httplib.LineAndFileWrapper):
+        # An HTTP/0.9 response, whose body starts with line.
+        self.fp = httplib.LineAndFileWrapper(line, fp)
+      else:
+        self.fp = fp
+
+  def close(self):
+    httplib.HTTPResponse.close(self)
+    if not self._reading:
+      # Closed by the caller, the connection can only be reused if the body
+      # had been read up to its end already.
+      self.__Release()
+
+  def read(self, amt=None):
+    if self._decoder is None and self.decode_content:
+      encoding = (self.getheader('content-encoding') or '').strip().lower()
+      if encoding in DECODED_ENCODINGS:
+        # Detects the gzip or zlib header by itself.
+        self._decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+      self.decode_content = False
+    decoder = self._decoder
+    if decoder is None:
+      data = self.__ReadRaw(amt)
+    elif amt is None:
+      data = decoder.decompress(decoder.unconsumed_tail + self.__ReadRaw())
+      data += decoder.flush()
+    else:
+      # Never return more than amt bytes, keep the rest compressed.
+      data = ''
+      while not data:
+        if decoder.unconsumed_tail:
+          data = decoder.decompress(decoder.unconsumed_tail, amt)
+          continue
+        raw = self.__ReadRaw(amt)
+        if not raw:
+          data = decoder.flush()
+          break
+        data = decoder.decompress(raw, amt)
+    self.decoded_bytes += len(data)
+    if self.stats is not None and data:
+      self.stats.add('response_bytes_decoded', len(data))
+    return data
+
+  def __ReadRaw(self, amt=None):
+    was_open = self.fp is not None
+    self._reading = True
+    try:
+      data = httplib.HTTPResponse.read(self, amt)
+    finally:
+      self._reading = False
+    self.wire_bytes += len(data)
+    if self.stats is not None and data:
+      self.stats.add('response_bytes_wire', len(data))
+    if was_open and self.fp is None:
+      self.__Release(True)
+    if self.download_limit is not None and data:
+      self.download_limit.wait(len(data), self.limit_host)
+    return data
+
+  def __Release(self, drained=False):
+    (pool, connection) = (self.pool, self.connection)
+    self.pool = None
+    self.connection = None
+    if self.timing is not None:
+      (timing, self.timing) = (self.timing, None)
+      timing.finish(self.status, self.wire_bytes)
+    if connection is None:
+      return
+    # will_close responses own the socket and a known length must have been
+    # read up to the last byte.
+    if drained and pool is not None and not self.will_close and \
+        not self.length:
+      pool.put(connection)
+    else:
+      connection.close()
+
+
+class ConnectionPool(object):
+  """Keeps idle keep-alive connections around so they can be reused.
+
+  Connections are keyed by (server, port, ssl, proxy) and handed out most
+  recently used first, proxy being set for https tunnels through a proxy.
+  A connection which has been idle for longer than idle_timeout seconds, or
+  which has been closed by the server in the meantime, is discarded instead
+  of reused. The pool can be shared between threads.
+  """
+
+  def __init__(self, max_per_host=10, idle_timeout=30):
+    """Creates a new ConnectionPool.
+
+    Args:
+      max_per_host: int (optional) The maximum number of idle connections
+                    that are kept for each (server, port, ssl, proxy).
+      idle_timeout: int (optional) Number of seconds after which an idle
+                    connection is closed.
+    """
+    self.max_per_host = max_per_host
+    self.idle_timeout = idle_timeout
+    self.created = 0
+    self.reused = 0
+    self._idle = {}
+    self._connections = weakref.WeakSet()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """Returns an idle connection for key, or None if there is none."""
+    expires = time.time() - self.idle_timeout
+    with self._lock:
+      idle = self._idle.get(key)
+      while idle:
+        (connection, released) = idle.pop()
+        if released < expires or _ConnectionDropped(connection):
+          connection.close()
+          continue
+        connection.reused = True
+        self.reused += 1
+        return connection
+    return None
+
+  def add(self, connection):
+    """Counts a new connection, which is handed back with put()."""
+    with self._lock:
+      self.created += 1
+      self._connections.add(connection)
+
+  def put(self, connection):
+    """Adds a connection, whose last response has been drained, to the pool.
+    """
+    key = connection.pool_key
+    now = time.time()
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      while idle and idle[0][1] < now - self.idle_timeout:
+        idle.pop(0)[0].close()
+      if connection.sock is None or len(idle) >= self.max_per_host:
+        connection.close()
+      else:
+        idle.append((connection, now))
+
+  def clear(self):
+    """Closes all idle connections."""
+    with self._lock:
+      for idle in self._idle.values():
+        for (connection, released) in idle:
+          connection.close()
+      self._idle = {}
+
+  def counts(self):
+    """Returns a dict with the number of 'idle' connections, of 'active'
+    ones (open and in use) and of the connections 'created' and 'reused' so
+    far."""
+    with self._lock:
+      idle = sum([len(idle) for idle in self._idle.values()])
+      opened = len([connection for connection in self._connections
+          if connection.sock is not None])
+      return {'idle': idle, 'active': max(0, opened - idle),
+          'created': self.created, 'reused': self.reused}
+
+
+class TransferStats(object):
+  """Thread-safe counters describing the traffic of one or more services.
+
+  Counters are created on first use, so get() returns 0 for anything that
+  has not happened yet.
+  """
+
+  def __init__(self):
+    self._counts = {}
+    self._lock = threading.Lock()
+
+  def add(self, name, value=1):
+    """Increments the counter called name by value."""
+    with self._lock:
+      self._counts[name] = self._counts.get(name, 0) + value
+
+  def get(self, name):
+    """Returns the current value of the counter called name."""
+    return self._counts.get(name, 0)
+
+  def snapshot(self):
+    """Returns a dict with a copy of all counters."""
+    with self._lock:
+      return dict(self._counts)
+
+
+class TransferProgress(object):
+  """Progress and throughput of one upload or download.
+
+  The transfer calls update() with the size of every piece it sends or
+  receives, which then calls callback(progress) with this object. Next to
+  bytes and total (None while unknown) it has:
+
+    elapsed: seconds since the transfer started.
+    rate: bytes per second over the last window seconds. It drops as soon as
+          the transfer slows down or stalls.
+    average_rate: bytes per second since the start.
+
+  When a transfer has stats (a TransferStats, normally service.stats), its
+  bytes and duration are added to the '<kind>_bytes' and '<kind>_seconds'
+  counters and it is counted in '<kind>s', kind being 'upload' or
+  'download'. The aggregate throughput of a service is then
+  <kind>_bytes / <kind>_seconds.
+  """
+
+  def __init__(self, callback=None, total=None, window=1.0):
+    """Creates a new TransferProgress.
+
+    Args:
+      callback: func (optional) Called with this object after every update.
+      total: int (optional) The number of bytes to transfer.
+      window: float (optional) Seconds over which rate is measured.
+    """
+    self.callback = callback
+    self.total = total
+    self.window = window
+    self.kind = None
+    self.stats = None
+    self.bytes = 0
+    self.skipped = 0
+    self.started = None
+    self.finished = None
+    self._samples = collections.deque()
+    self._lock = threading.Lock()
+
+  def start(self):
+    """Starts the clock, if the transfer hasn't started yet."""
+    with self._lock:
+      self._Start(time.time())
+
+  def skip(self, length):
+    """Accounts for length bytes transferred before, eg. by an earlier run
+    of a resumed transfer. They don't count towards the throughput."""
+    with self._lock:
+      self.bytes += length
+      self.skipped += length
+      self._samples = collections.deque([(time.time(), self.bytes)])
+
+  def rewind(self, length):
+    """Takes back length bytes which are going to be sent again, eg. when a
+    request is retried after its pooled connection turned out to be
+    closed."""
+    if not length:
+      return
+    with self._lock:
+      self.bytes -= length
+      self._samples = collections.deque([(time.time(), self.bytes)])
+    if self.stats is not None:
+      self.stats.add(self.kind + '_bytes', -length)
+
+  def update(self, length):
+    """Adds length bytes which have just been sent or received."""
+    now = time.time()
+    with self._lock:
+      self._Start(now)
+      self.bytes += length
+      self._samples.append((now, self.bytes))
+      self._Prune(now)
+    if self.stats is not None:
+      self.stats.add(self.kind + '_bytes', length)
+    if self.callback is not None:
+      self.callback(self)
+
+  def finish(self):
+    """Stops the clock and updates the counters of the transfer."""
+    with self._lock:
+      if self.finished is not None:
+        return
+      self._Start(time.time())
+      self.finished = time.time()
+    if self.stats is not None:
+      self.stats.add(self.kind + 's')
+      self.stats.add(self.kind + '_seconds', self.elapsed)
+
+  @property
+  def elapsed(self):
+    if self.started is None:
+      return 0.0
+    return (self.finished or time.time()) - self.started
+
+  @property
+  def rate(self):
+    now = self.finished or time.time()
+    with self._lock:
+      self._Prune(now)
+      if not self._samples or now <= self._samples[0][0]:
+        return 0.0
+      (then, count) = self._samples[0]
+      return (self.bytes - count) / (now - then)
+
+  @property
+  def average_rate(self):
+    elapsed = self.elapsed
+    if not elapsed:
+      return 0.0
+    return (self.bytes - self.skipped) / elapsed
+
+  def _Start(self, now):
+    if self.started is None:
+      self.started = now
+      self._samples.append((now, self.bytes))
+
+  def _Prune(self, now):
+    # Keep the last sample from before the window as the starting point.
+    samples = self._samples
+    while len(samples) > 1 and samples[1][0] <= now - self.window:
+      samples.popleft()
+
+
+def MakeProgress(progress, kind, stats=None, total=None):
+  """Returns the TransferProgress to update for a transfer.
+
+  Args:
+    progress: TransferProgress, func or None. A function is called with the
+        number of bytes transferred and the total, as (bytes, total).
+    kind: string 'upload' or 'download'.
+    stats: TransferStats (optional) The counters to update.
+    total: int (optional) The number of bytes to transfer.
+  """
+  if progress is None:
+    progress = TransferProgress()
+  elif not isinstance(progress, TransferProgress):
+    progress = TransferProgress(_BytesCallback(progress))
+  progress.kind = kind
+  progress.stats = stats
+  if total is not None:
+    progress.total = total
+  return progress
+
+
+def _BytesCallback(callback):
+  return lambda progress: callback(progress.bytes, progress.total)
+
+
+class BandwidthLimiter(object):
+  """Token bucket which caps the throughput of all transfers sharing it.
+
+  rate is the cap in bytes per second for all of them together, host_rate
+  (optional) an extra cap per host. Capacity which isn't used builds up for
+  at most burst seconds. reserve() takes the tokens for a piece of data and
+  returns how long to wait before the next piece: blocking transfers sleep,
+  the event loop stops polling the connection for that long, so nothing
+  spins while it waits. The limiter can be shared between threads, services
+  and event loops. The bucket of a host is dropped once it has filled up
+  again, at most prune_interval seconds later.
+  """
+
+  prune_interval = 10.0
+
+  def __init__(self, rate=None, host_rate=None, burst=0.25):
+    """Creates a new BandwidthLimiter.
+
+    Args:
+      rate: int (optional) Bytes per second for all transfers.
+      host_rate: int (optional) Bytes per second for the transfers to one
+                 host.
+      burst: float (optional) Seconds of unused capacity which can be spent
+             at once.
+    """
+    self.rate = rate
+    self.host_rate = host_rate
+    self.burst = burst
+    self._buckets = {}
+    self._pruned = time.time()
+    self._lock = threading.Lock()
+
+  def reserve(self, length, host=None):
+    """Takes length bytes from the buckets.
+
+    Returns:
+      The number of seconds to wait before sending or receiving more.
+    """
+    now = time.time()
+    delay = 0.0
+    with self._lock:
+      if self.rate:
+        delay = self._Take(None, self.rate, length, now)
+      if self.host_rate and host is not None:
+        delay = max(delay, self._Take(host, self.host_rate, length, now))
+      if now - self._pruned >= self.prune_interval:
+        self._Prune(now)
+    return delay
+
+  def wait(self, length, host=None):
+    """Takes length bytes from the buckets, sleeping if they are empty."""
+    delay = self.reserve(length, host)
+    if delay > 0:
+      time.sleep(delay)
+
+  def cap(self, size):
+    """Returns size, limited to the burst of the smallest rate."""
+    rates = [rate for rate in (self.rate, self.host_rate) if rate]
+    if not rates:
+      return size
+    return max(1024, min(size, int(min(rates) * self.burst)))
+
+  def _Take(self, key, rate, length, now):
+    # A bucket can go into debt, later callers then wait for it as well.
+    bucket = self._buckets.get(key)
+    if bucket is None:
+      bucket = self._buckets[key] = [rate * self.burst, now]
+    tokens = min(rate * self.burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[0] = tokens - length
+    bucket[1] = now
+    if bucket[0] >= 0:
+      return 0.0
+    return -bucket[0] / float(rate)
+
+  def _Prune(self, now):
+    # A full bucket is the same as a new one, so idle hosts needn't be kept.
+    self._pruned = now
+    rate = self.host_rate or 0
+    for key, (tokens, updated) in self._buckets.items():
+      if key is not None and \
+          tokens + (now - updated) * rate >= rate * self.burst:
+        del self._buckets[key]
+
+
+class RequestTiming(object):
+  """Where the time of one request went.
+
+  It is passed to the request_observers of the service once the response
+  body has been read, or once the request has failed. The phases are in
+  seconds, None for those which didn't happen (a reused connection has no
+  dns, connect and tls):
+
+    dns: looking up the address of the server.
+    connect: opening the connection, including the CONNECT of a proxy.
+    tls: the TLS handshake.
+    send: sending the request headers and body.
+    ttfb: waiting for the response, up to its first byte.
+    body: receiving the rest of the response.
+    total: the whole request.
+
+  Next to those it has service (the name of its class), verb, uri (see
+  UriTemplate), status (None when the request failed), error, reused,
+  request_bytes and response_bytes (the body bytes as sent and received)
+  and started (the time.time() at which the request started).
+  """
+
+  def __init__(self, observers, service, verb, uri):
+    self.observers = observers
+    self.service = service
+    self.verb = verb
+    self.uri = uri
+    self.status = None
+    self.error = None
+    self.reused = False
+    self.dns = None
+    self.connect = None
+    self.tls = None
+    self.send = None
+    self.ttfb = None
+    self.body = None
+    self.total = None
+    self.request_bytes = 0
+    self.response_bytes = 0
+    self.started = time.time()
+    self._sending = None
+    self._waiting = None
+    self._receiving = None
+
+  def sending(self):
+    """Marks the start of the request, once connected."""
+    self._sending = time.time()
+    self._waiting = None
+    self._receiving = None
+    self.request_bytes = 0
+
+  def waiting(self):
+    """Marks the end of the request."""
+    if self._waiting is None:
+      self._waiting = time.time()
+
+  def receiving(self):
+    """Marks the start of the response."""
+    if self._receiving is None:
+      self._receiving = time.time()
+
+  def finish(self, status=None, response_bytes=0, error=None):
+    """Completes the phases and passes the timing to the observers."""
+    if self.total is not None:
+      return
+    now = time.time()
+    self.status = status
+    self.response_bytes = response_bytes
+    self.error = error
+    if self._sending is not None:
+      self.send = (self._waiting or self._receiving or now) - self._sending
+    if self._waiting is not None and self._receiving is not None:
+      self.ttfb = max(0.0, self._receiving - self._waiting)
+    if self._receiving is not None:
+      self.body = now - self._receiving
+    self.total = now - self.started
+    for observer in list(self.observers):
+      observer(self)
+
+  def __str__(self):
+    phases = ['%s %.3fs' % (name, getattr(self, name)) for name in
+        ('dns', 'connect', 'tls', 'send', 'ttfb', 'body')
+        if getattr(self, name) is not None]
+    if self.error is not None:
+      outcome = 'failed (%s)' % (self.error,)
+    else:
+      outcome = str(self.status)
+    return '%s %s %s %s in %.3fs (%s), %d bytes sent, %d received%s' % (
+        self.service, self.verb, self.uri, outcome, self.total or 0.0,
+        ', '.join(phases), self.request_bytes, self.response_bytes,
+        self.reused and ', reused connection' or '')
+
+
+class TimingBuffer(object):
+  """Request observer which keeps the RequestTimings of the last size
+  requests.
+
+  Usage:
+    timings = TimingBuffer()
+    service.request_observers.append(timings)
+    ...
+    slowest = max(timings.records(), key=lambda timing: timing.total)
+  """
+
+  def __init__(self, size=1000):
+    self._records = collections.deque(maxlen=size)
+    self._lock = threading.Lock()
+
+  def __call__(self, timing):
+    with self._lock:
+      self._records.append(timing)
+
+  def __len__(self):
+    return len(self._records)
+
+  def records(self):
+    """Returns a list of the kept timings, oldest first."""
+    with self._lock:
+      return list(self._records)
+
+  def clear(self):
+    with self._lock:
+      self._records.clear()
+
+
+class SlowRequestLog(object):
+  """Request observer which logs the requests which took at least threshold
+  seconds, with the time of each of their phases.
+
+  Usage:
+    service.request_observers.append(SlowRequestLog(threshold=2.0))
+  """
+
+  def __init__(self, threshold=1.0, logger=None, level=logging.WARNING):
+    """Creates a new SlowRequestLog.
+
+    Args:
+      threshold: float (optional) Seconds from which a request is logged.
+      logger: logging.Logger (optional) Defaults to the 'raws_json' logger.
+      level: int (optional) Level of the messages.
+    """
+    self.threshold = threshold
+    self.logger = logger or logging.getLogger('raws_json')
+    self.level = level
+
+  def __call__(self, timing):
+    if timing.total >= self.threshold:
+      self.logger.log(self.level, 'Slow request: %s', timing)
+
+
+def UriTemplate(uri):
+  """Returns the path of uri without its query, with the segments which
+  are ids (see ID_SEGMENT_REGEX) replaced by '{id}', so the requests for
+  different entries of the same kind are reported under one name."""
+  match = URL_REGEX.match(uri)
+  if match is not None:
+    uri = match.group(5) or '/'
+  path = uri.split('?', 1)[0].split('#', 1)[0]
+  return '/'.join([ID_SEGMENT_REGEX.match(segment) and '{id}' or segment
+      for segment in path.split('/')])
+
+
+def _StartTiming(service, operation, uri):
+  """Returns the RequestTiming of a request, None if nothing observes the
+  requests of service."""
+  observers = getattr(service, 'request_observers', None)
+  if not observers:
+    return None
+  template = getattr(service, 'uri_template', None) or UriTemplate
+  return RequestTiming(observers, service.__class__.__name__, operation,
+      template(uri))
+
+
+class DnsCache(object):
+  """Caches host name lookups (getaddrinfo) for a limited time.
+
+  Failed lookups are cached as well, for negative_ttl seconds, so a host that
+  doesn't resolve doesn't cost a resolver round trip on every request. The
+  addresses of a host can also be pinned, which bypasses the resolver
+  altogether. The cache can be shared between threads.
+  """
+
+  def __init__(self, ttl=300, negative_ttl=10):
+    """Creates a new DnsCache.
+
+    Args:
+      ttl: int (optional) Number of seconds a successful lookup is reused.
+      negative_ttl: int (optional) Number of seconds a failed lookup is
+                    reused.
+    """
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self._entries = {}
+    self._pinned = {}
+    self._lock = threading.Lock()
+
+  def pin(self, host, addresses):
+    """Makes host always resolve to the given list of IP addresses."""
+    with self._lock:
+      self._pinned[host] = list(addresses)
+
+  def unpin(self, host):
+    """Resolves host through the resolver again."""
+    with self._lock:
+      self._pinned.pop(host, None)
+
+  def forget(self, host, port):
+    """Removes the cached lookup of host and port."""
+    with self._lock:
+      self._entries.pop((host, port), None)
+
+  def clear(self):
+    with self._lock:
+      self._entries = {}
+
+  def resolve(self, host, port):
+    """Looks up the addresses for a TCP connection to host and port.
+
+    Returns:
+      A list of (family, socktype, proto, canonname, sockaddr) tuples, like
+      socket.getaddrinfo().
+
+    Raises:
+      socket.gaierror if the host doesn't resolve, also when that failure
+      is still cached.
+    """
+    key = (host, port)
+    now = time.time()
+    with self._lock:
+      pinned = self._pinned.get(host)
+      entry = self._entries.get(key)
+    if pinned is not None:
+      return [_PinnedAddrInfo(address, port) for address in pinned]
+    if entry is not None and entry[0] > now:
+      if isinstance(entry[1], Exception):
+        raise entry[1]
+      return entry[1]
+    try:
+      addr_infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    except socket.gaierror, e:
+      with self._lock:
+        self._entries[key] = (now + self.negative_ttl, e)
+      raise
+    with self._lock:
+      self._entries[key] = (now + self.ttl, addr_infos)
+    return addr_infos
+
+
+def _ConnectAny(addr_infos, timeout, source_address):
+  """Returns a socket connected to the first of addr_infos which accepts
+  the connection."""
+  error = None
+  for (family, socktype, proto, canonname, sockaddr) in addr_infos:
+    sock = None
+    try:
+      sock = socket.socket(family, socktype, proto)
+      if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+        sock.settimeout(timeout)
+      if source_address:
+        sock.bind(source_address)
+      sock.connect(sockaddr)
+      return sock
+    except socket.error, e:
+      error = e
+      if sock is not None:
+        sock.close()
+  if error is None:
+    error = socket.error('getaddrinfo returns an empty list')
+  raise error
+
+
+class _Connector(object):
+  """The _create_connection of pooled connections, which keeps how long
+  the lookup of the last socket it opened took.
+
+  Hosts are resolved through dns_cache when there is one. If none of the
+  addresses accepts the connection the lookup is forgotten, so the next
+  attempt asks the resolver again.
+  """
+
+  lookup_time = None
+
+  def __init__(self, dns_cache=None):
+    self.dns_cache = dns_cache
+
+  def __call__(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+      source_address=None):
+    (host, port) = address
+    started = time.time()
+    if self.dns_cache is None:
+      addr_infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    else:
+      addr_infos = self.dns_cache.resolve(host, port)
+    self.lookup_time = time.time() - started
+    try:
+      return _ConnectAny(addr_infos, timeout, source_address)
+    except socket.error:
+      if self.dns_cache is not None:
+        self.dns_cache.forget(host, port)
+      raise
+
+
+def _PinnedAddrInfo(address, port):
+  if ':' in address:
+    return (socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+        (address, port, 0, 0))
+  return (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+      (address, port))
+
+
+# The DnsCache shared by all services of the process, unless they are given
+# their own.
+default_dns_cache = DnsCache()
+
+
+def _ConnectionDropped(connection):
+    """Checks if an idle connection has been closed by the server.
+
+    An idle keep-alive socket should have nothing to read, so if it is
+    readable the server either closed it or sent something unexpected.
+    """
+    if connection.sock is None:
+      return True
+    try:
+      return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+      return True
+
+
+def _GetConnection(service, server, port, ssl, proxy=None):
+    """Returns an idle pooled connection to the server or opens a new one.
+
+    Args:
+      proxy: tuple (optional) (server, port, username, password) of the proxy
+             through which an https connection is tunneled with CONNECT.
+    """
+    key = (server, port, ssl, proxy)
+    pool = getattr(service, 'connection_pool', None)
+    stats = getattr(service, 'stats', None)
+    if pool is not None:
+      connection = pool.get(key)
+      if connection is not None:
+        if stats is not None:
+          stats.add('connections_reused')
+        # Pooled connections can be shared by services with other limits.
+        connection.upload_limit = getattr(service, 'upload_limit', None)
+        return connection
+    if stats is not None:
+      stats.add('connections_created')
+    if ssl:
+      context = getattr(service, 'ssl_context', None) or DefaultSslContext()
+      if proxy:
+        (p_server, p_port, proxy_username, proxy_password) = proxy
+        connection = PooledHTTPSConnection(p_server, p_port, context=context)
+        connection.set_tunnel(server, port, _TunnelHeaders(service, proxy))
+      else:
+        connection = PooledHTTPSConnection(server, port, context=context)
+    else:
+      connection = PooledHTTPConnection(server, port)
+    connection._create_connection = _Connector(getattr(service, 'dns_cache',
+        None))
+    if pool is not None:
+      pool.add(connection)
+    connection.response_class = PooledHTTPResponse
+    connection.pool_key = key
+    connection.reused = False
+    connection.upload_limit = getattr(service, 'upload_limit', None)
+    connection.limit_host = server
+    return connection
+
+
 def PrepareConnection(service, full_uri):
     """Opens a connection to the server based on the full URI.
 
@@ -430,82 +1915,83 @@ def PrepareConnection(service, full_uri):
 
     (server, port, ssl, partial_uri) = ProcessUrl(service, full_uri)
     if ssl:
-      # destination is https
-      proxy = os.environ.get('https_proxy')
-      if proxy:
-        (p_server, p_port, p_ssl, p_uri) = ProcessUrl(service, proxy, True)
-        proxy_username = os.environ.get('proxy-username')
-        if not proxy_username:
-          proxy_username = os.environ.get('proxy_username')
-        proxy_password = os.environ.get('proxy-password')
-        if not proxy_password:
-          proxy_password = os.environ.get('proxy_password')
-        if proxy_username:
-          user_auth = base64.encodestring('%s:%s' % (proxy_username,
-                                                     proxy_password))
-          proxy_authorization = ('Proxy-authorization: Basic %s\r\n' % (
-              user_auth.strip()))
-        else:
-          proxy_authorization = ''
-        proxy_connect = 'CONNECT %s:%s HTTP/1.0\r\n' % (server, port)
-        user_agent = 'User-Agent: %s\r\n' % (
-            service.additional_headers['User-Agent'])
-        proxy_pieces = (proxy_connect + proxy_authorization + user_agent
-                         + '\r\n')
-
-        #now connect, very simple recv and error checking
-        p_sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        p_sock.connect((p_server,p_port))
-        p_sock.sendall(proxy_pieces)
-        response = ''
-
-        # Wait for the full response.
-        while response.find("\r\n\r\n") == -1:
-          response += p_sock.recv(8192)
-
-        p_status=response.split()[1]
-        if p_status!=str(200):
-          raise 'Error status=',str(p_status)
-
-        # Trivial setup for ssl socket.
-        ssl = socket.ssl(p_sock, None, None)
-        fake_sock = httplib.FakeSocket(p_sock, ssl)
-
-        # Initalize httplib and replace with the proxy socket.
-        connection = httplib.HTTPConnection(server)
-        connection.sock=fake_sock
-        full_uri = partial_uri
-
-      else:
-        connection = httplib.HTTPSConnection(server, port)
-        full_uri = partial_uri
-
+      # destination is https, through a proxy it is tunneled with CONNECT.
+      proxy = _ProxyFromEnvironment(service, True)
+      connection = _GetConnection(service, server, port, True, proxy)
+      full_uri = partial_uri
     else:
       # destination is http
-      proxy = os.environ.get('http_proxy')
+      proxy = _ProxyFromEnvironment(service, False)
       if proxy:
-        (p_server, p_port, p_ssl, p_uri) = ProcessUrl(service.server, proxy, True)
-        proxy_username = os.environ.get('proxy-username')
-        if not proxy_username:
-          proxy_username = os.environ.get('proxy_username')
-        proxy_password = os.environ.get('proxy-password')
-        if not proxy_password:
-          proxy_password = os.environ.get('proxy_password')
-        if proxy_username:
-          UseBasicAuth(service, proxy_username, proxy_password, True)
-        connection = httplib.HTTPConnection(p_server, p_port)
+        (p_server, p_port, proxy_username, proxy_password) = proxy
+        connection = _GetConnection(service, p_server, p_port, False)
         if not full_uri.startswith("http://"):
           if full_uri.startswith("/"):
             full_uri = "http://%s%s" % (service.server, full_uri)
           else:
             full_uri = "http://%s/%s" % (service.server, full_uri)
       else:
-        connection = httplib.HTTPConnection(server, port)
+        connection = _GetConnection(service, server, port, False)
         full_uri = partial_uri
 
     return (connection, full_uri)
 
 
+def _TunnelHeaders(service, proxy):
+    """Returns the headers of the CONNECT request which opens a tunnel."""
+    (p_server, p_port, proxy_username, proxy_password) = proxy
+    headers = {}
+    if proxy_username:
+      user_auth = base64.encodestring('%s:%s' % (proxy_username,
+                                                 proxy_password))
+      headers['Proxy-Authorization'] = 'Basic %s' % user_auth.strip()
+    if isinstance(service.additional_headers, dict) and \
+        service.additional_headers.has_key('User-Agent'):
+      headers['User-Agent'] = service.additional_headers['User-Agent']
+    return headers
+
+
+def _ProxyFromEnvironment(service, ssl):
+    """Looks up the proxy to use for an http or https destination.
+
+    The proxy is taken from the https_proxy or http_proxy environment
+    variable, its credentials from proxy-username (or proxy_username) and
+    proxy-password (or proxy_password). The environment is read once per
+    service, UseBasicAuth makes it be read again. For an http proxy with
+    credentials the Proxy-Authorization header is added to the service.
+
+    Returns:
+      A tuple (server, port, username, password) describing the proxy, or
+      None if requests should go out directly.
+    """
+    cache = getattr(service, '_proxy_cache', None)
+    if cache is None:
+      cache = service._proxy_cache = {}
+    if ssl not in cache:
+      proxy = _ReadProxyEnvironment(service, ssl)
+      if proxy and proxy[2] and not ssl:
+        UseBasicAuth(service, proxy[2], proxy[3], True)
+      cache[ssl] = proxy
+    return cache[ssl]
+
+
+def _ReadProxyEnvironment(service, ssl):
+    if ssl:
+      proxy = os.environ.get('https_proxy')
+    else:
+      proxy = os.environ.get('http_proxy')
+    if not proxy:
+      return None
+    (p_server, p_port, p_ssl, p_uri) = ProcessUrl(service.server, proxy, True)
+    proxy_username = os.environ.get('proxy-username')
+    if not proxy_username:
+      proxy_username = os.environ.get('proxy_username')
+    proxy_password = os.environ.get('proxy-password')
+    if not proxy_password:
+      proxy_password = os.environ.get('proxy_password')
+    return (p_server, p_port, proxy_username, proxy_password)
+
+
 def UseBasicAuth(service, username, password, for_proxy=False):
     """Sets an Authenticaiton: Basic HTTP header containing plaintext.
 
@@ -526,6 +2012,8 @@ def UseBasicAuth(service, username, password, for_proxy=False):
       header_name = 'Proxy-Authorization'
     else:
       header_name = 'Authorization'
+      # Credentials changed, pick up the proxy settings again as well.
+      service._proxy_cache = None
     service.additional_headers[header_name] = 'Basic %s' % (base_64_string,)
 
 
@@ -636,61 +2124,369 @@ def BuildUri(uri, url_params=None, escape_params=True):
     return full_uri
 
 
+def IterResponse(response, chunk_size=READ_CHUNK_SIZE):
+    """Yields the body of an HTTP response in chunks.
+
+    At most chunk_size bytes of the body are held in memory at a time. Once
+    the body has been read completely a pooled connection is released.
+
+    Args:
+      response: httplib.HTTPResponse or an object with a similar read method.
+      chunk_size: int (optional) The maximum size of each chunk.
+    """
+    try:
+      while 1:
+        data = response.read(chunk_size)
+        if not data: break
+        yield data
+    finally:
+      # Closes the connection if the caller stopped before the end.
+      if hasattr(response, 'isclosed') and not response.isclosed():
+        response.close()
+
+
+def CopyResponse(response, file_handle, chunk_size=READ_CHUNK_SIZE):
+    """Writes the body of an HTTP response to a file object in chunks.
+
+    Args:
+      response: httplib.HTTPResponse or an object with a similar read method.
+      file_handle: An object with a write method, eg. an open file.
+      chunk_size: int (optional) The maximum number of bytes held in memory.
+
+    Returns:
+      The number of bytes written.
+    """
+    written = 0
+    for data in IterResponse(response, chunk_size):
+      file_handle.write(data)
+      written += len(data)
+    return written
+
+
+class MultipartBody(object):
+  """A multipart/related request body made of strings and MediaSources.
+
+  The body is kept as a list of parts in which all consecutive strings
+  (boundaries, part headers and string data) are joined, so it is sent with
+  as few writes as possible and files are never read into memory. Its length
+  is computed from the parts, without building the body.
+  """
+
+  def __init__(self, boundary='END_OF_PART',
+      preamble='Media multipart posting\r\n'):
+    self.boundary = boundary
+    self._parts = []
+    self._strings = [preamble]
+    self._count = 0
+
+  def addPart(self, content_type, data):
+    """Appends a part to the body.
+
+    Args:
+      content_type: string The MIME type of the part.
+      data: string or MediaSource The content of the part.
+    """
+    if self._count:
+      self._strings.append('\r\n')
+    self._strings.append('--%s\r\nContent-Type: %s\r\n\r\n' % (
+        self.boundary, content_type))
+    self._count += 1
+    if isinstance(data, str):
+      self._strings.append(data)
+    else:
+      self._parts.append(''.join(self._strings))
+      self._parts.append(data)
+      self._strings = []
+
+  def getParts(self):
+    """Returns the body as a list of strings and MediaSources."""
+    closing = ''.join(self._strings) + '\r\n--%s--\r\n' % self.boundary
+    return self._parts + [closing]
+
+  def getLength(self):
+    """Returns the number of bytes in the body, or None if a MediaSource
+    has no content_length."""
+    length = 0
+    for part in self.getParts():
+      if isinstance(part, str):
+        length += len(part)
+      elif part.content_length is None:
+        return None
+      else:
+        length += int(part.content_length)
+    return length
+
+  def getContentType(self):
+    return 'multipart/related; boundary=%s' % self.boundary
+
+
+class FilePool(object):
+  """Limits the number of files which MediaSources keep open at the same time.
+
+  A MediaSource with a file_pool takes a slot when it opens its file and
+  gives it back when it closes it. When all slots are taken, opening blocks
+  until another thread closes a file.
+  """
+
+  def __init__(self, max_open=64):
+    self.max_open = max_open
+    self.open_files = 0
+    self._condition = threading.Condition()
+
+  def acquire(self):
+    with self._condition:
+      while self.open_files >= self.max_open:
+        self._condition.wait()
+      self.open_files += 1
+
+  def release(self):
+    with self._condition:
+      self.open_files -= 1
+      self._condition.notify()
+
+
 class MediaSource(object):
   """Raws Entries can refer to media sources, so this class provides a
   place to store references to these objects along with some metadata.
   """
 
+  _file_handle = None
+  _path = None
+  _mapping = None
+  _use_mmap = False
+  _position = 0
+
   def __init__(self, file_handle=None, content_type=None, content_length=None,
-      file_path=None, file_name=None, svr_filename = None):
+      file_path=None, file_name=None, svr_filename = None,
+      chunk_size=UPLOAD_CHUNK_SIZE, use_mmap=False, file_pool=None):
     """Creates an object of type MediaSource.
 
     Args:
       file_handle: A file handle pointing to the file to be encapsulated in the
-                   MediaSource
+                   MediaSource. This can also be a pipe, or an iterable of
+                   strings.
       content_type: string The MIME type of the file. Required if a file_handle
                     is given.
-      content_length: int The size of the file. Required if a file_handle is
-                      given.
+      content_length: int The size of the file. If it is None for a
+                      file_handle, the data is sent with chunked
+                      transfer-coding.
       file_path: string (optional) A full path name to the file. Used in
                     place of a file_handle.
       file_name: string The name of the file without any path information.
                  Required if a file_handle is given.
+      chunk_size: int (optional) Number of bytes sent at a time when the file
+                  can't be sent with sendfile.
+      use_mmap: bool (optional) Map the file at file_path into memory, see
+                setFile.
+      file_pool: FilePool (optional) Shared limit on the number of files
+                 open at the same time.
     """
+    # Threads sending ranges of the file may open it at the same time.
+    self._open_lock = threading.Lock()
     self.file_handle = file_handle
     self.content_type = content_type
     self.content_length = content_length
     self.file_name = file_name
     self.svr_filename = svr_filename
     self.file_path = file_path
+    self.chunk_size = chunk_size
+    self.file_pool = file_pool
 
     if (file_handle is None and file_path is not None):
-        self.setFile(file_path, content_type)
+        self.setFile(file_path, content_type, use_mmap)
 
     if not self.svr_filename:
         self.svr_filename = self.file_name
 
+  def _GetFileHandle(self):
+    if self._file_handle is None and self._path is not None:
+      self.open()
+    return self._file_handle
+
+  def _SetFileHandle(self, file_handle):
+    self.close()
+    self._file_handle = file_handle
+    self._path = None
+
+  # A file given by its path is only opened when its data is first needed.
+  file_handle = property(_GetFileHandle, _SetFileHandle)
 
-  def setFile(self, file_name, content_type):
-    """A helper function which can create a file handle from a given filename
-    and set the content type and length all at once.
+  @property
+  def mapping(self):
+    if self._use_mmap and self._file_handle is None and self._path is not None:
+      self.open()
+    return self._mapping
+
+  def setFile(self, file_name, content_type, use_mmap=False):
+    """A helper function which can set the file, content type and length all
+    at once.
+
+    The file itself is opened when it is first read, and closed again by
+    close() (RawsService does so once the request has been sent), so many
+    MediaSources can be created without running out of file descriptors.
+
+    With use_mmap the file is also mapped into memory read-only. The body is
+    then sent, hashed and split into ranges from slices of the mapping
+    (see getView), so the data isn't copied into Python strings first.
 
     Args:
       file_name: string The path and file name to the file containing the media
       content_type: string A MIME type representing the type of the media
+      use_mmap: bool (optional) Map the file into memory.
     """
-    self.file_handle = open(file_name, 'rb')
+    self.file_handle = None
+    self._path = file_name
+    self._use_mmap = use_mmap
+    self.file_path = file_name
     self.content_type = content_type
     self.content_length = os.path.getsize(file_name)
     self.file_name = os.path.basename(file_name)
 
+  def open(self):
+    """Opens the file set with setFile, if it isn't open yet.
+
+    When the MediaSource has a file_pool this waits for a free slot in it.
+    The file is opened only once, also when several threads ask for it.
+    """
+    with self._open_lock:
+      if self._file_handle is not None or self._path is None:
+        return
+      if self.file_pool is not None:
+        self.file_pool.acquire()
+      file_handle = None
+      try:
+        file_handle = open(self._path, 'rb')
+        # An empty file can't be mapped.
+        if self._use_mmap and self.content_length:
+          self._mapping = mmap.mmap(file_handle.fileno(), 0,
+              access=mmap.ACCESS_READ)
+      except:
+        if file_handle is not None:
+          file_handle.close()
+        if self.file_pool is not None:
+          self.file_pool.release()
+        raise
+      self._file_handle = file_handle
+      self.seek(self._position)
+
+  def close(self):
+    """Closes the file set with setFile. It is opened again, at the position
+    it was closed at, when it is read later on. A file_handle passed in by
+    the caller is left open.
+    """
+    with self._open_lock:
+      if self._file_handle is None or self._path is None:
+        return
+      self._position = self.tell()
+      if self._mapping is not None:
+        self._mapping.close()
+        self._mapping = None
+      self._file_handle.close()
+      self._file_handle = None
+      if self.file_pool is not None:
+        self.file_pool.release()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  # File-like access to the data, so a MediaSource can be sent as request
+  # body and rewound when a request is retried. Until the file is opened
+  # only its position is kept.
+  def read(self, size=-1):
+    mapping = self.mapping
+    if mapping is not None:
+      if size < 0:
+        size = len(mapping) - mapping.tell()
+      return mapping.read(size)
+    return self.file_handle.read(size)
+
+  def tell(self):
+    if self._mapping is not None:
+      return self._mapping.tell()
+    if self._file_handle is None and self._path is not None:
+      return self._position
+    return self._file_handle.tell()
+
+  def seek(self, offset, whence=0):
+    if self._mapping is not None:
+      self._mapping.seek(offset, whence)
+    elif self._file_handle is None and self._path is not None:
+      if whence == 1:
+        offset += self._position
+      elif whence == 2:
+        offset += self.content_length
+      self._position = offset
+    else:
+      self._file_handle.seek(offset, whence)
+
+  def getView(self, offset=0, length=None):
+    """Returns length bytes of a mapped file from offset on, without copying
+    them, or None if the file isn't mapped.
+
+    The result is a memoryview (a read-only buffer on Python 2) which can be
+    passed to socket.sendall, hashlib objects or file.write.
+    """
+    if self.mapping is None:
+      return None
+    if length is None:
+      length = len(self.mapping) - offset
+    return _MappedView(self.mapping, offset, length)
+
+  def iterViews(self, size=None):
+    """Yields the rest of a mapped file as views of at most size bytes.
+
+    The position of the MediaSource moves on with every view.
+    """
+    size = size or self.chunk_size
+    end = len(self.mapping)
+    offset = self.mapping.tell()
+    while offset < end:
+      length = min(size, end - offset)
+      view = _MappedView(self.mapping, offset, length)
+      offset += length
+      self.mapping.seek(offset)
+      yield view
+
+  def getDigest(self, algorithm='md5'):
+    """Returns the hex digest of the whole file, leaving the position as it
+    was. A mapped file is hashed from views of the mapping.
+
+    Args:
+      algorithm: string Name of a hashlib algorithm.
+    """
+    digest = hashlib.new(algorithm)
+    closed = self._file_handle is None
+    position = self.tell()
+    self.seek(0)
+    try:
+      if self.mapping is not None:
+        for view in self.iterViews():
+          digest.update(view)
+      else:
+        for data in _IterDataParts([self.file_handle], self.chunk_size):
+          digest.update(data)
+    finally:
+      self.seek(position)
+      if closed:
+        self.close()
+    return digest.hexdigest()
+
   def writeFile(self, file_path):
     # can not write if no path and handle
     if not file_path or not self.file_handle:
         return False
     self.file_path = file_path
     fd = open(file_path, 'wb')
-    fd.write(self.file_handle.read())  
-    fd.close()
+    try:
+      while True:
+        data = self.file_handle.read(self.chunk_size)
+        if not data:
+          break
+        fd.write(data)
+    finally:
+      fd.close()
     return True
 
@@ -0,0 +1,1040 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 rambla.eu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Non-blocking request handler for RawsService, built on asyncore.
+
+  HttpRequest: Drop-in replacement for raws_json.HttpRequest which returns a
+       Future instead of blocking until the response has arrived. Services
+       using this module as their handler (see AsyncRawsService) return
+       Futures from all their CRUD operations.
+
+  EventLoop: Drives all requests of a thread on a single poll() loop and
+       keeps their keep-alive connections for reuse.
+
+Example:
+  loop = EventLoop()
+  rass = AsyncRassService(username, password, server, loop = loop)
+  futures = [rass.itemExists(path) for path in paths]
+  exists = loop.run_until_complete(gather(futures))
+"""
+
+import asyncore
+import base64
+import collections
+import errno
+import socket
+import ssl
+import sys
+import threading
+import time
+import zlib
+
+import raws_json
+
+_CHUNK_SIZE = 65536
+_AGAIN = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class Future(object):
+  """The result of a request which may not have completed yet."""
+
+  def __init__(self):
+    self._done = False
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+  def done(self):
+    return self._done
+
+  def result(self):
+    """Returns the result, or raises the exception the request failed with.
+    """
+    if not self._done:
+      raise RuntimeError('Future has not completed yet')
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def exception(self):
+    """Returns the exception the request failed with, or None."""
+    if self._exc_info is not None:
+      return self._exc_info[1]
+    return None
+
+  def set_result(self, result):
+    self._result = result
+    self._Finish()
+
+  def set_exception(self, exc_info):
+    """Fails the future, exc_info is a tuple as returned by sys.exc_info()."""
+    self._exc_info = exc_info
+    self._Finish()
+
+  def add_done_callback(self, callback):
+    """Calls callback(future) once the future completes."""
+    if self._done:
+      callback(self)
+    else:
+      self._callbacks.append(callback)
+
+  def then(self, callback, errback=None):
+    """Chains a function onto the result of this future.
+
+    Args:
+      callback: func Called with the result, its return value becomes the
+          result of the returned future. If it returns a Future, the
+          returned future completes like that one.
+      errback: func (optional) Called with the exception if this future
+          failed. It can return a replacement result or raise.
+
+    Returns:
+      A new Future.
+    """
+    chained = Future()
+    def _Chain(future):
+      try:
+        if future._exc_info is None:
+          result = callback(future._result)
+        elif errback is not None:
+          result = errback(future._exc_info[1])
+        else:
+          chained.set_exception(future._exc_info)
+          return
+      except Exception:
+        chained.set_exception(sys.exc_info())
+        return
+      if isinstance(result, Future):
+        result.add_done_callback(lambda inner: _Pass(inner, chained))
+      else:
+        chained.set_result(result)
+    self.add_done_callback(_Chain)
+    return chained
+
+  def _Finish(self):
+    self._done = True
+    callbacks = self._callbacks
+    self._callbacks = []
+    for callback in callbacks:
+      callback(self)
+
+
+def _Pass(future, target):
+  """Completes target like future."""
+  if future._exc_info is not None:
+    target.set_exception(future._exc_info)
+  else:
+    target.set_result(future._result)
+
+
+def gather(futures):
+  """Returns a Future of the list of results of futures, in the same order.
+
+  The returned future fails with the first exception of any of the futures.
+  """
+  futures = list(futures)
+  gathered = Future()
+  results = [None] * len(futures)
+  remaining = [len(futures)]
+  if not futures:
+    gathered.set_result(results)
+  def _Collect(index, future):
+    if gathered.done():
+      return
+    if future._exc_info is not None:
+      gathered.set_exception(future._exc_info)
+      return
+    results[index] = future._result
+    remaining[0] -= 1
+    if not remaining[0]:
+      gathered.set_result(results)
+  for index, future in enumerate(futures):
+    future.add_done_callback(lambda f, index=index: _Collect(index, f))
+  return gathered
+
+
+class AsyncResponse(object):
+  """The response to a request, fully received.
+
+  Mimics the parts of httplib.HTTPResponse which the services use.
+  """
+
+  def __init__(self, status, reason, headers, body, wire_bytes=None):
+    self.status = status
+    self.reason = reason
+    self.msg = headers
+    self._headers = headers
+    self._body = body
+    self.decoded_bytes = len(body)
+    if wire_bytes is None:
+      wire_bytes = len(body)
+    self.wire_bytes = wire_bytes
+
+  def read(self, amt=None):
+    if amt is None:
+      (data, self._body) = (self._body, '')
+    else:
+      (data, self._body) = (self._body[:amt], self._body[amt:])
+    return data
+
+  def getheader(self, name, default=None):
+    name = name.lower()
+    values = [value for (key, value) in self._headers if key == name]
+    if not values:
+      return default
+    return ', '.join(values)
+
+  def getheaders(self):
+    return list(self._headers)
+
+  def isclosed(self):
+    return not self._body
+
+  def close(self):
+    self._body = ''
+
+
+class _Request(object):
+  """A request waiting for or using a connection."""
+
+  def __init__(self, key, head, parts, method, future, decode_content=False,
+      stats=None, dns_cache=None, ssl_context=None,
+      progress=None, head_length=None, upload_limit=None,
+      download_limit=None, timing=None):
+    self.key = key
+    self.head = head
+    # The number of bytes of head which are headers, the rest is body.
+    self.head_length = len(head) if head_length is None else head_length
+    self.progress = progress
+    self.upload_limit = upload_limit
+    self.download_limit = download_limit
+    self.timing = timing
+    self.parts = parts
+    self.method = method
+    self.future = future
+    self.decode_content = decode_content
+    self.stats = stats
+    self.dns_cache = dns_cache
+    self.ssl_context = ssl_context or raws_json.DefaultSslContext()
+    self.positions = _DataPositions(parts)
+    # Body bytes reported to progress, taken back when the request is retried.
+    self.sent = 0
+
+
+class EventLoop(object):
+  """Runs asynchronous requests and keeps their connections alive.
+
+  Connections are keyed by (server, port, ssl, proxy) like the ConnectionPool
+  of the blocking transport. At most max_per_host connections are opened
+  to the same key, further requests wait for one of them to become free.
+  """
+
+  def __init__(self, max_per_host=64, idle_timeout=30):
+    self.max_per_host = max_per_host
+    self.idle_timeout = idle_timeout
+    self.socket_map = {}
+    self.events = 0
+    self.created = 0
+    self.reused = 0
+    self._open = {}
+    self._idle = {}
+    self._waiting = {}
+    self._busy = 0
+    self._waker = None
+
+  def run_until_complete(self, future, timeout=30.0):
+    """Runs the loop until future has completed and returns its result.
+
+    Args:
+      future: Future The request (or gather() of requests) to wait for.
+      timeout: float (optional) Maximum number of seconds to wait for
+          network activity before giving up.
+    """
+    while not future.done():
+      if not self._busy:
+        raise RuntimeError('No requests left to complete the future')
+      if not self.run_once(timeout):
+        raise socket.timeout('No network activity for %s seconds' % timeout)
+    return future.result()
+
+  def run_once(self, timeout=30.0):
+    """Handles the network events of one poll() call.
+
+    Returns:
+      False if there was no activity within timeout seconds.
+    """
+    self._CloseExpired()
+    if not self.socket_map:
+      return False
+    events = self.events
+    # Wake up when a connection paused by a BandwidthLimiter may continue.
+    now = time.time()
+    paused = [connection.PausedUntil() for connection in
+        self.socket_map.values()]
+    paused = [until for until in paused if until > now]
+    if paused:
+      timeout = min(timeout, max(0.001, min(paused) - now))
+    asyncore.poll2(timeout, self.socket_map)
+    # Functions running on threads don't make network activity.
+    threads = self._waker is not None and self._waker.running
+    return self.events != events or bool(paused) or bool(threads)
+
+  def run_in_thread(self, function, *args, **kwargs):
+    """Calls function(*args, **kwargs) on a thread of its own, for blocking
+    work like hashing a file, which would hold up the other requests of the
+    loop.
+
+    Returns:
+      A Future of the return value of function, completed by the loop.
+    """
+    if self._waker is None:
+      self._waker = _Waker(self)
+    waker = self._waker
+    future = Future()
+    self._busy += 1
+    waker.running += 1
+    def _Run():
+      try:
+        outcome = (function(*args, **kwargs), None)
+      except Exception:
+        outcome = (None, sys.exc_info())
+      waker.Wake(future, outcome)
+    thread = threading.Thread(target=_Run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+  def close(self):
+    """Closes all connections of the loop."""
+    for connection in self.socket_map.values():
+      connection.close()
+    self.socket_map.clear()
+    self._open = {}
+    self._idle = {}
+    self._waker = None
+
+  def counts(self):
+    """Returns the connection counts, like ConnectionPool.counts()."""
+    idle = sum([len(idle) for idle in self._idle.values()])
+    return {'idle': idle, 'active': sum(self._open.values()) - idle,
+        'created': self.created, 'reused': self.reused}
+
+  def _Submit(self, request):
+    self._busy += 1
+    key = request.key
+    idle = self._idle.get(key)
+    while idle:
+      connection = idle.pop()
+      if connection.connected:
+        connection.reused = True
+        self.reused += 1
+        connection.Start(request)
+        return
+    if self._open.get(key, 0) >= self.max_per_host:
+      self._waiting.setdefault(key, collections.deque()).append(request)
+      return
+    self._open[key] = self._open.get(key, 0) + 1
+    self.created += 1
+    connection = _Connection(self, key)
+    connection.Start(request)
+    connection.Open()
+
+  def _Completed(self, connection, keep_alive):
+    """Called by a connection once its request has completed."""
+    self._busy -= 1
+    key = connection.key
+    if not keep_alive:
+      connection.close()
+      return
+    waiting = self._waiting.get(key)
+    if waiting:
+      connection.reused = True
+      self.reused += 1
+      connection.Start(waiting.popleft())
+    else:
+      connection.idle_since = time.time()
+      self._idle.setdefault(key, []).append(connection)
+
+  def _Closed(self, connection):
+    """Called by a connection when its socket is closed."""
+    key = connection.key
+    self._open[key] -= 1
+    idle = self._idle.get(key)
+    if idle and connection in idle:
+      idle.remove(connection)
+    waiting = self._waiting.get(key)
+    if waiting:
+      self._busy -= 1
+      self._Submit(waiting.popleft())
+
+  def _CloseExpired(self):
+    expires = time.time() - self.idle_timeout
+    for idle in self._idle.values():
+      for connection in [c for c in idle if c.idle_since < expires]:
+        connection.close()
+
+
+class _Waker(asyncore.dispatcher):
+  """Hands the outcome of EventLoop.run_in_thread calls to the loop.
+
+  The threads queue their outcome and write a byte to a socket pair, so the
+  poll of the loop wakes up and completes the futures on the loop's thread.
+  """
+
+  def __init__(self, loop):
+    (self._reader, self._writer) = socket.socketpair()
+    self._reader.setblocking(0)
+    asyncore.dispatcher.__init__(self, self._reader, map=loop.socket_map)
+    self.loop = loop
+    self.running = 0
+    self._done = collections.deque()
+    self._lock = threading.Lock()
+
+  def Wake(self, future, outcome):
+    """Called on the thread of the function, with (result, exc_info)."""
+    with self._lock:
+      self._done.append((future, outcome))
+      try:
+        self._writer.send('x')
+      except socket.error:
+        # The loop has been closed.
+        pass
+
+  def readable(self):
+    return True
+
+  def writable(self):
+    return False
+
+  def PausedUntil(self):
+    return 0
+
+  def handle_read(self):
+    self.loop.events += 1
+    try:
+      self.recv(4096)
+    except socket.error, e:
+      if e.args[0] not in _AGAIN:
+        raise
+    while True:
+      with self._lock:
+        if not self._done:
+          return
+        (future, (result, exc_info)) = self._done.popleft()
+      self.running -= 1
+      self.loop._busy -= 1
+      if exc_info is None:
+        future.set_result(result)
+      else:
+        future.set_exception(exc_info)
+
+  def close(self):
+    asyncore.dispatcher.close(self)
+    self._writer.close()
+
+
+# Connection states.
+_CONNECTING, _TUNNEL, _HANDSHAKE, _READY = range(4)
+
+
+class _Connection(asyncore.dispatcher):
+  """A non-blocking HTTP/1.1 connection which runs one request at a time."""
+
+  def __init__(self, loop, key):
+    asyncore.dispatcher.__init__(self, map=loop.socket_map)
+    self.loop = loop
+    self.key = key
+    (self.host, self.port, self.ssl, self.proxy) = key
+    self.reused = False
+    self.idle_since = 0
+    self.request = None
+    self._state = _CONNECTING
+    self._want_write = False
+    self._out = ''
+    self._head_left = 0
+    # Times until which a BandwidthLimiter holds back writing and reading.
+    self._write_after = 0
+    self._read_after = 0
+    # Start of the connect or the TLS handshake, for the RequestTiming.
+    self._phase_started = None
+    # Addresses not tried yet while connecting.
+    self._addresses = []
+    self._parts = []
+    self._ResetResponse()
+
+  def Open(self):
+    """Starts connecting to the server, or to the proxy if there is one."""
+    if self.proxy:
+      (address_host, address_port) = self.proxy[:2]
+    else:
+      (address_host, address_port) = (self.host, self.port)
+    try:
+      started = time.time()
+      if self.request.dns_cache is not None:
+        addr_infos = self.request.dns_cache.resolve(address_host, address_port)
+      else:
+        addr_infos = socket.getaddrinfo(address_host, address_port, 0,
+            socket.SOCK_STREAM)
+      self._phase_started = time.time()
+      if self.request.timing is not None:
+        self.request.timing.dns = self._phase_started - started
+      if not addr_infos:
+        raise socket.error('getaddrinfo returns an empty list')
+      self._addresses = list(addr_infos)
+      self._Connect()
+    except socket.error:
+      self._Fail(sys.exc_info())
+
+  def Start(self, request):
+    self.request = request
+    self._ResetResponse()
+    self._parts = list(request.parts)
+    if request.timing is not None:
+      request.timing.reused = self.reused
+    if self._state == _READY:
+      self._out = request.head
+      self._head_left = request.head_length
+      if request.timing is not None:
+        request.timing.sending()
+
+  # asyncore interface
+
+  def readable(self):
+    return not self._read_after or self._read_after <= time.time()
+
+  def writable(self):
+    if self._state == _CONNECTING or self._want_write:
+      return True
+    if self._write_after and self._write_after > time.time():
+      return False
+    return bool(self._out or (self._state == _READY and self._parts))
+
+  def PausedUntil(self):
+    """Returns the time at which a paused connection continues, or 0."""
+    return max(self._write_after, self._read_after)
+
+  def handle_connect(self):
+    self.loop.events += 1
+    if self.proxy and self.ssl:
+      self._state = _TUNNEL
+      self._out = _TunnelRequest(self.host, self.port, self.proxy)
+    elif self.ssl:
+      self._StartTls()
+    else:
+      self._Ready()
+
+  def handle_write(self):
+    self.loop.events += 1
+    if self._state == _HANDSHAKE:
+      self._Handshake()
+      return
+    self._want_write = False
+    if not self._out and self._state == _READY:
+      self._out = _NextChunk(self._parts)
+    if not self._out:
+      self._Sent()
+      return
+    try:
+      sent = self.socket.send(self._out[:_CHUNK_SIZE])
+    except ssl.SSLWantWriteError:
+      self._want_write = True
+      return
+    except ssl.SSLWantReadError:
+      return
+    except socket.error, e:
+      if e.args[0] in _AGAIN:
+        return
+      raise
+    self._out = self._out[sent:]
+    if self._state != _READY:
+      return
+    body = sent - self._head_left
+    self._head_left = max(0, -body)
+    if body > 0:
+      self.request.sent += body
+      if self.request.progress is not None:
+        self.request.progress.update(body)
+      if self.request.timing is not None:
+        self.request.timing.request_bytes += body
+    if not self._out and not self._parts:
+      self._Sent()
+    self._write_after = self._Throttle(self.request.upload_limit, sent)
+
+  def handle_read(self):
+    self.loop.events += 1
+    if self._state == _HANDSHAKE:
+      self._Handshake()
+      return
+    try:
+      data = self.socket.recv(_CHUNK_SIZE)
+    except ssl.SSLWantReadError:
+      return
+    except ssl.SSLWantWriteError:
+      self._want_write = True
+      return
+    except socket.error, e:
+      if e.args[0] in _AGAIN:
+        return
+      raise
+    if not data:
+      self._Eof()
+      return
+    received = len(data)
+    limiter = self.request and self.request.download_limit
+    self._Feed(data)
+    # Decrypted data can be buffered by the SSL layer without the socket
+    # becoming readable again.
+    while self.connected and self.ssl and self._state == _READY:
+      pending = self.socket.pending()
+      if not pending:
+        break
+      data = self.socket.recv(pending)
+      received += len(data)
+      self._Feed(data)
+    self._read_after = self._Throttle(limiter, received)
+
+  def handle_close(self):
+    self.loop.events += 1
+    self._Eof()
+
+  def handle_error(self):
+    self.loop.events += 1
+    self._Fail(sys.exc_info())
+
+  def close(self):
+    if self.socket is not None and self._fileno is not None:
+      asyncore.dispatcher.close(self)
+      self.loop._Closed(self)
+
+  def _Sent(self):
+    """Called when the whole request has been sent."""
+    self._request_sent = True
+    if self.request is not None and self.request.timing is not None:
+      self.request.timing.waiting()
+
+  def _TimePhase(self, name):
+    """Records the time since the last phase of the connection setup."""
+    now = time.time()
+    if self.request is not None and self.request.timing is not None and \
+        self._phase_started is not None:
+      setattr(self.request.timing, name, now - self._phase_started)
+    self._phase_started = now
+
+  def _Throttle(self, limiter, length):
+    """Returns the time until which the connection waits for limiter."""
+    if limiter is None:
+      return 0
+    delay = limiter.reserve(length, self.host)
+    if delay <= 0:
+      return 0
+    return time.time() + delay
+
+  # Connection setup
+
+  def _Connect(self):
+    """Starts connecting to the next address of the server. The addresses
+    which are left are tried when it fails, like socket.create_connection
+    does."""
+    while True:
+      (family, socktype, proto, canonname, address) = self._addresses.pop(0)
+      try:
+        self.create_socket(family, socktype)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect(address)
+        return
+      except socket.error:
+        if self.socket is not None:
+          asyncore.dispatcher.close(self)
+        if not self._addresses:
+          raise
+
+  def _StartTls(self):
+    self._TimePhase('connect')
+    self._state = _HANDSHAKE
+    self.del_channel()
+    self.socket = self.request.ssl_context.wrap_socket(self.socket,
+        server_hostname=self.host, do_handshake_on_connect=False)
+    self.set_socket(self.socket, self.loop.socket_map)
+    self._Handshake()
+
+  def _Handshake(self):
+    self._want_write = False
+    try:
+      self.socket.do_handshake()
+    except ssl.SSLWantReadError:
+      return
+    except ssl.SSLWantWriteError:
+      self._want_write = True
+      return
+    self._TimePhase('tls')
+    self._Ready()
+
+  def _Ready(self):
+    if not self.ssl:
+      self._TimePhase('connect')
+    self._phase_started = None
+    self._state = _READY
+    if self.request is not None:
+      self._out = self.request.head
+      self._head_left = self.request.head_length
+      if self.request.timing is not None:
+        self.request.timing.sending()
+
+  # Response parsing
+
+  def _ResetResponse(self):
+    self._in = ''
+    self._status = None
+    self._headers = None
+    self._body = []
+    self._length = None
+    self._chunked = False
+    self._chunk_left = None
+    self._will_close = False
+    self._received = False
+    self._request_sent = False
+
+  def _Feed(self, data):
+    if self._state == _TUNNEL:
+      self._in += data
+      if self._in.find('\r\n\r\n') == -1:
+        return
+      (status_line, rest) = self._in.split('\r\n', 1)
+      self._in = ''
+      if status_line.split(None, 2)[1:2] != ['200']:
+        raise socket.error('Tunnel connection failed: %s' % status_line)
+      self._StartTls()
+      return
+    if self.request is None:
+      # Nothing is expected on an idle connection.
+      self.close()
+      return
+    if not self._received and self.request.timing is not None:
+      self.request.timing.receiving()
+    self._received = True
+    self._in += data
+    self._Parse()
+
+  def _Parse(self):
+    while self._headers is None:
+      end = self._in.find('\r\n\r\n')
+      if end == -1:
+        return
+      head = self._in[:end].split('\r\n')
+      self._in = self._in[end + 4:]
+      (version, status, reason) = (head[0].split(None, 2) + [''])[:3]
+      status = int(status)
+      if 100 <= status < 200:
+        continue
+      headers = []
+      for line in head[1:]:
+        (name, value) = line.split(':', 1)
+        headers.append((name.strip().lower(), value.strip()))
+      self._status = (status, reason)
+      self._headers = headers
+      connection = ','.join(v for (k, v) in headers if k == 'connection')
+      self._will_close = ('close' in connection.lower() or
+          (version == 'HTTP/1.0' and 'keep-alive' not in connection.lower()))
+      encoding = ','.join(
+          v for (k, v) in headers if k == 'transfer-encoding')
+      lengths = [v for (k, v) in headers if k == 'content-length']
+      if (self.request.method == 'HEAD' or status in (204, 304)):
+        self._length = 0
+      elif 'chunked' in encoding.lower():
+        self._chunked = True
+      elif lengths:
+        self._length = int(lengths[0])
+      else:
+        self._will_close = True
+
+    if self._chunked:
+      self._ParseChunked()
+    elif self._length is not None:
+      take = self._in[:self._length]
+      self._in = self._in[self._length:]
+      self._body.append(take)
+      self._length -= len(take)
+      if not self._length:
+        self._Complete()
+    else:
+      self._body.append(self._in)
+      self._in = ''
+
+  def _ParseChunked(self):
+    while True:
+      if self._chunk_left is None:
+        end = self._in.find('\r\n')
+        if end == -1:
+          return
+        size = self._in[:end].split(';', 1)[0].strip()
+        self._in = self._in[end + 2:]
+        self._chunk_left = int(size, 16)
+        if not self._chunk_left:
+          self._chunk_left = -1
+      if self._chunk_left == -1:
+        # Last chunk, skip the trailer up to the empty line.
+        while True:
+          end = self._in.find('\r\n')
+          if end == -1:
+            return
+          line = self._in[:end]
+          self._in = self._in[end + 2:]
+          if not line:
+            self._Complete()
+            return
+      if len(self._in) < self._chunk_left + 2:
+        return
+      self._body.append(self._in[:self._chunk_left])
+      self._in = self._in[self._chunk_left + 2:]
+      self._chunk_left = None
+
+  def _Complete(self):
+    (request, self.request) = (self.request, None)
+    (status, reason) = self._status
+    headers = self._headers
+    body = ''.join(self._body)
+    wire_bytes = len(body)
+    encoding = ','.join(v for (k, v) in headers
+        if k == 'content-encoding').strip().lower()
+    keep_alive = not self._will_close and not self._in
+    self._ResetResponse()
+    self.loop._Completed(self, keep_alive)
+    if request.decode_content and encoding in raws_json.DECODED_ENCODINGS:
+      try:
+        body = zlib.decompress(body, 32 + zlib.MAX_WBITS)
+      except zlib.error, e:
+        # The response was complete, only its body can't be decoded.
+        if request.timing is not None:
+          request.timing.finish(status, wire_bytes, e)
+        request.future.set_exception(sys.exc_info())
+        return
+    if request.stats is not None and body:
+      request.stats.add('response_bytes_wire', wire_bytes)
+      request.stats.add('response_bytes_decoded', len(body))
+    if request.progress is not None:
+      request.progress.finish()
+    response = AsyncResponse(status, reason, headers, body, wire_bytes)
+    if request.timing is not None:
+      request.timing.finish(status, wire_bytes)
+    request.future.set_result(response)
+
+  def _Eof(self):
+    if self.request is not None and self._headers is not None and \
+        self._length is None and not self._chunked:
+      # The body of this response is delimited by the end of the connection.
+      self._Complete()
+      return
+    if self.request is not None:
+      try:
+        raise socket.error(errno.ECONNRESET,
+            'Connection closed before the response was complete')
+      except socket.error:
+        self._Fail(sys.exc_info())
+      return
+    self.close()
+
+  def _Fail(self, exc_info):
+    if self._state == _CONNECTING and self._addresses and \
+        self.request is not None:
+      if self.socket is not None:
+        asyncore.dispatcher.close(self)
+      try:
+        self._Connect()
+        return
+      except socket.error:
+        exc_info = sys.exc_info()
+    (request, self.request) = (self.request, None)
+    # Once it has been sent the server may have acted on a request, see
+    # raws_json._ClosedWhileIdle.
+    retry = (request is not None and self.reused and not self._received and
+        request.positions is not None and (not self._request_sent or
+        request.method in raws_json.IDEMPOTENT_METHODS))
+    # The rest of this poll's events may still reach this connection, it
+    # mustn't read on from the parts of the request it gave up.
+    self._parts = []
+    self._out = ''
+    self._ResetResponse()
+    if self.socket is not None:
+      asyncore.dispatcher.close(self)
+    if request is None:
+      self.loop._Closed(self)
+      return
+    self.loop._busy -= 1
+    self.loop._Closed(self)
+    if retry:
+      # The server closed the idle keep-alive connection, send the request
+      # again on a new one.
+      for (data_part, position) in request.positions:
+        data_part.seek(position)
+      if request.progress is not None:
+        request.progress.rewind(request.sent)
+      request.sent = 0
+      self.loop._Submit(request)
+    else:
+      if request.timing is not None:
+        request.timing.finish(error=exc_info[1])
+      request.future.set_exception(exc_info)
+
+
+def _NextChunk(parts):
+  """Returns the next piece of request body to send from parts."""
+  while parts:
+    part = parts[0]
+    if isinstance(part, raws_json.MediaSource) and \
+        not hasattr(part.file_handle, 'read'):
+      # A MediaSource of a generator.
+      part = parts[0] = part.file_handle
+    if getattr(part, 'mapping', None) is not None:
+      # A mapped file is sent from slices of the mapping.
+      for data in part.iterViews(_CHUNK_SIZE):
+        return data
+    elif hasattr(part, 'read'):
+      data = part.read(_CHUNK_SIZE)
+      if data:
+        return data
+    elif hasattr(part, '__iter__'):
+      # A generator, like the chunked encoding of the body.
+      if not hasattr(part, 'next'):
+        part = parts[0] = iter(part)
+      for data in part:
+        if data:
+          return str(data)
+    else:
+      parts.pop(0)
+      if part:
+        return str(part)
+      continue
+    parts.pop(0)
+  return ''
+
+
+def _DataPositions(parts):
+  positions = []
+  for data_part in parts:
+    if hasattr(data_part, 'read'):
+      try:
+        positions.append((data_part, data_part.tell()))
+      except (AttributeError, IOError, OSError):
+        return None
+    elif hasattr(data_part, '__iter__'):
+      return None
+  return positions
+
+
+def _TunnelRequest(host, port, proxy):
+  (p_server, p_port, proxy_username, proxy_password, user_agent) = proxy
+  lines = ['CONNECT %s:%s HTTP/1.0' % (host, port)]
+  if proxy_username:
+    user_auth = base64.encodestring('%s:%s' % (proxy_username,
+                                               proxy_password))
+    lines.append('Proxy-authorization: Basic %s' % user_auth.strip())
+  lines.append('User-Agent: %s' % user_agent)
+  return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+_local = threading.local()
+
+def get_event_loop():
+  """Returns the EventLoop of the current thread, creating it if needed."""
+  loop = getattr(_local, 'loop', None)
+  if loop is None:
+    loop = _local.loop = EventLoop()
+  return loop
+
+
+def HttpRequest(service, operation, data, uri, extra_headers=None,
+      url_params=None, escape_params=True, content_type='application/atom+xml',
+      progress=None):
+    """Starts an HTTP call to the server, supports GET, POST, PUT, and DELETE.
+
+    Takes the same arguments as raws_json.HttpRequest. The request is run on
+    service.loop (or the current thread's loop if the service has none).
+
+    Returns:
+      A Future which completes with an AsyncResponse once the whole response
+      has been received.
+    """
+    full_uri = raws_json.BuildUri(uri, url_params, escape_params)
+    extra_headers = raws_json._PrepareHeaders(service, data, extra_headers,
+        content_type)
+    (server, port, ssl, partial_uri) = raws_json.ProcessUrl(service, full_uri)
+
+    proxy = raws_json._ProxyFromEnvironment(service, ssl)
+    if proxy and not ssl:
+      # Plain http goes through the proxy with absolute URIs.
+      (p_server, p_port, proxy_username, proxy_password) = proxy
+      key = (p_server, p_port, False, None)
+      request_uri = 'http://%s:%s%s' % (server, port, partial_uri)
+    else:
+      if proxy:
+        proxy = proxy + (service.additional_headers.get('User-Agent'),)
+      key = (server, port, ssl, proxy)
+      request_uri = partial_uri
+
+    (service_lines, service_names) = raws_json._HeaderBlock(service)
+    headers = dict(extra_headers)
+    decode_content = raws_json._AcceptsCompressed(service, extra_headers)
+    if decode_content:
+      headers['Accept-Encoding'] = raws_json.ACCEPT_ENCODING
+    if 'Host' not in headers and 'host' not in service_names:
+      if port in (80, 443):
+        headers['Host'] = server
+      else:
+        headers['Host'] = '%s:%s' % (server, port)
+    lines = ['%s %s HTTP/1.1' % (operation, request_uri)]
+    if any([header.lower() in service_names for header in headers]):
+      # Headers of the call replace those of the service.
+      names = set([header.lower() for header in headers])
+      lines.extend([line for line in service_lines
+          if line.split(':', 1)[0].lower() not in names])
+    else:
+      lines.extend(service_lines)
+    for header in headers:
+      lines.append('%s: %s' % (header, headers[header]))
+    head = '\r\n'.join(lines) + '\r\n\r\n'
+    head_length = len(head)
+
+    if data is None:
+      parts = []
+    elif isinstance(data, list):
+      parts = list(data)
+    else:
+      parts = [data]
+    if raws_json._IsChunked(extra_headers):
+      parts = [raws_json._EncodeChunked(raws_json._IterDataParts(parts))]
+    # The strings at the start of the body are sent along with the headers.
+    while parts and isinstance(parts[0], str):
+      head += parts.pop(0)
+
+    if service.stats is not None:
+      service.stats.add('requests')
+    if data:
+      progress = raws_json._UploadProgress(service, progress, extra_headers)
+    else:
+      progress = None
+    timing = raws_json._StartTiming(service, operation, full_uri)
+    future = Future()
+    loop = getattr(service, 'loop', None) or get_event_loop()
+    loop._Submit(_Request(key, head, parts, operation, future,
+        decode_content=decode_content, stats=service.stats,
+        dns_cache=getattr(service, 'dns_cache', None),
+        ssl_context=getattr(service, 'ssl_context', None),
+        progress=progress, head_length=head_length,
+        upload_limit=getattr(service, 'upload_limit', None),
+        download_limit=getattr(service, 'download_limit', None),
+        timing=timing))
+    return future
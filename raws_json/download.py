@@ -0,0 +1,355 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 rambla.eu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Downloads of large files to disk, with HTTP Range requests.
+
+  RangedDownload: Streams a file to disk in fixed-size chunks. An
+       interrupted download continues from the bytes already on disk, and a
+       file can be fetched as several ranges over parallel connections,
+       optionally written through a memory-mapped output file.
+"""
+
+import httplib
+import mmap
+import os
+import re
+import socket
+import time
+from multiprocessing.pool import ThreadPool
+
+import raws_json
+from raws_json.upload import RETRY_STATUSES
+
+CONTENT_RANGE_REGEX = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+UNSATISFIED_RANGE_REGEX = re.compile(r'bytes \*/(\d+)')
+
+
+class DownloadError(Exception):
+  """Raised when the server refuses a download."""
+  pass
+
+
+class RangedDownload(object):
+  """Downloads the body of a GET request to a local file.
+
+  The size of the file and whether the server accepts byte ranges are found
+  with a HEAD request first. Downloads are always requested without
+  content-coding, so ranges refer to the bytes of the file itself.
+
+  With a single stream the body is written chunk_size bytes at a time. When
+  the connection fails, or when resume is set and part of the file is on
+  disk already, the download continues with a 'Range: bytes=offset-'
+  request. With more streams, or with use_mmap, the output file is
+  preallocated at its full size and every stream fetches its own range of
+  it; this needs a server which accepts ranges and reports the size,
+  otherwise a single stream is used.
+
+  Range requests carry an If-Range header with the ETag (or else the
+  Last-Modified date) of the HEAD response, so a file which changed on the
+  server since is sent whole instead of being spliced onto older bytes. A
+  local file longer than the remote one is downloaded again from the start.
+  Only resume a file_path which holds the beginning of the same remote file:
+  a shorter unrelated file can't be told apart from it.
+
+  Failed requests are retried up to max_retries times, waiting backoff, 2 *
+  backoff, ... seconds (at most max_backoff) in between.
+  """
+
+  def __init__(self, service, uri, file_path,
+      chunk_size=raws_json.READ_CHUNK_SIZE, streams=1, resume=False,
+      use_mmap=False, max_retries=5, backoff=1.0, max_backoff=60.0,
+      extra_headers=None, progress=None, error_handler=None):
+    """Creates a new RangedDownload.
+
+    Args:
+      service: raws_json.raws_service.RawsService through whose handler the
+               requests are made. The handler must block, so the service
+               can't be an AsyncRawsService.
+      uri: string The uri of the file.
+      file_path: string Path of the local file to write.
+      chunk_size: int (optional) Number of bytes held in memory per stream.
+      streams: int (optional) Number of ranges fetched at the same time.
+      resume: bool (optional) Continue from the bytes already in file_path
+              instead of overwriting it (single stream only). The file must
+              be the start of the same remote file.
+      use_mmap: bool (optional) Write through a memory map of the
+                preallocated output file.
+      max_retries: int (optional) Number of times a request is retried.
+      backoff: float (optional) Seconds waited before the first retry.
+      max_backoff: float (optional) Maximum number of seconds between two
+                   retries.
+      extra_headers: dict (optional) Headers added to every request.
+      progress: raws_json.TransferProgress or function (optional) Updated
+                after every chunk, see raws_json.MakeProgress. Bytes on disk
+                from an earlier run are skipped. With several streams it is
+                updated from their threads.
+      error_handler: function (optional) Called with a response which has an
+                     unexpected status, it should raise an exception.
+    """
+    self.service = service
+    self.uri = uri
+    self.file_path = file_path
+    self.chunk_size = chunk_size
+    self.streams = streams
+    self.resume = resume
+    self.use_mmap = use_mmap
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.extra_headers = extra_headers or {}
+    self.progress = raws_json.MakeProgress(progress, 'download',
+        getattr(service, 'stats', None))
+    self.error_handler = error_handler
+    # The ETag or Last-Modified date of the file, sent with If-Range.
+    self.validator = None
+    self._failed = False
+
+  def run(self):
+    """Downloads the file.
+
+    Returns:
+      The size of the downloaded file.
+    """
+    (size, accepts_ranges) = self._Probe()
+    self.progress.total = size
+    self.progress.start()
+    if (self.streams > 1 or self.use_mmap) and accepts_ranges and size:
+      size = self._RunParallel(size)
+    else:
+      size = self._RunSingle(size)
+    self.progress.finish()
+    return size
+
+  def _Probe(self):
+    response = self._Retry(lambda: self._Get('HEAD'))
+    response.read()
+    if response.status != 200:
+      # Not every server answers HEAD, the GET will tell.
+      return (None, False)
+    self.validator = _Validator(response)
+    length = response.getheader('Content-Length')
+    accepts_ranges = response.getheader('Accept-Ranges', '').lower() == 'bytes'
+    if length is None or not length.isdigit():
+      return (None, accepts_ranges)
+    return (int(length), accepts_ranges)
+
+  def _RunSingle(self, size):
+    if self.resume and os.path.exists(self.file_path):
+      fd = open(self.file_path, 'r+b')
+      fd.seek(0, 2)
+      if size is not None and fd.tell() > size:
+        # Not the start of this file, start over.
+        fd.seek(0)
+        fd.truncate()
+    else:
+      fd = open(self.file_path, 'w+b')
+    try:
+      failures = 0
+      while True:
+        offset = fd.tell()
+        if offset > self.progress.bytes:
+          # Left by an earlier run.
+          self.progress.skip(offset - self.progress.bytes)
+        if size is not None and offset == size:
+          return offset
+        try:
+          if offset:
+            response = self._Get('GET', offset)
+          else:
+            response = self._Get('GET')
+          if response.status == 200 and offset:
+            # The server doesn't do ranges, or the file changed since the
+            # HEAD request (If-Range), the whole file comes again.
+            fd.seek(0)
+            fd.truncate()
+            self.progress.skip(-self.progress.skipped)
+          elif response.status == 206:
+            if _RangeStart(response) != offset:
+              response.close()
+              raise DownloadError({'status': response.status,
+                  'reason': 'Unexpected Content-Range %s' %
+                      response.getheader('Content-Range'), 'body': ''})
+          elif response.status == 416 and offset:
+            response.read()
+            if _UnsatisfiedRangeSize(response) == offset:
+              # Nothing past offset, the file was complete already.
+              return offset
+            # The file on disk is longer than the remote one, or the server
+            # doesn't say, start over.
+            fd.seek(0)
+            fd.truncate()
+            self.progress.skip(-self.progress.skipped)
+            size = _UnsatisfiedRangeSize(response)
+            continue
+          elif response.status in RETRY_STATUSES and \
+              failures < self.max_retries:
+            response.read()
+            failures += 1
+            self._Wait(failures)
+            continue
+          elif response.status != 200:
+            self._Reject(response)
+          for data in raws_json.IterResponse(response, self.chunk_size):
+            fd.write(data)
+            self.progress.update(len(data))
+          fd.flush()
+          if size is not None and fd.tell() < size:
+            # The connection ended early, continue where it stopped.
+            raise httplib.IncompleteRead('', size - fd.tell())
+          return fd.tell()
+        except (socket.error, httplib.HTTPException):
+          failures += 1
+          if failures > self.max_retries:
+            raise
+          self._Wait(failures)
+    finally:
+      fd.close()
+
+  def _RunParallel(self, size):
+    if os.path.exists(self.file_path):
+      fd = open(self.file_path, 'r+b')
+    else:
+      fd = open(self.file_path, 'w+b')
+    memory_map = None
+    try:
+      fd.truncate(size)
+      if self.use_mmap:
+        memory_map = mmap.mmap(fd.fileno(), size)
+      streams = max(1, min(self.streams, size // self.chunk_size or 1))
+      ranges = [(i * size // streams, (i + 1) * size // streams, memory_map)
+          for i in xrange(streams)]
+      pool = ThreadPool(streams)
+      try:
+        pool.map(self._FetchRange, ranges)
+      finally:
+        pool.close()
+        pool.join()
+      if memory_map is not None:
+        memory_map.flush()
+      return size
+    finally:
+      if memory_map is not None:
+        memory_map.close()
+      fd.close()
+
+  def _FetchRange(self, fetch_range):
+    (first, end, memory_map) = fetch_range
+    fd = None
+    if memory_map is None:
+      fd = open(self.file_path, 'r+b')
+    try:
+      offset = first
+      failures = 0
+      while offset < end and not self._failed:
+        try:
+          response = self._Get('GET', offset, end - 1)
+          if response.status != 206 or _RangeStart(response) != offset:
+            if response.status in RETRY_STATUSES and \
+                failures < self.max_retries:
+              response.read()
+              failures += 1
+              self._Wait(failures)
+              continue
+            self._failed = True
+            if response.status == 200:
+              # If-Range didn't match, the other ranges are of another file.
+              response.close()
+              raise DownloadError({'status': response.status,
+                  'reason': 'The file changed during the download',
+                  'body': ''})
+            self._Reject(response)
+          if fd is not None:
+            fd.seek(offset)
+          for data in raws_json.IterResponse(response, self.chunk_size):
+            if memory_map is not None:
+              memory_map[offset:offset + len(data)] = data
+            else:
+              fd.write(data)
+            offset += len(data)
+            self.progress.update(len(data))
+          if offset < end:
+            raise httplib.IncompleteRead('', end - offset)
+        except (socket.error, httplib.HTTPException):
+          failures += 1
+          if failures > self.max_retries or self._failed:
+            self._failed = True
+            raise
+          self._Wait(failures)
+    finally:
+      if fd is not None:
+        fd.close()
+
+  def _Get(self, operation, first=None, last=None):
+    headers = dict(self.extra_headers)
+    # Ranges are about the stored bytes, so no compressed responses.
+    headers['Accept-Encoding'] = 'identity'
+    if first is not None:
+      if last is None:
+        headers['Range'] = 'bytes=%d-' % first
+      else:
+        headers['Range'] = 'bytes=%d-%d' % (first, last)
+      if self.validator is not None:
+        headers['If-Range'] = self.validator
+    return self.service.handler.HttpRequest(self.service, operation, None,
+        self.uri, extra_headers=headers)
+
+  def _Retry(self, request):
+    failures = 0
+    while True:
+      try:
+        return request()
+      except (socket.error, httplib.HTTPException):
+        failures += 1
+        if failures > self.max_retries:
+          raise
+        self._Wait(failures)
+
+  def _Reject(self, response):
+    if self.error_handler is not None:
+      self.error_handler(response)
+    raise DownloadError({'status': response.status,
+        'reason': response.reason, 'body': response.read()})
+
+  def _Wait(self, failures):
+    time.sleep(min(self.backoff * 2 ** (failures - 1), self.max_backoff))
+
+
+def _Validator(response):
+  """Returns the If-Range value for the file of a HEAD response: its strong
+  ETag, or else its Last-Modified date, None if it has neither."""
+  etag = response.getheader('ETag')
+  if etag and not etag.startswith('W/'):
+    return etag
+  return response.getheader('Last-Modified')
+
+
+def _UnsatisfiedRangeSize(response):
+  """Returns the size of the file given with a 416 response, None if it
+  isn't given."""
+  match = UNSATISFIED_RANGE_REGEX.match(
+      response.getheader('Content-Range') or '')
+  if match is None:
+    return None
+  return int(match.group(1))
+
+
+def _RangeStart(response):
+  """Returns the first byte of a 206 response, None if it isn't given."""
+  match = CONTENT_RANGE_REGEX.match(response.getheader('Content-Range') or '')
+  if match is None:
+    return None
+  return int(match.group(1))
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 rambla.eu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental parser for RAWS json feeds.
+
+  A RAWS feed looks like {"feed": {..., "entry": [{...}, {...}, ...]}}. The
+  FeedEntryParser decodes each element of the entry list as soon as its last
+  byte has been received, so a feed can be processed while it is still being
+  downloaded and without ever holding the whole document in memory.
+
+  IterFeedEntries: Generator which turns an iterable of body chunks (eg. the
+       result of RawsService.GetStream) into decoded entries.
+"""
+
+import json
+import re
+
+# Characters which change the structure of the document, and the ones which
+# end or escape inside a string.
+_STRUCTURE = re.compile(r'["{}\[\]:]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+# Start of the next element of a list.
+_ELEMENT = re.compile(r'[^\s,]')
+# Characters which can follow a number, true, false or null in a list. The
+# decoder stops at anything else as well, eg. at the '.' of '-2500.' when
+# the rest of the number is still to come.
+_SCALAR_END = frozenset(',] \t\r\n')
+
+
+class FeedEntryParser(object):
+  """Decodes the entries of a json feed from data received piecemeal.
+
+  Only the entry list inside the top-level feed object is decoded, the other
+  members of the feed are skipped. Memory use is bounded by the size of the
+  largest entry rather than by the size of the feed.
+  """
+
+  def __init__(self):
+    self._decoder = json.JSONDecoder()
+    self._buffer = ''
+    self._pending = []
+    self._pending_size = 0
+    self._pos = 0
+    # [type, key] of every open object or list, key being the member of an
+    # object whose value is currently parsed.
+    self._stack = []
+    self._key = None
+    self._entries_depth = None
+    # Don't try to decode an incomplete entry again before this many bytes
+    # are buffered, so big entries aren't decoded over and over.
+    self._retry_size = 0
+
+  def feed(self, data):
+    """Adds the next piece of the document.
+
+    Returns:
+      A list with the entries which were completed by data.
+    """
+    self._pending.append(data)
+    self._pending_size += len(data)
+    if self._pending_size < self._retry_size:
+      return []
+    self._buffer = ''.join([self._buffer] + self._pending)
+    self._pending = []
+    self._pending_size = len(self._buffer)
+    entries = []
+    self._Scan(entries)
+    # Drop everything which has been scanned.
+    self._buffer = self._buffer[self._pos:]
+    self._pending_size = len(self._buffer)
+    self._pos = 0
+    return entries
+
+  def close(self):
+    """Signals the end of the document.
+
+    Returns:
+      A list with the entries which were still waiting to be decoded.
+    """
+    self._retry_size = 0
+    entries = self.feed('')
+    if self._entries_depth is not None and self._buffer.strip():
+      raise ValueError('Feed ended inside an entry')
+    return entries
+
+  def _Scan(self, entries):
+    buf = self._buffer
+    pos = self._pos
+    while True:
+      if self._entries_depth is not None and \
+          len(self._stack) == self._entries_depth:
+        # Inside the entry list the json decoder finds the end of each entry.
+        m = _ELEMENT.search(buf, pos)
+        if m is None:
+          pos = len(buf)
+          break
+        index = m.start()
+        if buf[index] == ']':
+          self._stack.pop()
+          self._entries_depth = None
+          pos = index + 1
+          continue
+        try:
+          (entry, end) = self._decoder.raw_decode(buf, index)
+        except ValueError:
+          end = None
+        if end is None or (not isinstance(entry, (dict, list, basestring))
+            and (end == len(buf) or buf[end] not in _SCALAR_END)):
+          # Incomplete, a number may still go on in the next piece.
+          self._retry_size = 2 * (len(buf) - index)
+          pos = index
+          break
+        self._retry_size = 0
+        entries.append(entry)
+        pos = end
+        continue
+
+      m = _STRUCTURE.search(buf, pos)
+      if m is None:
+        pos = len(buf)
+        break
+      index = m.start()
+      char = buf[index]
+      if char == '"':
+        end = _StringEnd(buf, index + 1)
+        if end is None:
+          # Wait for the rest of the string.
+          pos = index
+          break
+        if self._stack and self._stack[-1][0] == '{':
+          self._key = buf[index:end + 1]
+        pos = end + 1
+        continue
+      pos = index + 1
+      if char == ':':
+        if self._key is not None:
+          self._stack[-1][1] = json.loads(self._key)
+          self._key = None
+      elif char in '{[':
+        self._stack.append([char, None])
+        if char == '[' and self._IsEntryList():
+          self._entries_depth = len(self._stack)
+      elif self._stack:
+        self._stack.pop()
+    self._pos = pos
+
+  def _IsEntryList(self):
+    return (len(self._stack) == 3 and self._stack[0] == ['{', 'feed'] and
+        self._stack[1] == ['{', 'entry'])
+
+
+def _StringEnd(buf, pos):
+  """Returns the index of the quote closing the string which runs from pos,
+  or None if the string isn't complete yet."""
+  while True:
+    m = _STRING_SPECIAL.search(buf, pos)
+    if m is None:
+      return None
+    if m.group() == '"':
+      return m.start()
+    # Skip the escaped character.
+    pos = m.start() + 2
+    if pos > len(buf):
+      return None
+
+
+def IterFeedEntries(chunks):
+  """Yields the entries of a json feed received as an iterable of chunks.
+
+  Args:
+    chunks: iterable of strings which together form the feed document.
+  """
+  parser = FeedEntryParser()
+  for data in chunks:
+    for entry in parser.feed(data):
+      yield entry
+  for entry in parser.close():
+    yield entry
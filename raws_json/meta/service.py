@@ -16,13 +16,13 @@
 # limitations under the License.import os
 import json
 import raws_json
-from raws_json.raws_service import RawsService
+from raws_json.raws_service import RawsService, AsyncRawsService, _BodyResult
 
 class MetaService(RawsService):
 
-    def __init__(self, username=None, password=None, server=None, ssl = False):
+    def __init__(self, username=None, password=None, server=None, ssl = False, session = None):
         self.username = username
-        super(MetaService, self).__init__(username = username, password = password, server = server, ssl = ssl)
+        super(MetaService, self).__init__(username = username, password = password, server = server, ssl = ssl, session = session)
 
     def delete(self, uri):
         """ Deletes any resource, given the uri. 
@@ -77,6 +77,20 @@ class MetaService(RawsService):
             uri = query.ToUri()
         return self.Get(uri = uri)
         
+    def iterContentList(self, query = None):
+        """ Retrieves a content list, one entry at a time.
+
+            Unlike getContentList, the feed is decoded while it is received, so large lists are processed in constant memory.
+
+            @param query raws_json.Query object that contains queryset args.
+            @return iterator of {"entry": entry} dicts
+        """
+        uri = "/content/" + self.username + "/"
+        if query:
+            query.feed = uri
+            uri = query.ToUri()
+        return self.GetEntries(uri = uri)
+
     def getContentInstance(self, name, query = None):
         """ Retrieves a content entry with name passed in the argument. 
 
@@ -186,10 +200,12 @@ class MetaService(RawsService):
             uri = query.ToUri()
         return self.Get(uri = uri)
         
-    def getExtAtom(self, query = None):
+    def getExtAtom(self, query = None, stream = False, file_handle = None):
         """ Retrieves a ext list in atom. 
 
             @param query raws_json.Query object that contains queryset args.
+            @param bool stream : If True, return an iterator of body chunks instead of the whole body.
+            @param file_handle : File object (or local path) the body gets written to, instead of returning it.
             @return List of content dicts (virtual or real).
         """
         uri = "/ext/atom/" + self.username + "/"
@@ -197,19 +213,20 @@ class MetaService(RawsService):
             query.feed = uri
             uri = query.ToUri()
 
+        extra_headers = {"Accept":"application/atom"}
+        if file_handle is not None:
+            return self.Download(uri, file_handle, extra_headers = extra_headers)
+        if stream:
+            return self.GetStream(uri, extra_headers = extra_headers)
         server_response = self.handler.HttpRequest(self, 'GET', None, uri, extra_headers= {"Accept":"application/atom"})
-        result_body = server_response.read()
-
-        if server_response.status == 200:
-            return result_body
-        else:
-            raise RequestError, {'status': server_response.status,
-              'reason': server_response.reason, 'body': result_body}
+        return self._ProcessResponse(server_response, _BodyResult)
         
-    def getExtMrss(self, rtmp = False, query = None):
+    def getExtMrss(self, rtmp = False, query = None, stream = False, file_handle = None):
         """ Retrieves a ext list in json. 
 
             @param query raws_json.Query object that contains queryset args.
+            @param bool stream : If True, return an iterator of body chunks instead of the whole body.
+            @param file_handle : File object (or local path) the body gets written to, instead of returning it.
             @return List of content dicts (virtual or real).
         """
         uri = "/ext/mrss/" + self.username + "/"
@@ -219,11 +236,15 @@ class MetaService(RawsService):
             query.feed = uri
             uri = query.ToUri()
 
+        extra_headers = {"Accept":"application/xml"}
+        if file_handle is not None:
+            return self.Download(uri, file_handle, extra_headers = extra_headers)
+        if stream:
+            return self.GetStream(uri, extra_headers = extra_headers)
         server_response = self.handler.HttpRequest(self, 'GET', None, uri, extra_headers= {"Accept":"application/xml"})
-        result_body = server_response.read()
+        return self._ProcessResponse(server_response, _BodyResult)
+
 
-        if server_response.status == 200:
-            return result_body
-        else:
-            raise RequestError, {'status': server_response.status,
-              'reason': server_response.reason, 'body': result_body}
+class AsyncMetaService(AsyncRawsService, MetaService):
+    """ MetaService whose methods return a raws_json.async_request.Future of their result. """
+    pass
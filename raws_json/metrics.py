@@ -0,0 +1,246 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 rambla.eu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request metrics of RAWS services, in the Prometheus text format.
+
+  MetricsRegistry: Request observer (see raws_json.RequestTiming) which
+       counts the requests and their bytes and keeps latency histograms per
+       service, verb, URI template and status, next to the connection
+       counts of the pools it watches.
+
+  Instrument: Makes a registry observe a service or a Session.
+
+  Render: Returns the metrics of a registry in the Prometheus text
+       exposition format, eg. for a /metrics endpoint.
+
+Example:
+  session = Session(username, password)
+  metrics.Instrument(session)
+  rass = RassService(server = server, session = session)
+  ...
+  body = metrics.Render()
+"""
+
+import bisect
+import threading
+
+# Upper bounds, in seconds, of the buckets of the latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0, 300.0)
+
+# Phases of a RequestTiming whose seconds are added up per request kind.
+PHASES = ('dns', 'connect', 'tls', 'send', 'ttfb', 'body')
+
+# Content-Type of the text returned by Render.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsRegistry(object):
+  """Aggregates the RequestTimings of the services observed by it.
+
+  The requests are counted per (service, verb, uri, status), service being
+  'rass', 'meta', 'rats', ... and status 'error' for requests which failed
+  without a response. Pools are ConnectionPools or async EventLoops, whose
+  idle and active connections are reported as gauges and whose created and
+  reused connections as counters. The registry can be shared between
+  threads.
+  """
+
+  def __init__(self, buckets=LATENCY_BUCKETS, namespace='raws'):
+    """Creates a new MetricsRegistry.
+
+    Args:
+      buckets: tuple (optional) Upper bounds of the latency buckets, in
+               seconds.
+      namespace: string (optional) Prefix of the metric names.
+    """
+    self.buckets = tuple(sorted(buckets))
+    self.namespace = namespace
+    self._requests = {}
+    self._pools = []
+    self._lock = threading.Lock()
+
+  def __call__(self, timing):
+    if timing.status is None:
+      status = 'error'
+    else:
+      status = str(timing.status)
+    labels = (_ServiceName(timing.service), timing.verb, timing.uri, status)
+    with self._lock:
+      entry = self._requests.get(labels)
+      if entry is None:
+        entry = self._requests[labels] = _RequestMetrics(len(self.buckets))
+      entry.count += 1
+      entry.seconds += timing.total
+      entry.buckets[bisect.bisect_left(self.buckets, timing.total)] += 1
+      entry.request_bytes += timing.request_bytes
+      entry.response_bytes += timing.response_bytes
+      for phase in PHASES:
+        entry.phases[phase] += getattr(timing, phase) or 0.0
+
+  def watch(self, pool, name='default'):
+    """Reports the connection counts of pool, labeled with name."""
+    with self._lock:
+      if pool not in [watched for (watched, watched_name) in self._pools]:
+        self._pools.append((pool, name))
+
+  def clear(self):
+    """Forgets the requests counted so far."""
+    with self._lock:
+      self._requests = {}
+
+  def render(self):
+    """Returns all metrics in the Prometheus text format."""
+    prefix = self.namespace and self.namespace + '_' or ''
+    with self._lock:
+      requests = sorted(self._requests.items())
+      pools = list(self._pools)
+    lines = []
+    def _Header(name, kind, text):
+      lines.append('# HELP %s%s %s' % (prefix, name, text))
+      lines.append('# TYPE %s%s %s' % (prefix, name, kind))
+    def _Sample(name, labels, value):
+      lines.append('%s%s%s %s' % (prefix, name, _Labels(labels),
+          _Number(value)))
+    names = ('service', 'verb', 'uri', 'status')
+
+    _Header('requests_total', 'counter', 'Requests by service, verb, URI '
+        'template and status.')
+    for (labels, entry) in requests:
+      _Sample('requests_total', zip(names, labels), entry.count)
+    _Header('request_duration_seconds', 'histogram', 'Duration of the '
+        'requests, up to the last byte of the response.')
+    for (labels, entry) in requests:
+      labels = zip(names, labels)
+      count = 0
+      for (bound, in_bucket) in zip(self.buckets, entry.buckets):
+        count += in_bucket
+        _Sample('request_duration_seconds_bucket',
+            labels + [('le', _Number(bound))], count)
+      _Sample('request_duration_seconds_bucket', labels + [('le', '+Inf')],
+          entry.count)
+      _Sample('request_duration_seconds_sum', labels, entry.seconds)
+      _Sample('request_duration_seconds_count', labels, entry.count)
+    _Header('request_phase_seconds_total', 'counter', 'Seconds spent in '
+        'each phase of the requests.')
+    for (labels, entry) in requests:
+      for phase in PHASES:
+        _Sample('request_phase_seconds_total',
+            zip(names, labels) + [('phase', phase)], entry.phases[phase])
+    _Header('request_bytes_total', 'counter', 'Request body bytes sent.')
+    for (labels, entry) in requests:
+      _Sample('request_bytes_total', zip(names, labels), entry.request_bytes)
+    _Header('response_bytes_total', 'counter', 'Response body bytes '
+        'received.')
+    for (labels, entry) in requests:
+      _Sample('response_bytes_total', zip(names, labels),
+          entry.response_bytes)
+
+    counts = [(name, pool.counts()) for (pool, name) in pools]
+    _Header('pool_connections', 'gauge', 'Open connections of the pools, '
+        'idle or active.')
+    for (name, pool_counts) in counts:
+      for state in ('idle', 'active'):
+        _Sample('pool_connections', [('pool', name), ('state', state)],
+            pool_counts[state])
+    _Header('pool_connections_created_total', 'counter', 'Connections '
+        'opened by the pools.')
+    for (name, pool_counts) in counts:
+      _Sample('pool_connections_created_total', [('pool', name)],
+          pool_counts['created'])
+    _Header('pool_connections_reused_total', 'counter', 'Requests sent on '
+        'a connection kept alive by the pools.')
+    for (name, pool_counts) in counts:
+      _Sample('pool_connections_reused_total', [('pool', name)],
+          pool_counts['reused'])
+    return '\n'.join(lines) + '\n'
+
+
+class _RequestMetrics(object):
+  """The counters of one (service, verb, uri, status)."""
+
+  def __init__(self, buckets):
+    self.count = 0
+    self.seconds = 0.0
+    # One more bucket for the requests above the largest bound.
+    self.buckets = [0] * (buckets + 1)
+    self.request_bytes = 0
+    self.response_bytes = 0
+    self.phases = dict([(phase, 0.0) for phase in PHASES])
+
+
+# The MetricsRegistry used when none is given.
+default_registry = MetricsRegistry()
+
+
+def Instrument(service, registry=None, name='default'):
+  """Collects the metrics of a service in registry.
+
+  Args:
+    service: raws_json.JsonService, or a Session to instrument all services
+             built on it.
+    registry: MetricsRegistry (optional) Defaults to default_registry.
+    name: string (optional) Label of the connection pool of service. The
+          EventLoop of an async service is labeled name + '_async'.
+
+  Returns:
+    The registry.
+  """
+  registry = registry or default_registry
+  if service.request_observers is None:
+    service.request_observers = []
+  if registry not in service.request_observers:
+    service.request_observers.append(registry)
+  if getattr(service, 'connection_pool', None) is not None:
+    registry.watch(service.connection_pool, name)
+  if getattr(service, 'loop', None) is not None:
+    registry.watch(service.loop, name + '_async')
+  return registry
+
+
+def Render(registry=None):
+  """Returns the metrics of registry (default_registry by default) in the
+  Prometheus text format, served with CONTENT_TYPE."""
+  return (registry or default_registry).render()
+
+
+def _ServiceName(class_name):
+  """Returns 'rass' for RassService, AsyncRassService, ..."""
+  name = class_name
+  if name.startswith('Async'):
+    name = name[len('Async'):]
+  if name.endswith('Service') and name != 'Service':
+    name = name[:-len('Service')]
+  return name.lower()
+
+
+def _Labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join(['%s="%s"' % (name, _Escape(value))
+      for (name, value) in labels])
+
+
+def _Escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+      '\n', '\\n')
+
+
+def _Number(value):
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
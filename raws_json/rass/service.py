@@ -15,14 +15,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.import os
 import json, os
+from multiprocessing.pool import ThreadPool
 import raws_json
-from raws_json.raws_service import RawsService, Feed, Query, RequestError
+from raws_json.async_request import Future, gather
+from raws_json.raws_service import RawsService, AsyncRawsService, Feed, Query, RequestError
 
 class RassService(RawsService):
 
-    def __init__(self, username=None, password=None, server=None, ssl = False):
+    def __init__(self, username=None, password=None, server=None, ssl = False, session = None):
         self.username = username
-        super(RassService, self).__init__(username = username, password = password, server = server, ssl = ssl)
+        super(RassService, self).__init__(username = username, password = password, server = server, ssl = ssl, session = session)
 
     def delete(self, uri):
         """ Deletes any resource, given the uri. """
@@ -48,23 +50,88 @@ class RassService(RawsService):
     # ITEM METHODS
     # -----------
 
-    def createItem(self, dirpath, filename, local_path, force_create = True):
+    def createItem(self, dirpath, filename, local_path, force_create = True, resumable = False, state_file = None, streams = 1, use_mmap = False, file_pool = None, upload_cache = None, progress = None):
         """ Creates a new RASS item resource by uploading a file (= a file on the CDN). 
 
             @param string dirpath : path to the directory (on the rambla CDN) in which the item needs to be created.
             @param string filename : proposed filename to be used when storing the file (RASS will append a suffix if file already exists on CDN and force_create == True).
             @param string local_path : location of the file to be uploaded on the local machine
             @param bool force_create : If True, append suffix to filename if file already exists. If False, return HTTP error if already exists.
+            @param bool resumable : If True, PUT the file in chunks which are retried on failure (see RawsService.PutResumable), force_create is ignored.
+            @param string state_file : location of the file in which the progress of a resumable upload is kept, so it can be continued by a next call.
+            @param int streams : number of parallel connections over which a resumable upload is sent.
+            @param bool use_mmap : If True, the file is memory-mapped and sent from the mapping rather than read into strings.
+            @param raws_json.FilePool file_pool : limit on the number of files open at the same time, shared with other uploads.
+            @param raws_json.upload_cache.UploadCache upload_cache : if given, the upload is skipped when the same file was uploaded to the same path before, and the item object of that upload is returned.
+            @param progress : raws_json.TransferProgress, or function called with the number of bytes sent and the size of the file.
             @return item object (= result of json.decode(response_body))
         """
         uri = "/item/" + dirpath.lstrip("/")
-        media_source = raws_json.MediaSource(file_path = local_path, svr_filename = filename)
+        def _Upload():
+            media_source = raws_json.MediaSource(file_path = local_path, svr_filename = filename, use_mmap = use_mmap, file_pool = file_pool)
+            if resumable:
+                return self.PutResumable(uri = uri.rstrip("/") + "/" + filename, media_source = media_source, state_file = state_file, streams = streams, progress = progress)
+            if force_create: # do POST
+                return self.Post(data = None, uri = uri, media_source = media_source, progress = progress)
+            # PUT requires filename to be part of the URL path
+            return self.Put(data = None, uri = uri.rstrip("/") + "/" + filename, media_source = media_source, progress = progress)
+        return self._CachedUpload(upload_cache, uri.rstrip("/") + "/" + filename, local_path, _Upload)
+
+    def createItems(self, items, force_create = True, workers = 4, max_open_files = None, upload_cache = None):
+        """ Uploads many files to the CDN, several at a time.
+
+            Every file is only opened while it is being sent, and at most max_open_files of them are open at the same time.
+
+            @param list items : (dirpath, filename, local_path) tuples, see createItem.
+            @param bool force_create : If True, append suffix to filename if file already exists. If False, return HTTP error if already exists.
+            @param int workers : number of uploads in progress at the same time.
+            @param int max_open_files : size of the pool of open files, defaults to workers.
+            @param raws_json.upload_cache.UploadCache upload_cache : if given, files which were uploaded to the same path before are skipped (see createItem).
+            @return list : item object for each of the items, in the same order, or the exception raised by its upload.
+        """
+        file_pool = raws_json.FilePool(max_open_files or workers)
+        def _Upload(item):
+            (dirpath, filename, local_path) = item
+            try:
+                return self.createItem(dirpath, filename, local_path, force_create = force_create, file_pool = file_pool, upload_cache = upload_cache)
+            except Exception, e:
+                return e
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(_Upload, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def createItemFromStream(self, dirpath, filename, stream, content_type = None, force_create = True):
+        """ Creates a new RASS item resource from data of unknown length, which is uploaded with chunked transfer-encoding.
+
+            @param string dirpath : path to the directory (on the rambla CDN) in which the item needs to be created.
+            @param string filename : proposed filename to be used when storing the file.
+            @param stream : file-like object (eg. the stdout pipe of a transcoder) or iterable of strings, read until its end.
+            @param string content_type : MIME type of the data.
+            @param bool force_create : If True, append suffix to filename if file already exists. If False, return HTTP error if already exists.
+            @return item object (= result of json.decode(response_body))
+        """
+        uri = "/item/" + dirpath.lstrip("/")
+        media_source = raws_json.MediaSource(file_handle = stream, content_type = content_type, file_name = filename)
         if force_create: # do POST
-            media_entry = self.Post(data = None, uri = uri, media_source = media_source)
-        else:
-            uri = uri.rstrip("/") + "/" + filename # PUT requires filename to be part of the URL path
-            media_entry = self.Put(data = None, uri = uri, media_source = media_source)
-        return media_entry
+            return self.Post(data = None, uri = uri, media_source = media_source)
+        uri = uri.rstrip("/") + "/" + filename # PUT requires filename to be part of the URL path
+        return self.Put(data = None, uri = uri, media_source = media_source)
+
+    def downloadItem(self, uri, local_path, streams = 1, resume = False, use_mmap = False, progress = None):
+        """ Downloads a file from the CDN to disk, in chunks, optionally continuing an earlier partial download of the same file.
+
+            @param string uri : URL of the file (absolute, or relative to the server of the service).
+            @param string local_path : location on the local machine where the file is written.
+            @param int streams : number of ranges of the file fetched over parallel connections.
+            @param bool resume : If True, an existing local file is continued instead of overwritten. It must hold the start of the same file on the CDN.
+            @param bool use_mmap : If True, the ranges are written through a memory map of the preallocated local file.
+            @param progress : raws_json.TransferProgress, or function called with the number of bytes on disk and the size of the file.
+            @return int : size of the downloaded file
+        """
+        return self.DownloadFile(uri = uri, file_path = local_path, streams = streams, resume = resume, use_mmap = use_mmap, progress = progress)
 
     def itemExists(self, path):
         """ Checks if a RASS item (= file on the CDN) exists?
@@ -139,6 +206,21 @@ class RassService(RawsService):
             uri = query.ToUri()
         return self.Get(uri = uri)
 
+    def iterDirList(self, path, query = None):
+        """ Retrieve the content of a directory, one entry at a time.
+
+            Unlike getDirList, the feed is decoded while it is received, so large (recursive) listings are processed in constant memory.
+
+            @param string : relative path to the directory to be retrieved
+            @param query raws_json.Query object that contains queryset args.
+            @return iterator of {"entry": entry} dicts
+        """
+        uri = "/dir/" + path.lstrip("/")
+        if query:
+            query.feed = uri
+            uri = query.ToUri()
+        return self.GetEntries(uri = uri)
+
     def deleteDir(self, path, recursive = False):
         """ Deletes a RASS item (file on the CDN + RASS resource attached to it)
 
@@ -182,8 +264,58 @@ class RassService(RawsService):
             @return a list (feed) of meta objects
         """
         return self.get_meta_info(path, query)
-        
 
 
-        
+class AsyncRassService(AsyncRawsService, RassService):
+    """ RassService whose methods return a raws_json.async_request.Future of their result. """
+
+    def getItemHeader(self, uri):
+        return self.Head(uri = uri).then(lambda http_resp: http_resp.status)
+
+    def itemUrlExists(self, uri):
+        return self.Head(uri = uri).then(lambda http_resp: http_resp.status == 200)
+
+    def dirExists(self, path):
+        qry = Query()
+        qry["kind"] = "root"
+        return self.getDirList(path, qry).then(lambda feed: True, _NotFound)
+
+    def createItems(self, items, force_create = True, max_open_files = 64, upload_cache = None):
+        """ Uploads many files to the CDN on the event loop.
+
+            At most max_open_files uploads are started at the same time, the next one starts when one of them completes, so only that many files are ever open.
+
+            @param raws_json.upload_cache.UploadCache upload_cache : if given, files which were uploaded to the same path before are skipped (see createItem).
+            @return Future of the list of item objects (or exceptions) for the items, in the same order.
+        """
+        results = [Future() for item in items]
+        pending = list(reversed(list(enumerate(items))))
+        def _Next(done = None):
+            if not pending:
+                return
+            (index, (dirpath, filename, local_path)) = pending.pop()
+            try:
+                future = self.createItem(dirpath, filename, local_path, force_create = force_create, upload_cache = upload_cache)
+            except Exception, e:
+                results[index].set_result(e)
+                _Next()
+                return
+            future.add_done_callback(lambda done: _Relay(done, results[index]))
+            future.add_done_callback(_Next)
+        for i in xrange(min(max_open_files, len(items))):
+            _Next()
+        return gather(results)
+
+
+def _Relay(future, result):
+    """ Completes result with the result of future, or with its exception. """
+    if future.exception() is not None:
+        result.set_result(future.exception())
+    else:
+        result.set_result(future.result())
+
 
+def _NotFound(e):
+    if isinstance(e, RequestError):
+        return False
+    raise e
@@ -16,29 +16,39 @@
 # limitations under the License.import os
 import json, os
 import raws_json
-from raws_json.raws_service import RawsService
+from raws_json.raws_service import RawsService, AsyncRawsService
 
 class RatsService(RawsService):
 
-    def __init__(self, username=None, password=None, server=None, ssl = False):
+    def __init__(self, username=None, password=None, server=None, ssl = False, session = None):
         self.username = username
-        super(RatsService, self).__init__(username = username, password = password, server = server, ssl = ssl)
+        super(RatsService, self).__init__(username = username, password = password, server = server, ssl = ssl, session = session)
 
     def delete(self, uri):
         """ Deletes any resource, given the uri. """
         return self.Delete(uri = uri)
 
-    def createSrc(self, filename, local_path):
+    def createSrc(self, filename, local_path, resumable = False, state_file = None, streams = 1, upload_cache = None, use_mmap = False, file_pool = None, progress = None):
         """ Tries to PUT a new src resource to RATS.
 
             @param filename filename to be given to the uploaded file on the RATS server.
             @param local_path location of the file to be uploaded on the local machine
+            @param resumable if True, PUT the file in chunks which are retried on failure (see RawsService.PutResumable)
+            @param state_file location of the file in which the progress of a resumable upload is kept, so it can be continued by a next call
+            @param streams number of parallel connections over which a resumable upload is sent
+            @param upload_cache raws_json.upload_cache.UploadCache, if given the upload is skipped when the same file was uploaded as filename before
+            @param use_mmap if True, the file is memory-mapped and sent from the mapping rather than read into strings
+            @param file_pool raws_json.FilePool, limit on the number of files open at the same time, shared with other uploads
+            @param progress raws_json.TransferProgress, or function called with the number of bytes sent and the size of the file
 
             @return SrcEntry object
         """
-        media_source = raws_json.MediaSource(file_path = local_path, svr_filename = filename)
-        media_entry = self.Put(data = None, uri = '/src/', media_source = media_source)
-        return media_entry
+        def _Upload():
+            media_source = raws_json.MediaSource(file_path = local_path, svr_filename = filename, use_mmap = use_mmap, file_pool = file_pool)
+            if resumable:
+                return self.PutResumable(uri = '/src/', media_source = media_source, state_file = state_file, streams = streams, progress = progress)
+            return self.Put(data = None, uri = '/src/', media_source = media_source, progress = progress)
+        return self._CachedUpload(upload_cache, '/src/' + filename, local_path, _Upload)
 
     def createJob(self, input=None, output=None, format=None, formatgroup = None, src_location=None, import_location=None, tgt_location=None, startpos=None, endpos=None, 
                     client_passthru=None, client_input=None, proc = None, snapshot_interval = None):
@@ -97,3 +107,8 @@ class RatsService(RawsService):
         if uri is None:
             raise Exception('You must provide a valid URI argument to getJob().')
         return self.Get(uri)
+
+
+class AsyncRatsService(AsyncRawsService, RatsService):
+    """ RatsService whose methods return a raws_json.async_request.Future of their result. """
+    pass
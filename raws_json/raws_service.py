@@ -28,11 +28,21 @@ __author__ = 'api.jscudder (Jeffrey Scudder)'
                An instance can perform query, insertion, deletion, and
                update.
 """
+import copy
+import itertools
+import Queue
 import re
 import httplib
 import urllib
 import raws_json
+import raws_json.async_request
+import raws_json.download
+import raws_json.feed_parser
+import raws_json.upload
 import json
+import sys
+import zlib
+from multiprocessing.pool import ThreadPool
 
 # Module level variable specifies which module should be used by RawsService
 # objects to make HttpRequests. This setting can be overridden on each
@@ -75,15 +85,93 @@ class Feed(object):
                 self.entries.append({"entry":e,})
 
 
+class Session(object):
+    """Transport state which can be shared by several RawsService instances.
+
+    The session owns the connection pool, the DNS cache, the SSL context,
+    the headers and credentials common to its services, the transfer
+    statistics and the request observers. Services which are built
+    on the same session (eg. a RassService, MetaService and RatsService
+    talking to the same Rambla hosts) share warm connections and counters
+    instead of each keeping their own. Headers and credentials given to a
+    service are sent over those of the session, for that service only.
+    """
+
+    def __init__(self, username=None, password=None, source=None,
+               additional_headers=None, connection_pool=None, dns_cache=None,
+               ssl_context=None, upload_limit=None, download_limit=None,
+               request_observers=None):
+        """Creates an object of type Session.
+
+        Args:
+          username: string (optional) The username for authentication, used by services that don't pass their own.
+          password: string (optional) The user's password.
+          source: string (optional) The name of the user's application.
+          additional_headers: dictionary (optional) Any additional headers which should be included with CRUD operations of all services on this session.
+          connection_pool: raws_json.ConnectionPool (optional) The pool which keeps connections alive between requests.
+          dns_cache: raws_json.DnsCache (optional) The cache through which host names are resolved. Defaults to the one shared by the whole process.
+          ssl_context: ssl.SSLContext (optional) Certificate and cipher settings for https, see raws_json.CreateSslContext. Created once for the session by default.
+          upload_limit: raws_json.BandwidthLimiter (optional) Caps the combined upload throughput of all services on the session.
+          download_limit: raws_json.BandwidthLimiter (optional) Caps their combined download throughput.
+          request_observers: list (optional) Functions called with the raws_json.RequestTiming of every request of the services on the session, eg. [raws_json.SlowRequestLog(threshold = 2.0)].
+        """
+        self.username = username
+        self.password = password
+        self.source = source
+        self.additional_headers = raws_json.HeaderDict(additional_headers or {})
+        self.connection_pool = connection_pool or raws_json.ConnectionPool()
+        self.dns_cache = dns_cache or raws_json.default_dns_cache
+        self.ssl_context = ssl_context or raws_json.CreateSslContext()
+        self.stats = raws_json.TransferStats()
+        self.upload_limit = upload_limit
+        self.download_limit = download_limit
+        self.request_observers = list(request_observers or [])
+        if self.username and self.password:
+            raws_json.UseBasicAuth(self, self.username, self.password)
+
+    def close(self):
+        """ Closes all idle connections of the session. """
+        self.connection_pool.clear()
+
+
+class BatchResult(object):
+    """The outcome of one request of a RawsService.batch() or map() call.
+
+    Attributes:
+      index: int Position of the request in the input.
+      request: The (verb, uri[, data]) tuple or map() argument.
+      result: The value returned for the request, None if it failed.
+      error: The exception raised by the request, None if it succeeded.
+    """
+
+    def __init__(self, index, request, result=None, error=None):
+        self.index = index
+        self.request = request
+        self.result = result
+        self.error = error
+
+    def __repr__(self):
+        if self.error is not None:
+            return '<BatchResult %d error=%r>' % (self.index, self.error)
+        return '<BatchResult %d result=%r>' % (self.index, self.result)
+
+
 class RawsService(raws_json.JsonService):
     """Contains elements needed for Raws login and CRUD request headers.
     
     Maintains additional headers (tokens for example) needed for the Raws
     services to allow a user to perform inserts, updates, and deletes.
     """
+
+    # If True, json entries sent by PostOrPut which are at least
+    # compress_threshold bytes long are gzip compressed (Content-Encoding: gzip).
+    compress_requests = False
+    compress_threshold = 4096
+    compress_level = 6
     
     def __init__(self, username=None, password=None, source=None, server=None, port = None,
-               additional_headers=None, handler=None, ssl = False):
+               additional_headers=None, handler=None, ssl = False, connection_pool=None, session=None,
+               ssl_context=None, upload_limit=None, download_limit=None):
         """Creates an object of type RawsService.
         
         Args:
@@ -94,12 +182,42 @@ class RawsService(raws_json.JsonService):
           additional_headers: dictionary (optional) Any additional headers which should be included with CRUD operations.
           handler: module (optional) The module whose HttpRequest function should be used when making requests to the server. The default value is atom.service.
           ssl: bool (optional) Use SSL encryption.
+          connection_pool: raws_json.ConnectionPool (optional) The pool which keeps connections alive between requests. By default each service gets its own pool.
+          session: Session (optional) Shared transport state. The service uses the connection pool, headers and stats of the session, and its username, password and source unless they are passed explicitly. Headers and credentials passed to the service only apply to the service itself.
+          ssl_context: ssl.SSLContext (optional) Certificate and cipher settings for https, see raws_json.CreateSslContext. Defaults to the context of the session, or else to the one shared by the whole process.
+          upload_limit: raws_json.BandwidthLimiter (optional) Caps the upload throughput of the service, eg. raws_json.BandwidthLimiter(rate=10 * 1024 * 1024, host_rate=4 * 1024 * 1024). Defaults to the limit of the session.
+          download_limit: raws_json.BandwidthLimiter (optional) Caps the download throughput of the service. Defaults to the limit of the session.
         """
+        self.session = session
+        if session is not None:
+            username = username or session.username
+            password = password or session.password
+            source = source or session.source
+            # The headers of the service are layered over those of the
+            # session, so its credentials don't leak to the other services.
+            self.base_headers = session.additional_headers
+            connection_pool = connection_pool or session.connection_pool
+            self.dns_cache = session.dns_cache
+            self.ssl_context = ssl_context or session.ssl_context
+            self.stats = session.stats
+            self.request_observers = session.request_observers
+            upload_limit = upload_limit or session.upload_limit
+            download_limit = download_limit or session.download_limit
+        else:
+            self.dns_cache = raws_json.default_dns_cache
+            self.ssl_context = ssl_context or raws_json.DefaultSslContext()
+            self.stats = raws_json.TransferStats()
+            self.request_observers = []
+        self.upload_limit = upload_limit
+        self.download_limit = download_limit
         self.username = username
         self.password = password
         self.server = server
-        self.additional_headers = additional_headers or {}
+        if not isinstance(additional_headers, raws_json.HeaderDict):
+            additional_headers = raws_json.HeaderDict(additional_headers or {})
+        self.additional_headers = additional_headers
         self.handler = handler or http_request_handler
+        self.connection_pool = connection_pool or raws_json.ConnectionPool()
         self.ssl = ssl
         if port:
             self.port = port
@@ -124,6 +242,29 @@ class RawsService(raws_json.JsonService):
         if self.username and self.password:
             self.UseBasicAuth(self.username, self.password)
 
+    def set_server_addresses(self, addresses):
+        """ Pins the IP addresses of the server, so its name is never looked up.
+
+            @param addresses list of IP address strings, pass None to use the resolver again.
+        """
+        if addresses:
+            self.dns_cache.pin(self.server, addresses)
+        else:
+            self.dns_cache.unpin(self.server)
+
+    def uri_template(self, uri):
+        """ Returns the uri under which a request is reported to the request_observers.
+
+            The paths below a resource are left out, so eg. all requests for items are reported as '/item/{path}'.
+            @param uri string: uri of the request
+            @return string
+        """
+        template = raws_json.UriTemplate(uri)
+        parts = template.split("/", 2)
+        if len(parts) == 3 and parts[2]:
+            return "/%s/{path}" % parts[1]
+        return template
+
     def get_service_uri(self):
         base_uri = "http://" + self.server
         if self.port:
@@ -184,30 +325,242 @@ class RawsService(raws_json.JsonService):
             extra_headers.update({"Accept":"application/json"})
 
         server_response = self.handler.HttpRequest(self, 'GET', None, uri, extra_headers=extra_headers)
-        result_body = server_response.read()
+        return self._ProcessResponse(server_response, _GetResult)
+
+    def GetStream(self, uri, extra_headers=None, chunk_size=raws_json.READ_CHUNK_SIZE):
+        """Query the Raws API with the given URI and stream the raw response body.
+
+        Unlike Get, the body is not decoded and never held in memory as a
+        whole, which makes this suitable for large feeds and exports.
+
+        Args:
+          uri: string The query in the form of a URI.
+          extra_headers: dictionary (optional) Extra HTTP headers to be included
+                         in the GET request.
+          chunk_size: int (optional) Maximum number of bytes per chunk.
+
+        Returns:
+          An iterator of byte strings. A RequestError is raised right away if
+          the server doesn't respond with 200.
+        """
+        server_response = self.handler.HttpRequest(self, 'GET', None, uri, extra_headers=extra_headers)
+        return self._ProcessResponse(server_response, _StreamResult(chunk_size))
+
+    def GetEntries(self, uri, extra_headers=None, chunk_size=raws_json.READ_CHUNK_SIZE):
+        """Query the Raws API for a feed and decode its entries one at a time.
+
+        Each entry is decoded as soon as it has been received, so big feeds
+        (eg. a recursive dir listing) can be processed in constant memory and
+        before the last byte has arrived.
+
+        Args:
+          uri: string The query in the form of a URI. Example:
+               '/dir/mysubdir/?kind=file'.
+          extra_headers: dictionary (optional) Extra HTTP headers to be included
+                         in the GET request.
+          chunk_size: int (optional) Number of bytes read from the response at
+              a time.
 
-        if server_response.status == 200:
-            return json.loads(s = result_body, parse_int = True, parse_float = True)
+        Returns:
+          An iterator of {"entry": entry} dicts, like the items of Feed.entries.
+          A RequestError is raised right away if the server doesn't respond
+          with 200.
+        """
+        if extra_headers is None:
+            extra_headers = {"Accept":"application/json"}
         else:
-          raise RequestError, {'status': server_response.status,
-              'reason': server_response.reason, 'body': result_body}
+            extra_headers.update({"Accept":"application/json"})
+        server_response = self.handler.HttpRequest(self, 'GET', None, uri, extra_headers=extra_headers)
+        return self._ProcessResponse(server_response, _EntriesResult(chunk_size))
+
+    def Download(self, uri, file_handle, extra_headers=None, chunk_size=raws_json.READ_CHUNK_SIZE):
+        """Query the Raws API with the given URI and write the response body to a file.
+
+        Args:
+          uri: string The query in the form of a URI. Example:
+               '/item/mysubdir/myfile.mp4'.
+          file_handle: An object with a write method, or a string with the
+              path of the local file to be (over)written.
+          extra_headers: dictionary (optional) Extra HTTP headers to be included
+                         in the GET request.
+          chunk_size: int (optional) Maximum number of bytes held in memory.
+
+        Returns:
+          The number of bytes written.
+        """
+        if isinstance(file_handle, basestring):
+            fd = open(file_handle, 'wb')
+            result = None
+            try:
+                result = self.Download(uri, fd, extra_headers=extra_headers, chunk_size=chunk_size)
+            finally:
+                self._CloseWhenDone(fd, result)
+            return result
+        server_response = self.handler.HttpRequest(self, 'GET', None, uri, extra_headers=extra_headers)
+        return self._ProcessResponse(server_response, _StreamResult(chunk_size, file_handle))
+
+    def DownloadFile(self, uri, file_path, chunk_size=raws_json.READ_CHUNK_SIZE, streams=1, resume=False,
+                     use_mmap=False, max_retries=5, backoff=1.0, extra_headers=None, progress=None):
+        """Downloads a (large) file to disk, streaming it in chunks.
+
+        A broken connection continues from the bytes already on disk with an
+        HTTP Range request, and failed requests are retried with exponential
+        backoff. With resume, so does a file_path left by an earlier run. With streams > 1 the file is fetched as that many
+        ranges over parallel connections into a preallocated output file. See
+        raws_json.download.RangedDownload.
+
+        Args:
+          uri: string The uri of the file. Example: '/item/mysubdir/myfile.mp4'.
+          file_path: string Path of the local file to write.
+          chunk_size: int (optional) Maximum number of bytes held in memory per stream.
+          streams: int (optional) Number of ranges fetched at the same time.
+          resume: bool (optional) Continue an existing file_path instead of overwriting it. It must hold the start of the same file; a file which changed on the server, or a longer local file, is downloaded again from the start.
+          use_mmap: bool (optional) Write the ranges through a memory map of the output file.
+          max_retries: int (optional) Number of times a failed request is retried.
+          backoff: float (optional) Seconds waited before the first retry.
+          extra_headers: dictionary (optional) Extra HTTP headers to be included in the requests.
+          progress: raws_json.TransferProgress or function (optional) Follows the download, see raws_json.MakeProgress.
+
+        Returns:
+          The size of the downloaded file.
+        """
+        download = raws_json.download.RangedDownload(self, uri, file_path, chunk_size=chunk_size,
+            streams=streams, resume=resume, use_mmap=use_mmap, max_retries=max_retries, backoff=backoff,
+            extra_headers=extra_headers, progress=progress, error_handler=_RaiseRequestError)
+        return download.run()
+
+    def GetMedia(self, uri, extra_headers=None, file_path=None):
+        """Returns a MediaSource containing media and its metadata from the given URI.
+
+        Without file_path the file_handle of the MediaSource is the response
+        itself, so the media can be read while it is received. With file_path
+        the media is first downloaded to that file (see DownloadFile).
+        """
+        if file_path is not None:
+            self.DownloadFile(uri, file_path, resume=False, extra_headers=extra_headers)
+            return raws_json.MediaSource(file_path=file_path)
+        server_response = self.handler.HttpRequest(self, 'GET', None, uri, extra_headers=extra_headers)
+        return self._ProcessResponse(server_response, _MediaResult)
+
+    def Head(self, uri, extra_headers=None, url_params=None, escape_params=True):
+        """Sends a HEAD request to the Raws API with the given URI.
+
+        Args:
+          uri: string The query in the form of a URI. Example:
+               '/item/mysubdir/myfile.mp4'.
+          extra_headers: dictionary (optional) Extra HTTP headers to be included
+                         in the HEAD request.
+          url_params: dict (optional) Additional URL parameters to be included
+                      in the URI.
+          escape_params: boolean (optional) If true, the query and any URL
+                         parameters will be escaped.
+
+        Returns:
+          The server's response to the HEAD request, as returned by the handler.
+        """
+        return self.handler.HttpRequest(self, 'HEAD', None, uri, extra_headers=extra_headers,
+            url_params=url_params, escape_params=escape_params)
+
+    def batch(self, requests, max_workers=8, ordered=True):
+        """Runs many requests on a bounded pool of threads.
+
+        The threads share the service's connection pool, which should keep at
+        least max_workers connections per host to avoid reconnecting.
+
+        Args:
+          requests: iterable of (verb, uri) or (verb, uri, data) tuples, verb
+              being one of 'GET', 'HEAD', 'POST', 'PUT' or 'DELETE'. The result
+              of each request is what Get, Head, PostOrPut or Delete return.
+          max_workers: int (optional) Number of requests run concurrently.
+          ordered: bool (optional) If True results are returned in the order
+              of requests, otherwise as soon as they finish.
+
+        Returns:
+          A generator of BatchResult objects. A failing request doesn't stop
+          the batch, its exception is stored in the error attribute.
+        """
+        return self.map(self._BatchRequest, requests, max_workers=max_workers,
+            ordered=ordered)
+
+    def map(self, function, arguments, max_workers=8, ordered=True):
+        """Calls function(argument) for every argument on a pool of threads.
+
+        Example: rass.map(rass.itemExists, paths) checks many items at once.
+
+        Args:
+          function: func Typically a bound method of this service.
+          arguments: iterable of the single arguments to pass to function.
+          max_workers: int (optional) Number of calls run concurrently.
+          ordered: bool (optional) If True results are returned in the order
+              of arguments, otherwise as soon as they finish.
+
+        Returns:
+          A generator of BatchResult objects. The arguments are read as the
+          results are consumed, at most 2 * max_workers ahead of the last
+          result returned, so arguments may be a long or endless generator.
+        """
+        def _Call(task):
+            (index, argument) = task
+            try:
+                return BatchResult(index, argument, result=function(argument))
+            except Exception:
+                return BatchResult(index, argument, error=sys.exc_info()[1])
+
+        tasks = enumerate(arguments)
+        window = 2 * max_workers
+        finished = Queue.Queue()
+        # Results which finished before the ones preceding them, when ordered.
+        early = {}
+        submitted = 0
+        returned = 0
+        pool = ThreadPool(max_workers)
+        try:
+            while True:
+                for task in itertools.islice(tasks, window - (submitted - returned)):
+                    pool.apply_async(_Call, (task,), callback=finished.put)
+                    submitted += 1
+                if returned == submitted:
+                    break
+                if ordered:
+                    while returned not in early:
+                        result = finished.get()
+                        early[result.index] = result
+                    result = early.pop(returned)
+                else:
+                    result = finished.get()
+                returned += 1
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _BatchRequest(self, request):
+        verb = request[0].upper()
+        uri = request[1]
+        data = None
+        if len(request) > 2:
+            data = request[2]
+        if verb == 'GET':
+            return self.Get(uri)
+        elif verb == 'HEAD':
+            return self.Head(uri)
+        elif verb == 'DELETE':
+            return self.Delete(uri)
+        elif verb in ('POST', 'PUT'):
+            return self.PostOrPut(verb, data, uri)
+        raise ValueError('Unsupported verb in batch request: %s' % verb)
+
+    def _ProcessResponse(self, server_response, result_handler):
+        """Turns the handler's response into the result of a CRUD operation.
+
+        Args:
+          server_response: The response returned by the handler's HttpRequest.
+          result_handler: func A function which reads the response and returns
+              the result, or raises a RequestError.
+        """
+        return result_handler(server_response)
   
-    # def GetMedia(self, uri, extra_headers=None, file_path = None):
-    #     """Returns a MediaSource containing media and its metadata from the given
-    #     URI string, storing it into the local file_path.
-    #     """
-    #     response_handle = self.handler.HttpRequest(self, 'GET', None, uri, extra_headers=extra_headers)
-    #     if not response_handle:
-    #         raise rawsc.RawscException('Failed to retrieve response handle from URI = %s.' % str(uri))
-    #     media_source = rawsc.MediaSource(file_handle = response_handle, content_type = response_handle.getheader('Content-Type'), content_length = response_handle.getheader('Content-Length'))
-    #     if not media_source:
-    #         raise rawsc.RawscException('Failed to create media_source object after retrieving URI = %s.' % str(uri))
-    #     if file_path is not None:
-    #         if not media_source.writeFile(file_path):
-    #             raise rawsc.RawscException('Failed writing response (URI = %s) to path = %s.' % (str(uri), str(file_path)))
-    #     return media_source
-    #     
-    # 
     # def GetEntry(self, uri, extra_headers=None):
     #     """Query the Raws API with the given URI and receive an Entry.
     # 
@@ -287,7 +640,7 @@ class RawsService(raws_json.JsonService):
     # 
     def Post(self, data, uri, extra_headers=None, url_params=None,
            escape_params=True, redirects_remaining=4, media_source=None,
-           converter=None):
+           converter=None, progress=None):
         """Insert or update  data into a Raws service at the given URI.
     
         Args:
@@ -313,6 +666,8 @@ class RawsService(raws_json.JsonService):
               server's response. Often this is a function like
               RawsEntryFromString which will parse the body of the server's
               response and return a RawsEntry.
+          progress: raws_json.TransferProgress or func (optional) Follows
+              the upload of the request body, see raws_json.HttpRequest.
     
         Returns:
           If the post succeeded, this method will return a RawsFeed, RawsEntry,
@@ -322,11 +677,11 @@ class RawsService(raws_json.JsonService):
         return self.PostOrPut('POST', data, uri, extra_headers=extra_headers,
             url_params=url_params, escape_params=escape_params,
             redirects_remaining=redirects_remaining,
-            media_source=media_source, converter=converter)
+            media_source=media_source, converter=converter, progress=progress)
       
     def PostOrPut(self, verb, data, uri, extra_headers=None, url_params=None,
            escape_params=True, redirects_remaining=4, media_source=None,
-           converter=None):
+           converter=None, progress=None):
         """Insert data into a Raws service at the given URI.
     
         Args:
@@ -353,6 +708,8 @@ class RawsService(raws_json.JsonService):
               server's response. Often this is a function like
               RawsEntryFromString which will parse the body of the server's
               response and return a RawsEntry.
+          progress: raws_json.TransferProgress or func (optional) Follows
+              the upload of the request body, see raws_json.HttpRequest.
     
         Returns:
           If the post succeeded, this method will return a RawsFeed, RawsEntry,
@@ -365,61 +722,59 @@ class RawsService(raws_json.JsonService):
             extra_headers.update({"Accept":"application/json"})
     
         if data and media_source:
-            if ElementTree.iselement(data):
-                data_str = ElementTree.tostring(data)
+            if isinstance(data, str):
+                data_str = data
             else:
-                data_str = str(data)
-    
-            multipart = []
-            multipart.append('Media multipart posting\r\n--END_OF_PART\r\n' + \
-              'Content-Type: application/atom+xml\r\n\r\n')
-            multipart.append('\r\n--END_OF_PART\r\nContent-Type: ' + \
-              media_source.content_type+'\r\n\r\n')
-            multipart.append('\r\n--END_OF_PART--\r\n')
-    
+                data_str = json.dumps(data)
+            body = raws_json.MultipartBody()
+            body.addPart('application/json', data_str)
+            body.addPart(media_source.content_type, media_source)
+
             extra_headers['MIME-version'] = '1.0'
-            extra_headers['Content-Length'] = str(len(multipart[0]) +
-              len(multipart[1]) + len(multipart[2]) +
-              len(data_str) + media_source.content_length)
-    
-            server_response = self.handler.HttpRequest(self, verb,
-              [multipart[0], data_str, multipart[1], media_source.file_handle,
-                  multipart[2]], uri,
-              extra_headers=extra_headers, url_params=url_params,
-              escape_params=escape_params,
-              content_type='multipart/related; boundary=END_OF_PART')
-            result_body = server_response.read()
+            if body.getLength() is not None:
+                extra_headers['Content-Length'] = str(body.getLength())
+
+            server_response = None
+            try:
+                server_response = self.handler.HttpRequest(self, verb,
+                  body.getParts(), uri,
+                  extra_headers=extra_headers, url_params=url_params,
+                  escape_params=escape_params,
+                  content_type=body.getContentType(), progress=progress)
+            finally:
+                self._CloseWhenDone(media_source, server_response)
     
         elif media_source or isinstance(data, raws_json.MediaSource):
             if isinstance(data, raws_json.MediaSource):
                 media_source = data
-            extra_headers['Content-Length'] = str(media_source.content_length)
+            if media_source.content_length is not None:
+                extra_headers['Content-Length'] = str(media_source.content_length)
             extra_headers['Slug'] = str(media_source.svr_filename)
-            server_response = self.handler.HttpRequest(self, verb,
-              media_source.file_handle, uri, extra_headers=extra_headers,
-              url_params=url_params, escape_params=escape_params,
-              content_type=media_source.content_type)
-            result_body = server_response.read()
+            server_response = None
+            try:
+                server_response = self.handler.HttpRequest(self, verb,
+                  media_source, uri, extra_headers=extra_headers,
+                  url_params=url_params, escape_params=escape_params,
+                  content_type=media_source.content_type, progress=progress)
+            finally:
+                self._CloseWhenDone(media_source, server_response)
     
         else:
             http_data = json.dumps(data)
             content_type = 'application/json'
+            if self.compress_requests and len(http_data) >= self.compress_threshold:
+                http_data = _GzipCompress(http_data, self.compress_level)
+                extra_headers['Content-Encoding'] = 'gzip'
             server_response = self.handler.HttpRequest(self, verb,
               http_data, uri, extra_headers=extra_headers,
               url_params=url_params, escape_params=escape_params,
-              content_type=content_type)
-            result_body = server_response.read()
+              content_type=content_type, progress=progress)
     
-        # Server returns 201 for most post requests, but when performing a batch
-        # request the server responds with a 200 on success.
-        if server_response.status == 201 or server_response.status == 200:
-            return json.loads(result_body)
-        else:
-            raise RequestError, {'status': server_response.status, 'reason': server_response.reason, 'body': result_body}
+        return self._ProcessResponse(server_response, _PostOrPutResult)
       
     def Put(self, data, uri, extra_headers=None, url_params=None,
           escape_params=True, redirects_remaining=3, media_source=None,
-          converter=None):
+          converter=None, progress=None):
         """Updates an entry at the given URI.
     
         Args:
@@ -443,6 +798,8 @@ class RawsService(raws_json.JsonService):
               server's response. Often this is a function like
               RawsEntryFromString which will parse the body of the server's
               response and return a RawsEntry.
+          progress: raws_json.TransferProgress or func (optional) Follows
+              the upload of the request body, see raws_json.HttpRequest.
     
         Returns:
           If the put succeeded, this method will return a RawsFeed, RawsEntry,
@@ -452,8 +809,83 @@ class RawsService(raws_json.JsonService):
         return self.PostOrPut('PUT', data, uri, extra_headers=extra_headers,
             url_params=url_params, escape_params=escape_params,
             redirects_remaining=redirects_remaining,
-            media_source=media_source, converter=converter)
+            media_source=media_source, converter=converter, progress=progress)
       
+    def PutResumable(self, uri, media_source, state_file=None, chunk_size=raws_json.upload.DEFAULT_CHUNK_SIZE,
+                     max_retries=5, backoff=1.0, extra_headers=None, streams=1, progress=None):
+        """Uploads a file with Content-Range PUT requests, so it can be resumed.
+
+        The file is sent chunk_size bytes at a time. A chunk which fails is
+        retried with exponential backoff, continuing from the last byte the
+        server confirmed. With a state_file the confirmed offset survives the
+        process, and calling PutResumable again for the same uri and file
+        continues the upload instead of starting over.
+
+        Args:
+          uri: string The uri to which the file is PUT.
+          media_source: MediaSource The file to upload, its file_handle must
+                        be seekable and its content_length known.
+          state_file: string (optional) Path of the file in which the upload
+                      progress is kept. It is removed once the upload is done.
+          chunk_size: int (optional) Number of bytes sent with each request.
+          max_retries: int (optional) Number of times a chunk is retried.
+          backoff: float (optional) Seconds waited before the first retry,
+                   doubled for every next one.
+          extra_headers: dict (optional) HTTP headers which are to be included.
+          streams: int (optional) If more than 1, the file is split in this
+                   many byte ranges which are sent over parallel connections,
+                   and committed once all of them arrived (see
+                   raws_json.upload.ParallelUpload).
+          progress: raws_json.TransferProgress or function (optional)
+                    Follows the bytes confirmed by the server, see
+                    raws_json.MakeProgress.
+
+        Returns:
+          The decoded json entry returned by the server.
+        """
+        headers = {"Accept": "application/json"}
+        if media_source.svr_filename:
+            headers['Slug'] = str(media_source.svr_filename)
+        if extra_headers:
+            headers.update(extra_headers)
+        kwargs = dict(state=raws_json.upload.UploadState(state_file), chunk_size=chunk_size,
+            max_retries=max_retries, backoff=backoff, extra_headers=headers,
+            result_handler=_PostOrPutResult, progress=progress)
+        if streams > 1:
+            upload = raws_json.upload.ParallelUpload(self, uri, media_source,
+                streams=streams, **kwargs)
+        else:
+            upload = raws_json.upload.ResumableUpload(self, uri, media_source, **kwargs)
+        try:
+            return upload.run()
+        finally:
+            media_source.close()
+
+    def _CloseWhenDone(self, file_object, result):
+        """Closes a file (or MediaSource) used by a request once result, the return value of the request, is complete."""
+        file_object.close()
+
+    def _CachedUpload(self, upload_cache, path, local_path, upload):
+        """Calls upload() unless local_path is known to be at path already.
+
+        Args:
+          upload_cache: raws_json.upload_cache.UploadCache or None.
+          path: string Location of the upload on the server.
+          local_path: string The file to upload.
+          upload: func Uploads the file and returns the decoded entry.
+
+        Returns:
+          The entry of the upload, or of the earlier upload of the same file.
+        """
+        if upload_cache is None:
+            return upload()
+        (entry, fingerprint) = upload_cache.lookup(self.server, path, local_path)
+        if entry is not None:
+            return entry
+        entry = upload()
+        upload_cache.store(self.server, path, fingerprint, entry)
+        return entry
+
     def Delete(self, uri, extra_headers=None, url_params=None, escape_params=True, redirects_remaining=4):
         """Deletes the entry at the given URI.
     
@@ -482,13 +914,180 @@ class RawsService(raws_json.JsonService):
         server_response = self.handler.HttpRequest(self, 'DELETE', None, uri,
             extra_headers=extra_headers, url_params=url_params,
             escape_params=escape_params)
-        result_body = server_response.read()
-    
-        if server_response.status == 204:
-            return True
+        return self._ProcessResponse(server_response, _DeleteResult)
+
+
+def _GzipCompress(data, level):
+    """ Returns data compressed in the gzip format. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _GetResult(server_response):
+    result_body = server_response.read()
+
+    if server_response.status == 200:
+        return json.loads(s = result_body, parse_int = True, parse_float = True)
+    else:
+      raise RequestError, {'status': server_response.status,
+          'reason': server_response.reason, 'body': result_body}
+
+
+def _PostOrPutResult(server_response):
+    result_body = server_response.read()
+
+    # Server returns 201 for most post requests, but when performing a batch
+    # request the server responds with a 200 on success.
+    if server_response.status == 201 or server_response.status == 200:
+        return json.loads(result_body)
+    else:
+        raise RequestError, {'status': server_response.status, 'reason': server_response.reason, 'body': result_body}
+
+
+def _DeleteResult(server_response):
+    result_body = server_response.read()
+
+    if server_response.status == 204:
+        return True
+    else:
+      raise RequestError, {'status': server_response.status,
+          'reason': server_response.reason, 'body': result_body}
+
+
+def _StreamResult(chunk_size, file_handle=None):
+    """Returns a result handler which streams a 200 response body.
+
+    The body is returned as an iterator of chunks or, if file_handle is
+    given, written to it.
+    """
+    def _Result(server_response):
+        if server_response.status != 200:
+            raise RequestError, {'status': server_response.status,
+              'reason': server_response.reason, 'body': server_response.read()}
+        if file_handle is not None:
+            return raws_json.CopyResponse(server_response, file_handle, chunk_size)
+        return raws_json.IterResponse(server_response, chunk_size)
+    return _Result
+
+
+def _EntriesResult(chunk_size):
+    """Returns a result handler which decodes the entries of a 200 feed
+    response while it is read."""
+    stream_result = _StreamResult(chunk_size)
+    def _Result(server_response):
+        chunks = stream_result(server_response)
+        return ({"entry":e} for e in raws_json.feed_parser.IterFeedEntries(chunks))
+    return _Result
+
+
+def _MediaResult(server_response):
+    if server_response.status != 200:
+        _RaiseRequestError(server_response)
+    content_length = server_response.getheader('Content-Length')
+    if content_length is not None and not server_response.getheader('Content-Encoding'):
+        content_length = int(content_length)
+    else:
+        content_length = None
+    return raws_json.MediaSource(file_handle=server_response,
+        content_type=server_response.getheader('Content-Type'), content_length=content_length)
+
+
+def _RaiseRequestError(server_response):
+    raise RequestError, {'status': server_response.status,
+        'reason': server_response.reason, 'body': server_response.read()}
+
+
+def _BodyResult(server_response):
+    result_body = server_response.read()
+
+    if server_response.status == 200:
+        return result_body
+    else:
+        raise RequestError, {'status': server_response.status,
+          'reason': server_response.reason, 'body': result_body}
+
+
+class AsyncRawsService(RawsService):
+    """A RawsService whose requests don't block.
+
+    All CRUD operations (Get, Post, Put, PostOrPut, Delete and Head) return a
+    raws_json.async_request.Future right away. The future completes with the
+    same result the blocking RawsService would have returned, or fails with
+    the same exception (eg. RequestError). Requests run on an EventLoop, so a
+    single thread can keep many of them in flight:
+
+        loop = raws_json.async_request.EventLoop()
+        rass = AsyncRassService(username, password, server, loop = loop)
+        exists = loop.run_until_complete(rass.itemExists(path))
+
+    Resumable uploads (PutResumable) and ranged downloads (DownloadFile)
+    wait for every chunk, they run on a thread of their own and their
+    future completes on the loop.
+
+    Takes the same arguments as the blocking service it is combined with,
+    plus loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Creates an object of type AsyncRawsService.
+
+        Args:
+          loop: raws_json.async_request.EventLoop (optional) The loop on which requests are run. Defaults to the loop of the current thread.
+        """
+        loop = kwargs.pop('loop', None)
+        super(AsyncRawsService, self).__init__(*args, **kwargs)
+        if kwargs.get('handler') is None:
+            self.handler = raws_json.async_request
+        self.loop = loop or raws_json.async_request.get_event_loop()
+
+    def _ProcessResponse(self, server_response, result_handler):
+        return server_response.then(result_handler)
+
+    def _CloseWhenDone(self, file_object, result):
+        # The loop uses the file until the future completes.
+        if result is None:
+            file_object.close()
         else:
-          raise RequestError, {'status': server_response.status,
-              'reason': server_response.reason, 'body': result_body}
+            result.add_done_callback(lambda future: file_object.close())
+
+    def DownloadFile(self, uri, file_path, *args, **kwargs):
+        """Runs RawsService.DownloadFile on a thread, with blocking requests, while the loop goes on.
+
+        Takes the same arguments as RawsService.DownloadFile. A progress is updated from that thread.
+
+        Returns:
+          A Future of the size of the downloaded file.
+        """
+        return self.loop.run_in_thread(RawsService.DownloadFile, self._Blocking(), uri, file_path, *args, **kwargs)
+
+    def PutResumable(self, uri, media_source, *args, **kwargs):
+        """Runs RawsService.PutResumable on a thread, with blocking requests, while the loop goes on.
+
+        Takes the same arguments as RawsService.PutResumable. A progress is updated from that thread.
+
+        Returns:
+          A Future of the decoded json entry returned by the server.
+        """
+        return self.loop.run_in_thread(RawsService.PutResumable, self._Blocking(), uri, media_source, *args, **kwargs)
+
+    def _Blocking(self):
+        """Returns a copy of the service whose requests block, for work run on a thread. It shares the connection pool, stats and limits of the service."""
+        service = copy.copy(self)
+        service.handler = raws_json
+        return service
+
+    def _CachedUpload(self, upload_cache, path, local_path, upload):
+        if upload_cache is None:
+            return upload()
+        # Hashing the file blocks, so the cache is used on threads rather than on the loop.
+        def _Looked((entry, fingerprint)):
+            if entry is not None:
+                return entry
+            return upload().then(lambda entry: _Store(entry, fingerprint))
+        def _Store(entry, fingerprint):
+            stored = self.loop.run_in_thread(upload_cache.store, self.server, path, fingerprint, entry)
+            return stored.then(lambda ignored: entry)
+        return self.loop.run_in_thread(upload_cache.lookup, self.server, path, local_path).then(_Looked)
 
 
 class Query(dict):
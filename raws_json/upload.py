@@ -0,0 +1,534 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 rambla.eu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resumable uploads of large files with Content-Range PUT requests.
+
+  The file is sent in chunks, each one a PUT request with a
+  'Content-Range: bytes first-last/total' header. The server answers a chunk
+  with 308 and a 'Range: bytes=0-last' header telling up to where the data
+  has been received, and with 200 or 201 once the upload is complete. A PUT
+  without body and with 'Content-Range: bytes */total' asks the server how
+  far an upload got.
+
+  UploadState: The confirmed offset of an upload, kept in a small state file
+       so an interrupted upload can be continued by a later run.
+  ResumableUpload: Uploads a MediaSource chunk by chunk, retrying failed
+       chunks with exponential backoff.
+  ParallelUpload: Uploads a MediaSource as several byte ranges at the same
+       time, and commits the file once all of them arrived.
+"""
+
+import httplib
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import raws_json
+
+# Number of bytes sent with each PUT request.
+DEFAULT_CHUNK_SIZE = 8 * 1048576
+
+# Statuses after which a chunk is sent again.
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+RANGE_REGEX = re.compile(r'bytes=(\d+)-(\d+)')
+
+# Header marking the PUT requests of a ParallelUpload, which must not
+# complete the upload on the server even if they happen to fill the file.
+PART_HEADER = 'X-Upload-Part'
+
+
+class UploadError(Exception):
+  """Raised when the server rejects part of an upload."""
+  pass
+
+
+class UploadState(object):
+  """The confirmed offset of a resumable upload.
+
+  With a path the state is also written to that file after every confirmed
+  chunk, and read back when the same upload (same uri and size) is started
+  again. Without a path it is only kept in memory.
+  """
+
+  def __init__(self, path=None):
+    self.path = path
+    self.uri = None
+    self.size = None
+    self.offset = 0
+    # (first, end) of the chunks a ParallelUpload got confirmed.
+    self.parts = []
+
+  def load(self, uri, size):
+    """Reads the offset stored for the upload of size bytes to uri.
+
+    Returns:
+      The offset at which the upload can continue, 0 if there is no usable
+      state.
+    """
+    self.uri = uri
+    self.size = size
+    self.offset = 0
+    self.parts = []
+    if self.path and os.path.exists(self.path):
+      try:
+        fd = open(self.path, 'rb')
+        try:
+          state = json.load(fd)
+        finally:
+          fd.close()
+      except (IOError, ValueError):
+        return 0
+      if state.get('uri') == uri and state.get('size') == size:
+        self.offset = int(state.get('offset', 0))
+        self.parts = [tuple(part) for part in state.get('parts', [])]
+    return self.offset
+
+  def save(self, offset):
+    self.offset = offset
+    self._Write()
+
+  def addPart(self, first, end):
+    """Records that bytes first up to end of a ParallelUpload arrived."""
+    self.parts.append((first, end))
+    self._Write()
+
+  def _Write(self):
+    if not self.path:
+      return
+    # The state is written to a new file which then replaces the old one,
+    # so a crash halfway leaves the previous state rather than a broken one.
+    directory = os.path.dirname(os.path.abspath(self.path))
+    (fd, temp_path) = tempfile.mkstemp(dir=directory,
+        prefix=os.path.basename(self.path) + '.')
+    try:
+      temp_file = os.fdopen(fd, 'wb')
+      try:
+        json.dump({'uri': self.uri, 'size': self.size, 'offset': self.offset,
+            'parts': self.parts}, temp_file)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+      finally:
+        temp_file.close()
+      _Replace(temp_path, self.path)
+    except:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise
+
+  def remove(self):
+    if self.path and os.path.exists(self.path):
+      os.remove(self.path)
+
+
+class FileRange(object):
+  """Read-only, file-like view of length bytes of a file from offset on.
+
+  A lock can be given when other threads read from the same file handle.
+  When the memory map of the file is given the range is read from it
+  instead, which needs no lock, and it is sent from views of the mapping.
+  """
+
+  def __init__(self, file_handle, offset, length, lock=None, mapping=None):
+    self.file_handle = file_handle
+    self.offset = offset
+    self.length = length
+    self.lock = lock
+    self.mapping = mapping
+    self._pos = 0
+
+  def read(self, size=-1):
+    left = self.length - self._pos
+    if size < 0 or size > left:
+      size = left
+    if size <= 0:
+      return ''
+    if self.mapping is not None:
+      start = self.offset + self._pos
+      self._pos += size
+      return self.mapping[start:start + size]
+    if self.lock is not None:
+      self.lock.acquire()
+    try:
+      self.file_handle.seek(self.offset + self._pos)
+      data = self.file_handle.read(size)
+    finally:
+      if self.lock is not None:
+        self.lock.release()
+    self._pos += len(data)
+    return data
+
+  def tell(self):
+    return self._pos
+
+  def seek(self, offset, whence=0):
+    if whence == 1:
+      offset += self._pos
+    elif whence == 2:
+      offset += self.length
+    self._pos = offset
+
+  def iterViews(self, size=raws_json.UPLOAD_CHUNK_SIZE):
+    """Yields the rest of the range as views of the mapping of at most size
+    bytes."""
+    while self._pos < self.length:
+      length = min(size, self.length - self._pos)
+      view = raws_json._MappedView(self.mapping, self.offset + self._pos,
+          length)
+      self._pos += length
+      yield view
+
+
+class ResumableUpload(object):
+  """Uploads a MediaSource with Content-Range PUT requests.
+
+  Every chunk is retried up to max_retries times when the connection fails,
+  the server answers with one of RETRY_STATUSES or it confirms none of the
+  chunk, waiting backoff, 2 *
+  backoff, 4 * backoff, ... seconds (at most max_backoff) in between. Before
+  a chunk is sent again the server is asked how much of it arrived, so the
+  upload continues from the last acknowledged byte.
+  """
+
+  def __init__(self, service, uri, media_source, state=None,
+      chunk_size=DEFAULT_CHUNK_SIZE, max_retries=5, backoff=1.0,
+      max_backoff=60.0, extra_headers=None, result_handler=None,
+      progress=None):
+    """Creates a new ResumableUpload.
+
+    Args:
+      service: raws_json.raws_service.RawsService through whose handler the
+               requests are made. The handler must block, so the service
+               can't be an AsyncRawsService.
+      uri: string The uri to which the file is PUT.
+      media_source: MediaSource The file to upload, its file_handle must be
+                    seekable and its content_length known.
+      state: UploadState (optional) Where the confirmed offset is kept.
+      chunk_size: int (optional) Number of bytes sent with each request.
+      max_retries: int (optional) Number of times a chunk is retried.
+      backoff: float (optional) Seconds waited before the first retry.
+      max_backoff: float (optional) Maximum number of seconds between two
+                   retries.
+      extra_headers: dict (optional) Headers added to every request.
+      result_handler: function (optional) Called with the final response,
+                      its result is returned by run().
+      progress: raws_json.TransferProgress or function (optional) Follows
+                the bytes confirmed by the server, see
+                raws_json.MakeProgress. Bytes confirmed by an earlier run
+                are skipped.
+    """
+    self.service = service
+    self.uri = uri
+    self.media_source = media_source
+    self.state = state or UploadState()
+    self.chunk_size = chunk_size
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.extra_headers = extra_headers or {}
+    self.result_handler = result_handler
+    self.size = int(media_source.content_length)
+    # The requests of the chunks count towards service.stats already.
+    self.progress = raws_json.MakeProgress(progress, 'upload', total=self.size)
+
+  def run(self):
+    """Uploads the rest of the file.
+
+    Returns:
+      The result of result_handler for the final response, or the response
+      itself if there is no result_handler.
+
+    Raises:
+      socket.error or httplib.HTTPException when a chunk still fails after
+      max_retries retries.
+    """
+    offset = self.state.load(self.uri, self.size)
+    # Only the server knows how much of an earlier run really arrived.
+    query = offset > 0 or self.size == 0
+    resumed = offset > 0
+    self.progress.start()
+    failures = 0
+    while True:
+      try:
+        if query:
+          response = self._Put('bytes */%d' % self.size, None, 0)
+        else:
+          length = min(self.chunk_size, self.size - offset)
+          response = self._Put(
+              'bytes %d-%d/%d' % (offset, offset + length - 1, self.size),
+              FileRange(self.media_source.file_handle, offset, length,
+                  mapping=self.media_source.mapping),
+              length)
+      except (socket.error, httplib.HTTPException):
+        failures += 1
+        if failures > self.max_retries:
+          raise
+        self._Wait(failures)
+        query = True
+        continue
+
+      if response.status == 308:
+        response.read()
+        confirmed = ConfirmedOffset(response)
+        if query and confirmed >= self.size:
+          # Everything arrived, but the server doesn't consider the upload
+          # complete.
+          failures += 1
+          if failures > self.max_retries:
+            return self._Result(response)
+          self._Wait(failures)
+          continue
+        if confirmed > offset:
+          failures = 0
+        elif not query:
+          # The server took none of the chunk, or even lost earlier bytes.
+          failures += 1
+          if failures > self.max_retries:
+            return self._Result(response)
+          self._Wait(failures)
+        offset = confirmed
+        self.state.save(offset)
+        if resumed:
+          self.progress.skip(offset)
+          resumed = False
+        elif offset > self.progress.bytes:
+          self.progress.update(offset - self.progress.bytes)
+        query = offset >= self.size
+        continue
+
+      if response.status in RETRY_STATUSES:
+        response.read()
+        failures += 1
+        if failures > self.max_retries:
+          return self._Result(response)
+        self._Wait(failures)
+        query = True
+        continue
+
+      if response.status in (200, 201):
+        self.state.remove()
+        if self.size > self.progress.bytes:
+          self.progress.update(self.size - self.progress.bytes)
+      self.progress.finish()
+      return self._Result(response)
+
+  def _Put(self, content_range, data, length, part=False):
+    headers = dict(self.extra_headers)
+    headers['Content-Range'] = content_range
+    if part:
+      headers[PART_HEADER] = '1'
+    headers['Content-Length'] = str(length)
+    return self.service.handler.HttpRequest(self.service, 'PUT', data,
+        self.uri, extra_headers=headers,
+        content_type=self.media_source.content_type)
+
+  def _Result(self, response):
+    if self.result_handler is not None:
+      return self.result_handler(response)
+    return response
+
+  def _Wait(self, failures):
+    time.sleep(min(self.backoff * 2 ** (failures - 1), self.max_backoff))
+
+
+class ParallelUpload(ResumableUpload):
+  """Uploads a MediaSource as several byte ranges at the same time.
+
+  The file is cut in chunks of chunk_size bytes, which are divided in
+  streams consecutive ranges. Each range is sent by its own thread over its
+  own pooled connection, chunk by chunk, retrying failed chunks like
+  ResumableUpload does. Those requests carry the PART_HEADER, so the server
+  doesn't complete the upload. Once every chunk is confirmed the upload is
+  committed with a single 'bytes */total' PUT: the file either appears
+  whole or not at all.
+
+  Confirmed chunks are recorded in the UploadState, and skipped when the
+  upload is run again.
+  """
+
+  def __init__(self, service, uri, media_source, streams=4, progress=None,
+      **kwargs):
+    """Creates a new ParallelUpload.
+
+    Args:
+      streams: int (optional) Number of ranges sent at the same time.
+      progress: raws_json.TransferProgress or function (optional) Updated
+                whenever a chunk is confirmed, from the upload threads.
+
+    The other arguments are those of ResumableUpload.
+    """
+    ResumableUpload.__init__(self, service, uri, media_source,
+        progress=progress, **kwargs)
+    self.streams = streams
+    self._lock = threading.Lock()
+    self._file_lock = threading.Lock()
+    self._confirmed = 0
+    self._failed = False
+
+  def run(self):
+    """Uploads the chunks which aren't confirmed yet and commits the file.
+
+    Returns:
+      The result of result_handler for the response to the commit, or the
+      response itself if there is no result_handler.
+
+    Raises:
+      socket.error or httplib.HTTPException when a chunk still fails after
+      max_retries retries, or UploadError (or the error raised by
+      result_handler) when the server rejects a chunk.
+    """
+    self.state.load(self.uri, self.size)
+    chunks = []
+    self._confirmed = self.size
+    for (first, end) in MissingRanges(self.size, self.state.parts):
+      self._confirmed -= end - first
+      for chunk_first in xrange(first, end, self.chunk_size):
+        chunks.append((chunk_first, min(chunk_first + self.chunk_size, end)))
+    self.progress.start()
+    self.progress.skip(self._confirmed)
+    streams = max(1, min(self.streams, len(chunks)))
+    count = len(chunks)
+    ranges = [chunks[i * count // streams:(i + 1) * count // streams]
+        for i in xrange(streams)]
+
+    if chunks:
+      pool = ThreadPool(streams)
+      try:
+        pool.map(self._SendRange, ranges)
+      finally:
+        pool.close()
+        pool.join()
+    return self._Commit()
+
+  def _SendRange(self, chunks):
+    if self.media_source.mapping is not None:
+      # Every thread reads its ranges from the one mapping.
+      file_handle = self.media_source.file_handle
+      lock = None
+    elif self.media_source.file_path:
+      file_handle = open(self.media_source.file_path, 'rb')
+      lock = None
+    else:
+      file_handle = self.media_source.file_handle
+      lock = self._file_lock
+    try:
+      for (first, end) in chunks:
+        if self._failed:
+          return
+        try:
+          self._SendChunk(FileRange(file_handle, first, end - first, lock,
+              self.media_source.mapping),
+              first, end)
+        except:
+          self._failed = True
+          raise
+        with self._lock:
+          self.state.addPart(first, end)
+          self._confirmed += end - first
+        self.progress.update(end - first)
+    finally:
+      if file_handle is not self.media_source.file_handle:
+        file_handle.close()
+
+  def _SendChunk(self, data, first, end):
+    failures = 0
+    while True:
+      try:
+        data.seek(0)
+        response = self._Put('bytes %d-%d/%d' % (first, end - 1, self.size),
+            data, end - first, part=True)
+      except (socket.error, httplib.HTTPException):
+        failures += 1
+        if failures > self.max_retries or self._failed:
+          raise
+        self._Wait(failures)
+        continue
+      if response.status in (200, 201, 308):
+        response.read()
+        return
+      if response.status in RETRY_STATUSES and failures < self.max_retries:
+        response.read()
+        failures += 1
+        self._Wait(failures)
+        continue
+      self._Reject(response)
+
+  def _Commit(self):
+    failures = 0
+    while True:
+      try:
+        response = self._Put('bytes */%d' % self.size, None, 0)
+      except (socket.error, httplib.HTTPException):
+        failures += 1
+        if failures > self.max_retries:
+          raise
+        self._Wait(failures)
+        continue
+      if response.status in RETRY_STATUSES and failures < self.max_retries:
+        response.read()
+        failures += 1
+        self._Wait(failures)
+        continue
+      if response.status in (200, 201):
+        self.state.remove()
+        self.progress.finish()
+        return self._Result(response)
+      self._Reject(response)
+
+  def _Reject(self, response):
+    if self.result_handler is not None:
+      self.result_handler(response)
+    raise UploadError({'status': response.status, 'reason': response.reason,
+        'body': response.read()})
+
+
+def _Replace(source, target):
+  """Renames source to target, which is replaced if it exists."""
+  try:
+    os.rename(source, target)
+  except OSError:
+    # Windows doesn't rename over an existing file.
+    if not os.path.exists(target):
+      raise
+    os.remove(target)
+    os.rename(source, target)
+
+
+def MissingRanges(size, parts):
+  """Returns the (first, end) ranges of size bytes not covered by parts."""
+  missing = []
+  offset = 0
+  for (first, end) in sorted(parts):
+    if first > offset:
+      missing.append((offset, first))
+    offset = max(offset, end)
+  if offset < size:
+    missing.append((offset, size))
+  return missing
+
+
+def ConfirmedOffset(response):
+  """Returns the number of bytes the server confirmed in a 308 response."""
+  match = RANGE_REGEX.match(response.getheader('Range') or '')
+  if match is None:
+    return 0
+  return int(match.group(2)) + 1
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 rambla.eu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local record of uploaded files, to skip uploading unchanged files again.
+
+  UploadCache: sqlite database which maps (server, path on the server) to
+       the size, modification time and content hash of the local file last
+       uploaded there, and to the entry the server returned for it. An
+       upload of the same bytes to the same path can then be skipped.
+
+Example:
+  cache = UploadCache('~/.raws_uploads.db')
+  rass.createItem(dirpath, filename, local_path, upload_cache = cache)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+import raws_json
+
+# Files of at least this many bytes are hashed on a thread of their own
+# while they are uploaded.
+THREAD_THRESHOLD = 1048576
+
+
+class UploadCache(object):
+  """Remembers which files were uploaded to which paths.
+
+  A file is known to be unchanged when its size and modification time are
+  those recorded after its last upload. When only its modification time
+  changed (eg. the file was copied or written again), its content hash
+  decides. A file which has to be uploaded is hashed on a thread while it
+  is being sent, rather than read once more before the upload starts.
+  hashlib releases the GIL, so several files are hashed at the same time.
+
+  The cache only knows what was uploaded through it. When files are removed
+  from the server in some other way, forget() their paths.
+  """
+
+  def __init__(self, path, algorithm='md5', threads=4,
+      thread_threshold=THREAD_THRESHOLD):
+    """Creates a new UploadCache.
+
+    Args:
+      path: string Location of the sqlite database, created if needed.
+      algorithm: string (optional) Name of the hashlib algorithm used.
+      threads: int (optional) Maximum number of files hashed at the same
+               time.
+      thread_threshold: int (optional) Smaller files are hashed in the
+                        calling thread.
+    """
+    self.path = os.path.expanduser(path)
+    self.algorithm = algorithm
+    self.thread_threshold = thread_threshold
+    self._hashing = threading.Semaphore(threads)
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(self.path, check_same_thread=False)
+    self._db.execute('CREATE TABLE IF NOT EXISTS uploads ('
+        'server TEXT, path TEXT, size INTEGER, mtime REAL, algorithm TEXT, '
+        'digest TEXT, entry TEXT, PRIMARY KEY (server, path))')
+    self._db.commit()
+
+  def lookup(self, server, path, local_path):
+    """Checks if local_path was uploaded to path before.
+
+    Only a file with the recorded size but another modification time is
+    hashed before this returns. This can take a while for big files, the
+    AsyncRawsService calls it on a thread.
+
+    Args:
+      server: string Name of the server.
+      path: string Location of the upload on the server.
+      local_path: string The file to upload.
+
+    Returns:
+      A tuple (entry, fingerprint). entry is the decoded result of the
+      earlier upload if it had the same content, None otherwise.
+      fingerprint describes the file and is passed to store() after it has
+      been uploaded. The hash in it may still be computed meanwhile.
+    """
+    stat = os.stat(local_path)
+    with self._lock:
+      row = self._db.execute('SELECT size, mtime, algorithm, digest, entry '
+          'FROM uploads WHERE server = ? AND path = ?', (server, path)
+          ).fetchone()
+    if row is not None and row[0] == stat.st_size and \
+        row[2] == self.algorithm:
+      if row[1] == stat.st_mtime:
+        return (json.loads(row[4]), (stat.st_size, stat.st_mtime, row[3]))
+      digest = self.digest(local_path)
+      if digest == row[3]:
+        # Same bytes with a new modification time.
+        self.store(server, path, (stat.st_size, stat.st_mtime, digest),
+            json.loads(row[4]))
+        return (json.loads(row[4]), (stat.st_size, stat.st_mtime, digest))
+    elif stat.st_size < self.thread_threshold:
+      digest = self.digest(local_path)
+    else:
+      digest = _Digest(self, local_path)
+    return (None, (stat.st_size, stat.st_mtime, digest))
+
+  def store(self, server, path, fingerprint, entry):
+    """Records that the file with fingerprint was uploaded to path.
+
+    Args:
+      server: string Name of the server.
+      path: string Location of the upload on the server.
+      fingerprint: tuple As returned by lookup().
+      entry: The decoded result of the upload.
+    """
+    (size, mtime, digest) = fingerprint
+    if isinstance(digest, _Digest):
+      digest = digest.result()
+    with self._lock:
+      self._db.execute('INSERT OR REPLACE INTO uploads VALUES '
+          '(?, ?, ?, ?, ?, ?, ?)', (server, path, size, mtime,
+              self.algorithm, digest, json.dumps(entry)))
+      self._db.commit()
+
+  def forget(self, server, path):
+    """Removes what is known about the upload to path."""
+    with self._lock:
+      self._db.execute('DELETE FROM uploads WHERE server = ? AND path = ?',
+          (server, path))
+      self._db.commit()
+
+  def digest(self, local_path):
+    """Returns the hex digest of the content of local_path."""
+    with self._hashing:
+      return FileDigest(local_path, self.algorithm)
+
+  def close(self):
+    """Closes the database."""
+    with self._lock:
+      self._db.close()
+
+
+class _Digest(object):
+  """The digest of a file, computed on a thread of its own."""
+
+  def __init__(self, cache, local_path):
+    self._value = None
+    self._exc_info = None
+    self._done = threading.Event()
+    thread = threading.Thread(target=self._Run, args=(cache, local_path))
+    thread.daemon = True
+    thread.start()
+
+  def _Run(self, cache, local_path):
+    try:
+      self._value = cache.digest(local_path)
+    except Exception:
+      self._exc_info = sys.exc_info()
+    self._done.set()
+
+  def done(self):
+    return self._done.is_set()
+
+  def result(self):
+    """Waits for the hex digest, or raises the error of reading the file."""
+    self._done.wait()
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._value
+
+
+def FileDigest(local_path, algorithm='md5'):
+  """Returns the hex digest of a file, read a chunk at a time."""
+  digest = hashlib.new(algorithm)
+  fd = open(local_path, 'rb')
+  try:
+    while True:
+      data = fd.read(raws_json.UPLOAD_CHUNK_SIZE)
+      if not data:
+        break
+      digest.update(data)
+  finally:
+    fd.close()
+  return digest.hexdigest()
@@ -0,0 +1,408 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 rambla.eu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stand-in RAWS server for the tests, on a local port.
+
+  StandInServer: Serves the files in its files dict with HEAD and GET,
+       including Range and If-Range, and accepts uploads: plain POST and PUT
+       bodies (also chunked or gzip encoded) are answered with their length
+       and md5, PUTs with a Content-Range are collected like a resumable
+       upload (308 until complete, then 201). Every request is logged.
+
+Example:
+  server = StandInServer()
+  server.files['/item/a.bin'] = 'data'
+  service.port = server.port
+  ...
+  server.stop()
+
+  TunnelProxy: Answers CONNECT requests by relaying the connection to the
+       requested host, like an https proxy does. With https=True the
+       StandInServer speaks TLS with the certificate in keycert.pem, so
+       requests to it can go through such a tunnel.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import gzip
+import hashlib
+import json
+import os
+import re
+import select
+import socket
+import ssl
+import sys
+import threading
+
+CONTENT_RANGE_REGEX = re.compile(r'bytes (\*|(\d+)-(\d+))/(\d+|\*)')
+RANGE_REGEX = re.compile(r'bytes=(\d+)-(\d*)')
+# Self-signed certificate and key for localhost.
+CERTIFICATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'keycert.pem')
+
+
+class _Background:
+  """Runs a threading server on a thread of its own until stop()."""
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def _Start(self):
+    self.port = self.server_address[1]
+    self.sockets = []
+    self.lock = threading.Lock()
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+    # Ends the handler threads waiting on keep-alive connections.
+    with self.lock:
+      sockets = list(self.sockets)
+    for sock in sockets:
+      try:
+        sock.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+
+  def process_request(self, request, client_address):
+    with self.lock:
+      self.sockets.append(request)
+    SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+  def handle_error(self, request, client_address):
+    # Clients which close a connection halfway are part of the tests.
+    if not isinstance(sys.exc_info()[1], socket.error):
+      SocketServer.TCPServer.handle_error(self, request, client_address)
+
+
+class StandInServer(_Background, SocketServer.ThreadingMixIn,
+    BaseHTTPServer.HTTPServer):
+  """HTTP/1.1 server with keep-alive, run on a thread of its own.
+
+  Attributes the tests can change:
+    files: dict path -> data served by GET and HEAD.
+    etags: dict path -> ETag of the file, a hash of its data by default.
+    drop_puts: int Number of Content-Range PUTs cut off halfway.
+    busy_puts: int Number of Content-Range PUTs answered with 503.
+    stall_puts: int Number of Content-Range PUTs answered with a 308 without
+                Range, their data isn't kept.
+    drop_posts: int Number of POSTs on a reused connection which get the
+                connection closed instead of an answer, like when it was
+                idle too long.
+    drop_gets: int The same for GETs.
+    gzip_responses: bool Compress json responses if the client accepts it.
+    corrupt_gzip: bool Send compressed responses with an invalid block.
+    log: list of (method, path, headers, body length) of the requests.
+    bodies: dict path -> the last plain POST or PUT body sent to it.
+  """
+
+  def __init__(self, https=False):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+    self.ssl_context = None
+    if https:
+      self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+      self.ssl_context.load_cert_chain(CERTIFICATE)
+    self.files = {}
+    self.etags = {}
+    self.uploads = {}
+    self.drop_puts = 0
+    self.busy_puts = 0
+    self.stall_puts = 0
+    self.drop_posts = 0
+    self.drop_gets = 0
+    self.gzip_responses = False
+    self.corrupt_gzip = False
+    self.connections = 0
+    self.log = []
+    self.bodies = {}
+    self._Start()
+
+  def etag(self, path):
+    if path in self.etags:
+      return self.etags[path]
+    return '"%s"' % hashlib.md5(self.files[path]).hexdigest()
+
+  def uploaded(self, path):
+    """Returns the bytes of a completed Content-Range upload to path."""
+    return self.uploads[path].get('data')
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    if self.server.ssl_context is not None:
+      self.request = self.server.ssl_context.wrap_socket(self.request,
+          server_side=True)
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.requests = 0
+    with self.server.lock:
+      self.server.connections += 1
+
+  def handle_one_request(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+    self.requests += 1
+
+  def log_message(self, *args):
+    pass
+
+  def do_HEAD(self):
+    self._Log(0)
+    if self.path in self.server.files:
+      self._File(self.server.files[self.path], False)
+    else:
+      self._Json(404, {'error': 'not found'})
+
+  def do_GET(self):
+    if self._Dropped('drop_gets'):
+      return
+    self._Log(0)
+    if self.path in self.server.files:
+      self._File(self.server.files[self.path], True)
+    elif self.path.startswith('/missing'):
+      self._Json(404, {'error': 'not found'})
+    else:
+      entries = [{'entry': {'id': str(i), 'path': self.path}}
+          for i in xrange(200)]
+      self._Json(200, {'feed': {'entry': entries}})
+
+  def do_POST(self):
+    if self._Dropped('drop_posts'):
+      return
+    body = self._Body()
+    self._Log(len(body))
+    self.server.bodies[self.path] = body
+    self._Json(201, _Entry(body, self.headers))
+
+  def do_PUT(self):
+    content_range = self.headers.get('Content-Range')
+    if content_range is None:
+      body = self._Body()
+      self._Log(len(body))
+      self.server.bodies[self.path] = body
+      self._Json(201, _Entry(body, self.headers))
+      return
+    length = int(self.headers.get('Content-Length') or 0)
+    with self.server.lock:
+      drop = self.server.drop_puts > 0 and not content_range.startswith(
+          'bytes */')
+      busy = not drop and self.server.busy_puts > 0
+      stall = not drop and not busy and self.server.stall_puts > 0 and \
+          not content_range.startswith('bytes */')
+      if drop:
+        self.server.drop_puts -= 1
+      elif busy:
+        self.server.busy_puts -= 1
+      elif stall:
+        self.server.stall_puts -= 1
+    if drop:
+      self.rfile.read(length // 2)
+      self._Log(length // 2)
+      self.close_connection = 1
+      return
+    body = self.rfile.read(length)
+    self._Log(len(body))
+    if busy:
+      self._Json(503, {'error': 'busy'})
+      return
+    if stall:
+      self.send_response(308)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    match = CONTENT_RANGE_REGEX.match(content_range)
+    total = int(match.group(4))
+    with self.server.lock:
+      upload = self.server.uploads.setdefault(self.path, {'parts': {}})
+      if match.group(1) != '*':
+        upload['parts'][int(match.group(2))] = body
+      received = 0
+      for (offset, data) in sorted(upload['parts'].items()):
+        if offset <= received:
+          received = max(received, offset + len(data))
+      if received >= total and (match.group(1) == '*' or
+          not self.headers.get('X-Upload-Part')):
+        data = ''
+        for (offset, part) in sorted(upload['parts'].items()):
+          data = data[:offset] + part + data[offset + len(part):]
+        upload['data'] = data[:total]
+    if received >= total and 'data' in upload:
+      self._Json(201, {'entry': {'len': total,
+          'md5': hashlib.md5(upload['data']).hexdigest()}})
+      return
+    self.send_response(308)
+    if received:
+      self.send_header('Range', 'bytes=0-%d' % (received - 1))
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def _Dropped(self, counter):
+    """Closes a reused connection without an answer while the server
+    attribute counter is above 0."""
+    with self.server.lock:
+      drop = self.requests > 0 and getattr(self.server, counter) > 0
+      if drop:
+        setattr(self.server, counter, getattr(self.server, counter) - 1)
+    if drop:
+      self.close_connection = 1
+      self.connection.shutdown(socket.SHUT_RDWR)
+    return drop
+
+  def _Log(self, length):
+    with self.server.lock:
+      self.server.log.append((self.command, self.path, dict(self.headers),
+          length))
+
+  def _Body(self):
+    if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+      parts = []
+      while True:
+        size = int(self.rfile.readline().split(';')[0].strip(), 16)
+        if not size:
+          self.rfile.readline()
+          break
+        parts.append(self.rfile.read(size))
+        self.rfile.readline()
+      body = ''.join(parts)
+    else:
+      body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    if self.headers.get('Content-Encoding') == 'gzip':
+      body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+    return body
+
+  def _File(self, data, send_body):
+    etag = self.server.etag(self.path)
+    (first, last) = (0, len(data) - 1)
+    status = 200
+    match = RANGE_REGEX.match(self.headers.get('Range') or '')
+    if_range = self.headers.get('If-Range')
+    if match is not None and (if_range is None or if_range == etag):
+      first = int(match.group(1))
+      if match.group(2):
+        last = min(last, int(match.group(2)))
+      if first >= len(data):
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % len(data))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      status = 206
+    self.send_response(status)
+    self.send_header('ETag', etag)
+    self.send_header('Accept-Ranges', 'bytes')
+    if status == 206:
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last,
+          len(data)))
+    self.send_header('Content-Length', str(last - first + 1))
+    self.end_headers()
+    if send_body:
+      self.wfile.write(data[first:last + 1])
+
+  def _Json(self, status, value):
+    body = json.dumps(value)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    if self.server.gzip_responses and 'gzip' in self.headers.get(
+        'Accept-Encoding', ''):
+      buf = StringIO.StringIO()
+      compressed = gzip.GzipFile(fileobj=buf, mode='wb')
+      compressed.write(body)
+      compressed.close()
+      body = buf.getvalue()
+      if self.server.corrupt_gzip:
+        # A deflate block of the reserved type, right after the gzip header.
+        body = body[:10] + '\xff' + body[11:]
+      self.send_header('Content-Encoding', 'gzip')
+    if self.path.startswith('/chunked'):
+      self.send_header('Transfer-Encoding', 'chunked')
+      self.end_headers()
+      for offset in xrange(0, len(body), 100):
+        piece = body[offset:offset + 100]
+        self.wfile.write('%x\r\n%s\r\n' % (len(piece), piece))
+      self.wfile.write('0\r\n\r\n')
+      return
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(body)
+
+
+class TunnelProxy(_Background, SocketServer.ThreadingMixIn,
+    SocketServer.TCPServer):
+  """Proxy which opens tunnels with CONNECT, run on a thread of its own.
+
+  Attributes the tests can change:
+    refuse: string Status, eg. '407 Proxy Authentication Required', with
+            which CONNECT requests are answered instead of opening a tunnel.
+    log: list of (host:port, headers) of the CONNECT requests, the header
+         names are lowercase.
+  """
+
+  def __init__(self):
+    SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), _TunnelHandler)
+    self.refuse = None
+    self.log = []
+    self._Start()
+
+
+class _TunnelHandler(SocketServer.StreamRequestHandler):
+
+  # Nothing past the CONNECT request may be buffered, it belongs to the
+  # tunnel.
+  rbufsize = 0
+
+  def handle(self):
+    (method, target) = self.rfile.readline().split()[:2]
+    headers = {}
+    while True:
+      line = self.rfile.readline().strip()
+      if not line:
+        break
+      (name, value) = line.split(':', 1)
+      headers[name.strip().lower()] = value.strip()
+    with self.server.lock:
+      self.server.log.append((target, headers))
+    if method != 'CONNECT' or self.server.refuse:
+      self.wfile.write('HTTP/1.0 %s\r\n\r\n' % (self.server.refuse or
+          '405 Method Not Allowed'))
+      return
+    (host, port) = target.rsplit(':', 1)
+    upstream = socket.create_connection((host, int(port)))
+    try:
+      self.wfile.write('HTTP/1.0 200 Connection established\r\n\r\n')
+      peers = {self.connection: upstream, upstream: self.connection}
+      while True:
+        for sock in select.select(peers.keys(), [], [])[0]:
+          data = sock.recv(65536)
+          if not data:
+            return
+          peers[sock].sendall(data)
+    finally:
+      upstream.close()
+
+
+def _Entry(body, headers):
+  return {'entry': {'len': len(body), 'md5': hashlib.md5(body).hexdigest(),
+      'content_type': headers.get('Content-Type'),
+      'authorization': headers.get('Authorization'),
+      'transfer_encoding': headers.get('Transfer-Encoding')}}
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of the non-blocking request handler."""
+
+import hashlib
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import raws_json
+import raws_json.async_request
+from raws_json.rass.service import AsyncRassService
+from tests.server import StandInServer
+
+
+class AsyncResponseTest(unittest.TestCase):
+
+  def testIterResponseStoppedEarly(self):
+    response = raws_json.async_request.AsyncResponse(200, 'OK', [], 'x' * 10)
+    chunks = raws_json.IterResponse(response, 4)
+    self.assertEqual(chunks.next(), 'xxxx')
+    chunks.close()
+    self.assertTrue(response.isclosed())
+
+
+class EventLoopTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.loop = raws_json.async_request.EventLoop()
+    self.rass = AsyncRassService('u', 'p', '127.0.0.1', loop=self.loop)
+    self.rass.port = self.server.port
+
+  def tearDown(self):
+    self.loop.close()
+    self.server.stop()
+
+  def testRequestsShareConnections(self):
+    futures = [self.rass.Get('/dir/%d/' % i) for i in xrange(3)]
+    feeds = self.loop.run_until_complete(
+        raws_json.async_request.gather(futures))
+    self.assertEqual([len(feed['feed']['entry']) for feed in feeds], [200] * 3)
+    self.loop.run_until_complete(self.rass.Get('/dir/'))
+    self.assertEqual(self.loop.counts()['reused'], 1)
+
+  def testRetryOnClosedConnectionSendsWholeBody(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'up.bin')
+      data = os.urandom(1500000)
+      fd = open(path, 'wb')
+      fd.write(data)
+      fd.close()
+      # Slow enough for the server to close the connection halfway through
+      # the body, a request which was sent completely isn't sent again.
+      self.rass.upload_limit = raws_json.BandwidthLimiter(10000000,
+          burst=0.01)
+      for i in xrange(3):
+        self.loop.run_until_complete(self.rass.Get('/dir/'))
+        self.server.drop_posts = 1
+        future = self.rass.Post(None, '/item/d/',
+            media_source=raws_json.MediaSource(file_path=path))
+        entry = self.loop.run_until_complete(future, timeout=5)['entry']
+        self.assertEqual(entry['md5'], hashlib.md5(data).hexdigest())
+    finally:
+      shutil.rmtree(directory)
+
+  def testRunInThread(self):
+    future = self.loop.run_in_thread(lambda a, b: a + b, 1, 2)
+    self.assertEqual(self.loop.run_until_complete(future), 3)
+    future = self.loop.run_in_thread(int, 'x')
+    self.assertRaises(ValueError, self.loop.run_until_complete, future)
+
+  def testConnectFallsBackToNextAddress(self):
+    # Nothing listens on 127.0.0.2, the second address is used.
+    self.rass.server = 'rass.test'
+    self.rass.dns_cache = raws_json.DnsCache()
+    self.rass.dns_cache.pin('rass.test', ['127.0.0.2', '127.0.0.1'])
+    feed = self.loop.run_until_complete(self.rass.Get('/dir/'))
+    self.assertEqual(len(feed['feed']['entry']), 200)
+
+  def testConnectFailsWhenNoAddressAnswers(self):
+    self.rass.server = 'rass.test'
+    self.rass.dns_cache = raws_json.DnsCache()
+    self.rass.dns_cache.pin('rass.test', ['127.0.0.2', '127.0.0.3'])
+    self.assertRaises(socket.error, self.loop.run_until_complete,
+        self.rass.Get('/dir/'))
+
+
+if __name__ == '__main__':
+  unittest.main()
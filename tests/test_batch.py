@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of RawsService.batch() and map()."""
+
+import itertools
+import json
+import threading
+import time
+import unittest
+
+from raws_json.raws_service import RequestError
+from raws_json.rass.service import RassService
+from tests.server import StandInServer
+
+
+class MapTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rass = RassService(server='127.0.0.1')
+
+  def testOrderedResultsFollowArguments(self):
+    def _Sleep(delay):
+      time.sleep(delay)
+      return delay * 10
+    delays = [0.2, 0.0, 0.1, 0.0, 0.05]
+    results = list(self.rass.map(_Sleep, delays, max_workers=4))
+    self.assertEqual([result.index for result in results], range(5))
+    self.assertEqual([result.request for result in results], delays)
+    self.assertEqual([result.result for result in results],
+        [delay * 10 for delay in delays])
+
+  def testUnorderedResultsComeAsTheyFinish(self):
+    release = threading.Event()
+    def _Wait(argument):
+      if argument == 'slow':
+        release.wait(5)
+      return argument
+    results = self.rass.map(_Wait, ['slow', 'fast'], max_workers=2,
+        ordered=False)
+    self.assertEqual(results.next().result, 'fast')
+    release.set()
+    self.assertEqual(results.next().result, 'slow')
+    self.assertRaises(StopIteration, results.next)
+
+  def testErrorsAreStoredAndDontStopTheRest(self):
+    def _Invert(number):
+      return 1.0 / number
+    results = list(self.rass.map(_Invert, [1, 0, 2], max_workers=2))
+    self.assertEqual([result.result for result in results], [1.0, None, 0.5])
+    self.assertTrue(isinstance(results[1].error, ZeroDivisionError))
+    self.assertEqual(results[0].error, None)
+
+  def testArgumentsAreReadInBoundedWindows(self):
+    read = []
+    def _Arguments():
+      for number in itertools.count():
+        read.append(number)
+        yield number
+    results = self.rass.map(lambda number: number, _Arguments(), max_workers=2)
+    for expected in xrange(10):
+      self.assertEqual(results.next().result, expected)
+      self.assertTrue(len(read) <= expected + 1 + 4, len(read))
+    results.close()
+
+  def testErrorOfArgumentsIsRaised(self):
+    def _Arguments():
+      yield 1
+      raise KeyError('arguments')
+    results = self.rass.map(lambda number: number, _Arguments())
+    self.assertRaises(KeyError, list, results)
+
+
+class BatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.server.files['/file'] = 'data'
+    self.rass = RassService(server='127.0.0.1')
+    self.rass.port = self.server.port
+
+  def tearDown(self):
+    self.server.stop()
+
+  def testRequestsOfAllVerbs(self):
+    requests = [('GET', '/dir/'), ('head', '/file'), ('POST', '/item/x', {'a': 1}),
+        ('PUT', '/item/y', {'b': 2}), ('GET', '/missing'), ('PATCH', '/item/x')]
+    results = list(self.rass.batch(requests, max_workers=3))
+    self.assertEqual([result.request for result in results], requests)
+    self.assertEqual(len(results[0].result['feed']['entry']), 200)
+    self.assertEqual(results[1].result.status, 200)
+    self.assertEqual(json.loads(self.server.bodies['/item/x']), {'a': 1})
+    self.assertEqual(json.loads(self.server.bodies['/item/y']), {'b': 2})
+    self.assertTrue(isinstance(results[4].error, RequestError))
+    self.assertTrue(isinstance(results[5].error, ValueError))
+    self.assertEqual(sorted(entry[0] for entry in self.server.log),
+        ['GET', 'GET', 'HEAD', 'POST', 'PUT'])
+
+  def testUnorderedBatchReturnsEveryRequest(self):
+    requests = [('GET', '/dir/%d' % i) for i in xrange(20)]
+    results = list(self.rass.batch(requests, max_workers=4, ordered=False))
+    self.assertEqual(sorted(result.index for result in results), range(20))
+    for result in results:
+      self.assertEqual(result.result['feed']['entry'][0]['entry']['path'],
+          requests[result.index][1])
+
+
+if __name__ == '__main__':
+  unittest.main()
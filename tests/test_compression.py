@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of compressed responses, which are decoded while they stream in, and
+of compressed request bodies."""
+
+import json
+import StringIO
+import unittest
+import zlib
+
+import raws_json
+import raws_json.async_request
+from raws_json.raws_service import _GzipCompress
+from raws_json.rass.service import RassService, AsyncRassService
+from tests.server import StandInServer
+
+
+class CompressedResponseTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.server.gzip_responses = True
+    self.rass = RassService('u', 'p', '127.0.0.1')
+    self.rass.port = self.server.port
+
+  def tearDown(self):
+    self.server.stop()
+
+  def _AcceptEncoding(self):
+    return self.server.log[-1][2].get('accept-encoding', '')
+
+  def testFeedIsDecoded(self):
+    feed = self.rass.Get('/dir/')
+    self.assertEqual(len(feed['feed']['entry']), 200)
+    self.assertTrue('gzip' in self._AcceptEncoding())
+
+  def testChunkedStreamIsDecodedPieceByPiece(self):
+    chunks = list(self.rass.GetStream('/chunked/dir/', chunk_size=512))
+    self.assertTrue(len(chunks) > 1)
+    self.assertTrue(max([len(chunk) for chunk in chunks]) <= 512)
+    feed = json.loads(''.join(chunks))
+    self.assertEqual(feed['feed']['entry'][199]['entry']['id'], '199')
+
+  def testEntriesOfChunkedFeed(self):
+    entries = list(self.rass.GetEntries('/chunked/dir/', chunk_size=100))
+    self.assertEqual([entry['entry']['entry']['id'] for entry in entries],
+        [str(i) for i in xrange(200)])
+
+  def testUncompressedWhenDisabled(self):
+    self.rass.compress_responses = False
+    self.assertEqual(len(self.rass.Get('/dir/')['feed']['entry']), 200)
+    self.assertFalse('gzip' in self._AcceptEncoding())
+
+  def testAsyncFeedIsDecoded(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    feed = loop.run_until_complete(rass.Get('/chunked/dir/'))
+    self.assertEqual(len(feed['feed']['entry']), 200)
+    self.assertTrue('gzip' in self._AcceptEncoding())
+
+  def testCorruptBodyFails(self):
+    self.server.corrupt_gzip = True
+    self.assertRaises(zlib.error, self.rass.Get, '/dir/')
+
+  def testAsyncCorruptBodyFails(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    self.server.corrupt_gzip = True
+    self.assertRaises(zlib.error, loop.run_until_complete, rass.Get('/dir/'),
+        timeout=5)
+    self.server.corrupt_gzip = False
+    feed = loop.run_until_complete(rass.Get('/dir/'), timeout=5)
+    self.assertEqual(len(feed['feed']['entry']), 200)
+    self.assertEqual(loop.counts()['reused'], 1)
+
+
+class CompressedRequestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.rass = RassService('u', 'p', '127.0.0.1')
+    self.rass.port = self.server.port
+    self.rass.compress_requests = True
+    self.entry = {'name': 'item', 'tags': ['tag%d' % i for i in xrange(1000)]}
+
+  def tearDown(self):
+    self.server.stop()
+
+  def _Headers(self):
+    return self.server.log[-1][2]
+
+  def testLargeEntryIsCompressed(self):
+    self.rass.Post(self.entry, '/item/x')
+    data = json.dumps(self.entry)
+    self.assertEqual(self._Headers().get('content-encoding'), 'gzip')
+    self.assertEqual(int(self._Headers()['content-length']),
+        len(_GzipCompress(data, 6)))
+    self.assertEqual(self.server.bodies['/item/x'], data)
+
+  def testSmallEntryIsSentAsIs(self):
+    entry = {'name': 'item'}
+    self.rass.compress_threshold = len(json.dumps(entry)) + 1
+    self.rass.Put(entry, '/item/x')
+    self.assertFalse('content-encoding' in self._Headers())
+    self.assertEqual(self.server.bodies['/item/x'], json.dumps(entry))
+    self.rass.compress_threshold = len(json.dumps(entry))
+    self.rass.Put(entry, '/item/x')
+    self.assertEqual(self._Headers().get('content-encoding'), 'gzip')
+
+  def testLevel(self):
+    data = json.dumps(self.entry)
+    for level in (1, 9):
+      self.rass.compress_level = level
+      self.rass.Post(self.entry, '/item/x')
+      self.assertEqual(int(self._Headers()['content-length']),
+          len(_GzipCompress(data, level)))
+    self.assertNotEqual(len(_GzipCompress(data, 1)),
+        len(_GzipCompress(data, 9)))
+
+  def testNotCompressedWhenDisabled(self):
+    self.rass.compress_requests = False
+    self.rass.Post(self.entry, '/item/x')
+    self.assertFalse('content-encoding' in self._Headers())
+    self.assertEqual(int(self._Headers()['content-length']),
+        len(json.dumps(self.entry)))
+
+  def testMediaSourceIsSentAsIs(self):
+    data = 'x' * 10000
+    self.rass.Post(raws_json.MediaSource(file_handle=StringIO.StringIO(data),
+        content_type='text/plain', content_length=len(data)), '/item/x')
+    self.assertFalse('content-encoding' in self._Headers())
+    self.assertEqual(self.server.bodies['/item/x'], data)
+
+  def testEntryWithMediaIsSentAsIs(self):
+    data = 'x' * 10000
+    self.rass.Post(self.entry, '/item/x',
+        media_source=raws_json.MediaSource(
+        file_handle=StringIO.StringIO(data), content_type='text/plain',
+        content_length=len(data)))
+    self.assertFalse('content-encoding' in self._Headers())
+    self.assertTrue(json.dumps(self.entry) in self.server.bodies['/item/x'])
+
+  def testAsyncEntryIsCompressed(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    rass.compress_requests = True
+    loop.run_until_complete(rass.Post(self.entry, '/item/x'), timeout=5)
+    loop.close()
+    self.assertEqual(self._Headers().get('content-encoding'), 'gzip')
+    self.assertEqual(self.server.bodies['/item/x'], json.dumps(self.entry))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of downloads to local files."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import raws_json
+import raws_json.async_request
+from raws_json.download import DownloadError
+from raws_json.rass.service import RassService, AsyncRassService
+from tests.server import StandInServer
+
+DATA = ''.join([chr(i % 251) for i in xrange(300007)])
+NEW_DATA = ''.join([chr(i % 241) for i in xrange(300007)])
+
+
+class _ChangingHandler(object):
+  """Request handler which replaces the file on the server right after the
+  HEAD request of a download."""
+
+  def __init__(self, server, path, data):
+    self.server = server
+    self.path = path
+    self.data = data
+
+  def HttpRequest(self, service, operation, *args, **kwargs):
+    response = raws_json.HttpRequest(service, operation, *args, **kwargs)
+    if operation == 'HEAD':
+      self.server.files[self.path] = self.data
+    return response
+
+
+class DownloadTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.server.files['/item/a.bin'] = DATA
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'a.bin')
+    self.rass = RassService('u', 'p', '127.0.0.1')
+    self.rass.port = self.server.port
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.directory)
+
+  def _Read(self):
+    return open(self.path, 'rb').read()
+
+  def _Write(self, data):
+    fd = open(self.path, 'wb')
+    fd.write(data)
+    fd.close()
+
+  def _Gets(self):
+    return [entry[2] for entry in self.server.log if entry[0] == 'GET']
+
+
+class DownloadTest(DownloadTestCase):
+
+  def testDownloadToPath(self):
+    self.assertEqual(self.rass.Download('/item/a.bin', self.path), len(DATA))
+    self.assertEqual(self._Read(), DATA)
+
+  def testAsyncDownloadToPath(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    future = rass.Download('/item/a.bin', self.path)
+    self.assertEqual(loop.run_until_complete(future), len(DATA))
+    self.assertEqual(self._Read(), DATA)
+
+
+class DownloadFileTest(DownloadTestCase):
+
+  def testOverwritesByDefault(self):
+    self._Write('x' * 1000)
+    self.assertEqual(self.rass.downloadItem('/item/a.bin', self.path),
+        len(DATA))
+    self.assertEqual(self._Read(), DATA)
+    self.assertEqual(self._Gets()[0].get('range'), None)
+
+  def testResumeContinuesWithIfRange(self):
+    self._Write(DATA[:100000])
+    self.assertEqual(self.rass.downloadItem('/item/a.bin', self.path,
+        resume=True), len(DATA))
+    self.assertEqual(self._Read(), DATA)
+    headers = self._Gets()[0]
+    self.assertEqual(headers['range'], 'bytes=100000-')
+    self.assertEqual(headers['if-range'], self.server.etag('/item/a.bin'))
+
+  def testResumeRestartsLongerFile(self):
+    self._Write(DATA + 'stale')
+    self.rass.downloadItem('/item/a.bin', self.path, resume=True)
+    self.assertEqual(self._Read(), DATA)
+    self.assertEqual(self._Gets()[0].get('range'), None)
+
+  def testResumeOfCompleteFile(self):
+    self._Write(DATA)
+    self.rass.downloadItem('/item/a.bin', self.path, resume=True)
+    self.assertEqual(self._Read(), DATA)
+    self.assertEqual(self._Gets(), [])
+
+  def testFileChangedAfterHeadIsSentWhole(self):
+    self._Write(DATA[:100000])
+    self.rass.handler = _ChangingHandler(self.server, '/item/a.bin', NEW_DATA)
+    self.rass.downloadItem('/item/a.bin', self.path, resume=True)
+    self.assertEqual(self._Read(), NEW_DATA)
+
+  def testParallelStreams(self):
+    self.assertEqual(self.rass.downloadItem('/item/a.bin', self.path,
+        streams=3), len(DATA))
+    self.assertEqual(self._Read(), DATA)
+    gets = self._Gets()
+    self.assertEqual(sorted([headers['range'] for headers in gets]),
+        ['bytes=0-100001', 'bytes=100002-200003', 'bytes=200004-300006'])
+    self.assertEqual(set([headers['if-range'] for headers in gets]),
+        set([self.server.etag('/item/a.bin')]))
+
+  def testParallelStreamsOfChangedFileFail(self):
+    self.rass.handler = _ChangingHandler(self.server, '/item/a.bin', NEW_DATA)
+    self.assertRaises(DownloadError, self.rass.downloadItem, '/item/a.bin',
+        self.path, streams=3)
+
+  def testAsyncServiceDownloadsOnThread(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    future = rass.downloadItem('/item/a.bin', self.path, streams=3)
+    self.assertEqual(loop.run_until_complete(future), len(DATA))
+    self.assertEqual(self._Read(), DATA)
+    self.assertEqual(len(self._Gets()), 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of the incremental feed parser."""
+
+import json
+import random
+import unittest
+
+from raws_json.feed_parser import FeedEntryParser, IterFeedEntries
+
+
+def _Feed(entries):
+  return json.dumps({'feed': {'title': 'a "feed" [x]', 'entry': entries,
+      'total': len(entries)}})
+
+
+def _Splits(document, rnd):
+  """Cuts document into pieces at random places."""
+  cuts = sorted(rnd.sample(xrange(1, len(document)),
+      min(len(document) - 1, rnd.randint(1, 12))))
+  return [document[i:j] for (i, j) in zip([0] + cuts, cuts + [None])]
+
+
+class FeedEntryParserTest(unittest.TestCase):
+
+  def _Parse(self, chunks):
+    return list(IterFeedEntries(chunks))
+
+  def testEntriesOfOneChunk(self):
+    entries = [{'entry': {'id': str(i), 'path': '/a/{%d}/' % i}}
+        for i in xrange(5)]
+    self.assertEqual(self._Parse([_Feed(entries)]), entries)
+
+  def testEveryChunkBoundary(self):
+    entries = [{'entry': {'id': 'x\\"y', 'n': [1, 2.5]}}, 'text', -2500.0,
+        12, True, None, []]
+    document = _Feed(entries)
+    for i in xrange(1, len(document)):
+      self.assertEqual(self._Parse([document[:i], document[i:]]), entries,
+          'split at %d' % i)
+
+  def testNumberSplitInsideIsntDecodedEarly(self):
+    chunks = ['{"feed": {"entry": [-2500.', '0, 1', 'e3, 7', ']}}']
+    self.assertEqual(self._Parse(chunks), [-2500.0, 1000.0, 7])
+
+  def testByteByByte(self):
+    entries = [{'entry': {'id': str(i)}} for i in xrange(3)] + [0, -1.5e-3]
+    self.assertEqual(self._Parse(list(_Feed(entries))), entries)
+
+  def testRandomSplits(self):
+    rnd = random.Random(3)
+    scalars = [lambda: rnd.randint(-10 ** 6, 10 ** 6),
+        lambda: round(rnd.uniform(-10 ** 4, 10 ** 4), rnd.randint(0, 4)),
+        lambda: rnd.choice([True, False, None]),
+        lambda: {'entry': {'id': str(rnd.random())}}]
+    for i in xrange(300):
+      entries = [rnd.choice(scalars)() for j in xrange(rnd.randint(0, 8))]
+      document = _Feed(entries)
+      self.assertEqual(self._Parse(_Splits(document, rnd)), entries)
+
+  def testTruncatedFeedFails(self):
+    parser = FeedEntryParser()
+    self.assertEqual(parser.feed('{"feed": {"entry": [{"a": 1}, {"b"'),
+        [{'a': 1}])
+    self.assertRaises(ValueError, parser.close)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of the formatted request headers of a service."""
+
+import httplib
+import unittest
+
+import raws_json
+from raws_json.raws_service import Session
+from raws_json.rass.service import RassService
+from tests.server import StandInServer
+
+
+def _Lines(service):
+  return sorted([line for line in raws_json._HeaderBlock(service)[0]
+      if line.startswith('X-')])
+
+
+class HeaderBlockTest(unittest.TestCase):
+
+  def setUp(self):
+    self.service = raws_json.JsonService(additional_headers={'X-A': '1'})
+
+  def testBlockIsKeptUntilHeadersChange(self):
+    block = raws_json._HeaderBlock(self.service)
+    self.assertEqual(_Lines(self.service), ['X-A: 1'])
+    self.assertTrue(raws_json._HeaderBlock(self.service) is block)
+    self.service.additional_headers['X-A'] = '1'
+    self.assertTrue(raws_json._HeaderBlock(self.service) is block)
+    self.service.additional_headers['X-A'] = '2'
+    self.assertEqual(_Lines(self.service), ['X-A: 2'])
+    self.service.additional_headers.update({'X-B': '3'})
+    self.assertEqual(_Lines(self.service),
+        ['X-A: 2', 'X-B: 3'])
+    del self.service.additional_headers['X-A']
+    self.assertEqual(_Lines(self.service), ['X-B: 3'])
+    self.assertFalse('x-a' in raws_json._HeaderBlock(self.service)[1])
+
+  def testBlockIsRebuiltWhenHeadersAreReplaced(self):
+    raws_json._HeaderBlock(self.service)
+    self.service.additional_headers = raws_json.HeaderDict({'X-A': '2'})
+    self.assertEqual(_Lines(self.service), ['X-A: 2'])
+
+  def testPlainDictIsFormattedForEveryRequest(self):
+    self.service.additional_headers = {'X-A': '1'}
+    raws_json._HeaderBlock(self.service)
+    self.service.additional_headers['X-A'] = '2'
+    self.assertEqual(_Lines(self.service), ['X-A: 2'])
+
+  def testBaseHeadersChangesApply(self):
+    session = Session(additional_headers={'X-S': '1', 'X-A': 'session'})
+    service = RassService(server='127.0.0.1', session=session)
+    service.additional_headers['X-A'] = 'service'
+    self.assertEqual(_Lines(service),
+        ['X-A: service', 'X-S: 1'])
+    session.additional_headers['X-S'] = '2'
+    self.assertEqual(_Lines(service),
+        ['X-A: service', 'X-S: 2'])
+    session.close()
+
+  def testInvalidHeadersAreRefused(self):
+    self.service.additional_headers['X-A'] = '1\r\nX-B: 2'
+    self.assertRaises(ValueError, raws_json._HeaderBlock, self.service)
+    self.service.additional_headers = raws_json.HeaderDict({'X A:': '1'})
+    self.assertRaises(ValueError, raws_json._HeaderBlock, self.service)
+
+
+class SentHeadersTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.rass = RassService(server='127.0.0.1')
+    self.rass.port = self.server.port
+
+  def tearDown(self):
+    self.server.stop()
+
+  def testChangedHeadersAreSent(self):
+    self.rass.additional_headers['X-A'] = '1'
+    self.rass.Get('/dir/')
+    self.assertEqual(self.server.log[-1][2].get('x-a'), '1')
+    self.rass.additional_headers['X-A'] = '2'
+    self.rass.Get('/dir/')
+    self.assertEqual(self.server.log[-1][2].get('x-a'), '2')
+
+  def testPlainConnectionGetsHeaders(self):
+    self.rass.additional_headers['X-A'] = '1'
+    connection = httplib.HTTPConnection('127.0.0.1', self.server.port)
+    send_request = getattr(raws_json, '__SendRequest')
+    send_request(self.rass, connection, 'GET', '/dir/', {}, None).read()
+    connection.close()
+    self.assertEqual(self.server.log[-1][2].get('x-a'), '1')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of the BandwidthLimiter."""
+
+import json
+import os
+import threading
+import time
+import unittest
+
+import raws_json
+import raws_json.async_request
+from raws_json.rass.service import AsyncRassService, RassService
+from tests.server import StandInServer
+
+
+def _Cpu():
+  times = os.times()
+  return times[0] + times[1]
+
+
+class BandwidthLimiterTest(unittest.TestCase):
+
+  def testRateIsCapped(self):
+    limiter = raws_json.BandwidthLimiter(1000000, burst=0.05)
+    started = time.time()
+    for i in xrange(30):
+      limiter.wait(10000)
+    # 300000 bytes, less the 50000 of the burst.
+    self.assertTrue(time.time() - started >= 0.24)
+
+  def testHostRateIsCappedPerHost(self):
+    limiter = raws_json.BandwidthLimiter(host_rate=100000, burst=0.1)
+    self.assertEqual(limiter.reserve(10000, 'a'), 0.0)
+    self.assertEqual(limiter.reserve(10000, 'b'), 0.0)
+    self.assertAlmostEqual(limiter.reserve(10000, 'a'), 0.1, places=2)
+    self.assertEqual(limiter.reserve(10000), 0.0)
+
+  def testThreadsShareTheRate(self):
+    limiter = raws_json.BandwidthLimiter(500000, burst=0.02)
+    def _Send():
+      for i in xrange(10):
+        limiter.wait(5000)
+    threads = [threading.Thread(target=_Send) for i in xrange(4)]
+    started = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    # 200000 bytes for all four threads together.
+    self.assertTrue(time.time() - started >= 0.35)
+
+  def testIdleHostBucketsAreDropped(self):
+    limiter = raws_json.BandwidthLimiter(1000000, host_rate=1000000,
+        burst=0.01)
+    limiter.prune_interval = 0
+    limiter.reserve(100, 'idle')
+    limiter.reserve(1000000, 'busy')
+    time.sleep(0.05)
+    limiter.reserve(100, 'new')
+    self.assertEqual(sorted(limiter._buckets), [None, 'busy', 'new'])
+    # The debt of a host which isn't full yet is still paid.
+    self.assertTrue(limiter.reserve(1, 'busy') > 0.5)
+
+  def testBucketsAreNotPrunedBeforeTheInterval(self):
+    limiter = raws_json.BandwidthLimiter(host_rate=1000000, burst=0.01)
+    limiter.reserve(100, 'a')
+    time.sleep(0.05)
+    limiter.reserve(100, 'b')
+    self.assertEqual(sorted(limiter._buckets), ['a', 'b'])
+
+
+class LimitedDownloadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.data = ['x' * 100] * 2000
+    self.server.files['/data'] = json.dumps(self.data)
+    self.loop = raws_json.async_request.EventLoop()
+    self.rass = AsyncRassService('u', 'p', '127.0.0.1', loop=self.loop)
+    self.rass.port = self.server.port
+
+  def tearDown(self):
+    self.loop.close()
+    self.server.stop()
+
+  def testLoopDoesntSpinWhileThrottled(self):
+    self.rass.download_limit = raws_json.BandwidthLimiter(400000, burst=0.02)
+    started = time.time()
+    cpu = _Cpu()
+    result = self.loop.run_until_complete(self.rass.Get('/data'), timeout=10)
+    self.assertEqual(result, self.data)
+    # The wait for the last read of at most 64KB comes after the body.
+    self.assertTrue(time.time() - started >= 0.3)
+    self.assertTrue(_Cpu() - cpu < 0.25, _Cpu() - cpu)
+
+  def testLoopAndThreadsShareTheRate(self):
+    limiter = raws_json.BandwidthLimiter(500000, burst=0.02)
+    self.rass.download_limit = limiter
+    rass = RassService('u', 'p', '127.0.0.1')
+    rass.port = self.server.port
+    rass.download_limit = limiter
+    thread = threading.Thread(target=rass.Get, args=('/data',))
+    started = time.time()
+    thread.start()
+    result = self.loop.run_until_complete(self.rass.Get('/data'), timeout=10)
+    thread.join()
+    self.assertEqual(result, self.data)
+    # Both bodies of 200000 bytes at 500000 bytes per second, one alone
+    # would take less than 0.4 seconds.
+    self.assertTrue(time.time() - started >= 0.5)
+
+
+if __name__ == '__main__':
+  unittest.main()
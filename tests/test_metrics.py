@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of the request metrics and their Prometheus text rendering."""
+
+import unittest
+
+import raws_json
+import raws_json.async_request
+from raws_json import metrics
+from raws_json.raws_service import RequestError
+from raws_json.rass.service import RassService, AsyncRassService
+from tests.server import StandInServer
+
+
+def _Timing(service, verb, uri, status, total, request_bytes=0,
+    response_bytes=0):
+  timing = raws_json.RequestTiming([], service, verb, uri)
+  timing.status = status
+  timing.total = total
+  timing.request_bytes = request_bytes
+  timing.response_bytes = response_bytes
+  timing.ttfb = total / 2
+  return timing
+
+
+class RenderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.registry = metrics.MetricsRegistry(buckets=(0.1, 1.0))
+
+  def _Lines(self):
+    return metrics.Render(self.registry).splitlines()
+
+  def testRequestsAndHistogram(self):
+    self.registry(_Timing('RassService', 'GET', '/item/{id}', 200, 0.05,
+        response_bytes=10))
+    self.registry(_Timing('AsyncRassService', 'GET', '/item/{id}', 200, 0.5,
+        response_bytes=20))
+    self.registry(_Timing('RassService', 'PUT', '/item/{id}', None, 2.0,
+        request_bytes=7))
+    lines = self._Lines()
+    labels = 'service="rass",verb="GET",uri="/item/{id}",status="200"'
+    for line in ['# TYPE raws_requests_total counter',
+        'raws_requests_total{%s} 2' % labels,
+        'raws_requests_total{service="rass",verb="PUT",uri="/item/{id}",'
+            'status="error"} 1',
+        '# TYPE raws_request_duration_seconds histogram',
+        'raws_request_duration_seconds_bucket{%s,le="0.1"} 1' % labels,
+        'raws_request_duration_seconds_bucket{%s,le="1.0"} 2' % labels,
+        'raws_request_duration_seconds_bucket{%s,le="+Inf"} 2' % labels,
+        'raws_request_duration_seconds_sum{%s} 0.55' % labels,
+        'raws_request_duration_seconds_count{%s} 2' % labels,
+        'raws_request_phase_seconds_total{%s,phase="ttfb"} 0.275' % labels,
+        'raws_response_bytes_total{%s} 30' % labels,
+        'raws_request_bytes_total{service="rass",verb="PUT",'
+            'uri="/item/{id}",status="error"} 7']:
+      self.assertTrue(line in lines, line)
+
+  def testLabelsAreEscaped(self):
+    self.registry(_Timing('MetaService', 'GET', '/a"b\\c\n', 200, 0.01))
+    self.assertTrue('raws_requests_total{service="meta",verb="GET",'
+        'uri="/a\\"b\\\\c\\n",status="200"} 1' in self._Lines())
+
+  def testNamespace(self):
+    self.registry = metrics.MetricsRegistry(namespace='')
+    self.registry(_Timing('RatsService', 'GET', '/src/', 200, 0.01))
+    lines = self._Lines()
+    self.assertTrue('# TYPE requests_total counter' in lines)
+    self.assertTrue(lines[-1].startswith('# TYPE pool_connections_reused'))
+
+  def testClear(self):
+    self.registry(_Timing('RassService', 'GET', '/dir/', 200, 0.01))
+    self.registry.clear()
+    self.assertFalse([line for line in self._Lines()
+        if not line.startswith('#')])
+
+
+class InstrumentTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.registry = metrics.MetricsRegistry()
+
+  def tearDown(self):
+    self.server.stop()
+
+  def _Service(self, service_class, **kwargs):
+    service = service_class('u', 'p', '127.0.0.1', **kwargs)
+    service.port = self.server.port
+    metrics.Instrument(service, self.registry, 'rass')
+    return service
+
+  def testServiceRequests(self):
+    rass = self._Service(RassService)
+    rass.Get('/dir/12345/')
+    rass.Get('/dir/12345/')
+    self.assertRaises(RequestError, rass.Get, '/missing/')
+    lines = metrics.Render(self.registry).splitlines()
+    self.assertTrue('raws_requests_total{service="rass",verb="GET",'
+        'uri="/dir/{path}",status="200"} 2' in lines)
+    self.assertTrue('raws_requests_total{service="rass",verb="GET",'
+        'uri="/missing/",status="404"} 1' in lines)
+    self.assertTrue('raws_pool_connections_created_total{pool="rass"} 1'
+        in lines)
+    self.assertTrue('raws_pool_connections_reused_total{pool="rass"} 2'
+        in lines)
+
+  def testAsyncServiceRequests(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = self._Service(AsyncRassService, loop=loop)
+    loop.run_until_complete(rass.Get('/dir/'))
+    lines = metrics.Render(self.registry).splitlines()
+    self.assertTrue('raws_requests_total{service="rass",verb="GET",'
+        'uri="/dir/",status="200"} 1' in lines)
+    self.assertTrue('raws_pool_connections_created_total{pool="rass_async"} 1'
+        in lines)
+
+
+if __name__ == '__main__':
+  unittest.main()
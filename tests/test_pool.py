@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of the keep-alive connection pool of the blocking requests."""
+
+import httplib
+import socket
+import unittest
+
+import raws_json
+from raws_json.rass.service import RassService
+from tests.server import StandInServer
+
+DATA = ''.join([chr(i % 251) for i in xrange(1000003)])
+
+
+class _Connection(object):
+  """Stand-in for an idle connection, with a socket that stays quiet."""
+
+  def __init__(self, key):
+    (self.sock, self.peer) = socket.socketpair()
+    self.pool_key = key
+
+  def close(self):
+    self.sock = None
+
+
+class PoolKeyTest(unittest.TestCase):
+
+  def testConnectionsAreKeyedByServerPortSslAndProxy(self):
+    pool = raws_json.ConnectionPool()
+    key = ('rass.test', 80, False, None)
+    connection = _Connection(key)
+    pool.add(connection)
+    pool.put(connection)
+    self.assertEqual(pool.get(('other.test', 80, False, None)), None)
+    self.assertEqual(pool.get(('rass.test', 8080, False, None)), None)
+    self.assertEqual(pool.get(('rass.test', 80, True, None)), None)
+    self.assertEqual(pool.get(('rass.test', 80, False,
+        ('proxy.test', 3128, None, None))), None)
+    self.assertTrue(pool.get(key) is connection)
+    self.assertTrue(connection.reused)
+
+
+class PoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.server.files['/item/a.bin'] = DATA
+    self.rass = RassService('u', 'p', '127.0.0.1')
+    self.rass.port = self.server.port
+    self.pool = self.rass.connection_pool
+
+  def tearDown(self):
+    self.pool.clear()
+    self.server.stop()
+
+  def _Response(self):
+    return raws_json.HttpRequest(self.rass, 'GET', None, '/item/a.bin')
+
+  def testConnectionIsReused(self):
+    self.rass.Get('/dir/')
+    self.rass.Get('/dir/')
+    self.assertEqual(self.server.connections, 1)
+    self.assertEqual(self.pool.counts(), {'idle': 1, 'active': 0,
+        'created': 1, 'reused': 1})
+
+  def testServersGetConnectionsOfTheirOwn(self):
+    other = StandInServer()
+    try:
+      self.rass.Get('/dir/')
+      self.rass.port = other.port
+      self.rass.Get('/dir/')
+      self.rass.port = self.server.port
+      self.rass.Get('/dir/')
+    finally:
+      other.stop()
+    self.assertEqual((self.server.connections, other.connections), (1, 1))
+    self.assertEqual(self.pool.counts()['reused'], 1)
+
+  def testDrainedResponseIsReleased(self):
+    response = self._Response()
+    self.assertEqual(self.pool.counts()['active'], 1)
+    self.assertEqual(response.read(), DATA)
+    self.assertEqual(self.pool.counts()['idle'], 1)
+    self.assertEqual(self.pool.counts()['active'], 0)
+
+  def testResponseClosedEarlyClosesConnection(self):
+    response = self._Response()
+    response.read(100)
+    response.close()
+    self.assertEqual(self.pool.counts()['active'], 0)
+    self.assertEqual(self.pool.counts()['idle'], 0)
+    self.assertEqual(self._Response().read(), DATA)
+    self.assertEqual(self.server.connections, 2)
+
+  def testIterResponseStoppedEarlyClosesConnection(self):
+    chunks = raws_json.IterResponse(self._Response(), 100)
+    chunks.next()
+    chunks.close()
+    self.assertEqual(self.pool.counts()['active'], 0)
+
+  def testClosedIdleConnectionIsSentAgain(self):
+    self.rass.Get('/dir/')
+    self.server.drop_gets = 1
+    self.assertEqual(len(self.rass.Get('/dir/')['feed']['entry']), 200)
+    self.assertEqual(self.server.connections, 2)
+
+  def testSentPostIsntSentAgain(self):
+    self.rass.Get('/dir/')
+    self.server.drop_posts = 1
+    self.assertRaises((httplib.HTTPException, socket.error), self.rass.Post,
+        {'a': 1}, '/item/x')
+    self.assertEqual(self.server.connections, 1)
+    self.assertEqual(self.pool.counts()['active'], 0)
+
+
+class ClosedWhileIdleTest(unittest.TestCase):
+
+  def _Closed(self, operation, error, sent):
+    return raws_json._ClosedWhileIdle(operation, error, sent)
+
+  def testResetWhileSending(self):
+    for error in (socket.error(104, 'reset'), socket.error(32, 'pipe')):
+      self.assertTrue(self._Closed('POST', error, False))
+      self.assertTrue(self._Closed('GET', error, False))
+
+  def testClosedBeforeResponse(self):
+    error = raws_json.ClosedBeforeResponse('')
+    self.assertTrue(self._Closed('GET', error, True))
+    self.assertTrue(self._Closed('PUT', error, True))
+    self.assertFalse(self._Closed('POST', error, True))
+
+  def testOtherFailuresArentRetried(self):
+    self.assertFalse(self._Closed('GET', socket.timeout('timed out'), True))
+    self.assertFalse(self._Closed('GET', socket.timeout('timed out'), False))
+    self.assertFalse(self._Closed('GET', httplib.BadStatusLine('x'), True))
+    self.assertFalse(self._Closed('POST', socket.error(104, 'reset'), True))
+
+
+if __name__ == '__main__':
+  unittest.main()
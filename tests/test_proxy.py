@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of https requests tunneled through a proxy with CONNECT."""
+
+import base64
+import os
+import socket
+import ssl
+import unittest
+
+import raws_json.async_request
+from raws_json.rass.service import AsyncRassService, RassService
+from tests.server import CERTIFICATE, StandInServer, TunnelProxy
+
+_PROXY_VARIABLES = ('https_proxy', 'proxy-username', 'proxy_username',
+    'proxy-password', 'proxy_password')
+
+
+class TunnelTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer(https=True)
+    self.proxy = TunnelProxy()
+    self.environ = dict([(name, os.environ.pop(name))
+        for name in _PROXY_VARIABLES if name in os.environ])
+    os.environ['https_proxy'] = 'http://127.0.0.1:%d' % self.proxy.port
+    self.context = ssl.create_default_context(cafile=CERTIFICATE)
+    self.loop = raws_json.async_request.EventLoop()
+
+  def tearDown(self):
+    for name in _PROXY_VARIABLES:
+      os.environ.pop(name, None)
+    os.environ.update(self.environ)
+    self.loop.close()
+    self.proxy.stop()
+    self.server.stop()
+
+  def _Service(self, service_class, **kwargs):
+    service = service_class('u', 'p', 'localhost', ssl=True, **kwargs)
+    service.port = self.server.port
+    service.ssl_context = self.context
+    return service
+
+  def _Target(self):
+    return 'localhost:%d' % self.server.port
+
+  def testRequestsGoThroughTunnel(self):
+    rass = self._Service(RassService)
+    for i in xrange(2):
+      self.assertEqual(len(rass.Get('/dir/')['feed']['entry']), 200)
+    # The tunnel is kept open like any other connection.
+    self.assertEqual([entry[0] for entry in self.proxy.log], [self._Target()])
+    self.assertEqual(self.server.connections, 1)
+    self.assertEqual(len(self.server.log), 2)
+
+  def testProxyCredentials(self):
+    os.environ['proxy-username'] = 'proxy'
+    os.environ['proxy-password'] = 'secret'
+    self._Service(RassService).Get('/dir/')
+    headers = self.proxy.log[0][1]
+    self.assertEqual(headers['proxy-authorization'],
+        'Basic ' + base64.b64encode('proxy:secret'))
+    # The credentials of the proxy don't reach the server.
+    self.assertFalse('proxy-authorization' in self.server.log[0][2])
+
+  def testAsyncRequestsGoThroughTunnel(self):
+    rass = self._Service(AsyncRassService, loop=self.loop)
+    futures = [rass.Get('/dir/%d/' % i) for i in xrange(2)]
+    feeds = self.loop.run_until_complete(
+        raws_json.async_request.gather(futures), timeout=10)
+    self.assertEqual([len(feed['feed']['entry']) for feed in feeds], [200] * 2)
+    self.loop.run_until_complete(rass.Get('/dir/'), timeout=10)
+    self.assertEqual(self.loop.counts()['reused'], 1)
+    self.assertEqual([entry[0] for entry in self.proxy.log],
+        [self._Target()] * self.server.connections)
+    self.assertTrue(self.proxy.log[0][1]['user-agent'])
+
+  def testFailedConnect(self):
+    self.proxy.refuse = '407 Proxy Authentication Required'
+    rass = self._Service(RassService)
+    try:
+      rass.Get('/dir/')
+      self.fail('The request went through a refused tunnel')
+    except socket.error, e:
+      self.assertTrue('407' in str(e), str(e))
+    self.assertEqual(self.server.log, [])
+    self.proxy.refuse = None
+    self.assertEqual(len(rass.Get('/dir/')['feed']['entry']), 200)
+
+  def testAsyncFailedConnect(self):
+    self.proxy.refuse = '403 Forbidden'
+    rass = self._Service(AsyncRassService, loop=self.loop)
+    try:
+      self.loop.run_until_complete(rass.Get('/dir/'), timeout=10)
+      self.fail('The request went through a refused tunnel')
+    except socket.error, e:
+      self.assertTrue('403' in str(e), str(e))
+    self.assertEqual(self.server.log, [])
+    self.proxy.refuse = None
+    feed = self.loop.run_until_complete(rass.Get('/dir/'), timeout=10)
+    self.assertEqual(len(feed['feed']['entry']), 200)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of services sharing a Session."""
+
+import base64
+import unittest
+
+from raws_json.raws_service import Session
+from raws_json.rass.service import RassService
+from tests.server import StandInServer
+
+
+def _Basic(username, password):
+  return 'Basic ' + base64.encodestring('%s:%s' % (username, password)).strip()
+
+
+class SessionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.session = Session('shared', 'secret', additional_headers={'X-A': '1'})
+
+  def tearDown(self):
+    self.session.close()
+    self.server.stop()
+
+  def _Service(self, *args, **kwargs):
+    service = RassService(server='127.0.0.1', session=self.session, *args,
+        **kwargs)
+    service.port = self.server.port
+    return service
+
+  def testServicesUseSessionCredentials(self):
+    entry = self._Service().Post({'a': 1}, '/item/x')['entry']
+    self.assertEqual(entry['authorization'], _Basic('shared', 'secret'))
+
+  def testOwnCredentialsDontLeakToOtherServices(self):
+    first = self._Service()
+    second = self._Service('other', 'password')
+    self.assertEqual(second.Post({}, '/item/x')['entry']['authorization'],
+        _Basic('other', 'password'))
+    self.assertEqual(first.Post({}, '/item/x')['entry']['authorization'],
+        _Basic('shared', 'secret'))
+    self.assertEqual(self.session.additional_headers['Authorization'],
+        _Basic('shared', 'secret'))
+
+  def testSessionHeadersAreSentAndChangesApply(self):
+    service = self._Service()
+    service.Get('/dir/')
+    self.assertEqual(self.server.log[-1][2].get('x-a'), '1')
+    self.session.additional_headers['X-A'] = '2'
+    service.Get('/dir/')
+    self.assertEqual(self.server.log[-1][2].get('x-a'), '2')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of the RequestTiming of requests and of its observers."""
+
+import logging
+import ssl
+import threading
+import time
+import unittest
+
+import raws_json
+import raws_json.async_request
+from raws_json.rass.service import AsyncRassService, RassService
+from tests.server import CERTIFICATE, StandInServer
+
+
+def _Timing(total):
+  timing = raws_json.RequestTiming([], 'RassService', 'GET', '/item/{id}')
+  timing.total = total
+  return timing
+
+
+class RequestTimingTest(unittest.TestCase):
+
+  def testPhases(self):
+    timings = []
+    timing = raws_json.RequestTiming([timings.append], 'RassService', 'PUT',
+        '/item/{id}')
+    time.sleep(0.02)
+    timing.sending()
+    time.sleep(0.05)
+    timing.waiting()
+    time.sleep(0.1)
+    timing.receiving()
+    time.sleep(0.05)
+    timing.finish(201, 10)
+    self.assertEqual(timings, [timing])
+    self.assertAlmostEqual(timing.send, 0.05, delta=0.03)
+    self.assertAlmostEqual(timing.ttfb, 0.1, delta=0.03)
+    self.assertAlmostEqual(timing.body, 0.05, delta=0.03)
+    self.assertAlmostEqual(timing.total, 0.22, delta=0.05)
+    self.assertEqual((timing.dns, timing.connect, timing.tls),
+        (None, None, None))
+    self.assertEqual((timing.status, timing.response_bytes), (201, 10))
+
+  def testFailureIsReportedOnce(self):
+    timings = []
+    timing = raws_json.RequestTiming([timings.append], 'RassService', 'GET',
+        '/')
+    timing.sending()
+    error = IOError('reset')
+    timing.finish(error=error)
+    timing.finish(200)
+    self.assertEqual(timings, [timing])
+    self.assertEqual((timing.status, timing.error), (None, error))
+    self.assertEqual((timing.ttfb, timing.body), (None, None))
+    self.assertTrue('failed (reset)' in str(timing))
+
+  def testSendingAgainRestartsThePhases(self):
+    timing = raws_json.RequestTiming([], 'RassService', 'POST', '/')
+    timing.sending()
+    timing.request_bytes = 10
+    timing.waiting()
+    time.sleep(0.05)
+    # A retry on another connection.
+    timing.sending()
+    timing.finish(error=IOError())
+    self.assertTrue(timing.send < 0.03)
+    self.assertEqual(timing.request_bytes, 0)
+
+
+class ServiceTimingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.server.files['/file'] = '"%s"' % ('x' * 998)
+    self.timings = raws_json.TimingBuffer()
+
+  def tearDown(self):
+    self.server.stop()
+
+  def _Service(self, service_class, **kwargs):
+    service = service_class('u', 'p', '127.0.0.1', **kwargs)
+    service.port = self.server.port
+    service.request_observers.append(self.timings)
+    return service
+
+  def _CheckPhases(self, timing, reused):
+    self.assertEqual(timing.reused, reused)
+    for phase in ('send', 'ttfb', 'body', 'total'):
+      self.assertTrue(getattr(timing, phase) >= 0, phase)
+    for phase in ('dns', 'connect'):
+      if reused:
+        self.assertEqual(getattr(timing, phase), None, phase)
+      else:
+        self.assertTrue(getattr(timing, phase) >= 0, phase)
+    phases = [getattr(timing, phase) or 0 for phase in
+        ('dns', 'connect', 'tls', 'send', 'ttfb', 'body')]
+    self.assertTrue(sum(phases) <= timing.total + 0.001)
+
+  def testBlockingRequests(self):
+    rass = self._Service(RassService)
+    rass.Post({'a': 1}, '/item/x')
+    rass.Get('/file')
+    (post, get) = self.timings.records()
+    self._CheckPhases(post, False)
+    self._CheckPhases(get, True)
+    self.assertEqual(post.tls, None)
+    self.assertEqual((post.verb, post.status, post.request_bytes),
+        ('POST', 201, len('{"a": 1}')))
+    self.assertEqual((get.verb, get.status, get.response_bytes),
+        ('GET', 200, 1000))
+
+  def testAsyncRequests(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = self._Service(AsyncRassService, loop=loop)
+    loop.run_until_complete(rass.Post({'a': 1}, '/item/x'), timeout=5)
+    loop.run_until_complete(rass.Get('/dir/'), timeout=5)
+    loop.close()
+    (post, get) = self.timings.records()
+    self._CheckPhases(post, False)
+    self._CheckPhases(get, True)
+    self.assertEqual((post.status, post.request_bytes),
+        (201, len('{"a": 1}')))
+    self.assertEqual(get.service, 'AsyncRassService')
+
+  def testTlsHandshake(self):
+    self.server.stop()
+    self.server = StandInServer(https=True)
+    rass = self._Service(RassService)
+    rass.server = 'localhost'
+    rass.ssl = True
+    rass.ssl_context = ssl.create_default_context(cafile=CERTIFICATE)
+    rass.Get('/dir/')
+    timing = self.timings.records()[0]
+    self._CheckPhases(timing, False)
+    self.assertTrue(timing.tls > 0)
+
+  def testFailedRequest(self):
+    rass = self._Service(RassService)
+    self.server.stop()
+    self.assertRaises(Exception, rass.Get, '/dir/')
+    timing = self.timings.records()[-1]
+    self.assertEqual(timing.status, None)
+    self.assertTrue(timing.error is not None)
+
+
+class TimingBufferTest(unittest.TestCase):
+
+  def testKeepsTheLastTimings(self):
+    timings = raws_json.TimingBuffer(size=3)
+    records = [_Timing(i) for i in xrange(5)]
+    for timing in records:
+      timings(timing)
+    self.assertEqual(len(timings), 3)
+    self.assertEqual(timings.records(), records[2:])
+    timings.clear()
+    self.assertEqual(timings.records(), [])
+
+  def testBoundWithManyThreads(self):
+    timings = raws_json.TimingBuffer(size=50)
+    def _Record():
+      for i in xrange(100):
+        timings(_Timing(i))
+    threads = [threading.Thread(target=_Record) for i in xrange(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(timings.records()), 50)
+
+
+class _Handler(logging.Handler):
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(record)
+
+
+class SlowRequestLogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.handler = _Handler()
+    self.logger = logging.getLogger('raws_json.tests.timing')
+    self.logger.propagate = False
+    self.logger.setLevel(logging.DEBUG)
+    self.logger.addHandler(self.handler)
+
+  def tearDown(self):
+    self.logger.removeHandler(self.handler)
+
+  def testThreshold(self):
+    log = raws_json.SlowRequestLog(threshold=1.0, logger=self.logger)
+    log(_Timing(0.999))
+    self.assertEqual(self.handler.records, [])
+    log(_Timing(1.0))
+    log(_Timing(2.5))
+    self.assertEqual([record.levelno for record in self.handler.records],
+        [logging.WARNING] * 2)
+    message = self.handler.records[1].getMessage()
+    self.assertTrue(message.startswith('Slow request: RassService GET '
+        '/item/{id}'), message)
+    self.assertTrue('in 2.500s' in message, message)
+
+  def testLevel(self):
+    log = raws_json.SlowRequestLog(threshold=0, logger=self.logger,
+        level=logging.INFO)
+    log(_Timing(0.0))
+    self.assertEqual(self.handler.records[0].levelno, logging.INFO)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,517 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Tests of uploads of local files and streams."""
+
+import email
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import raws_json
+import raws_json.async_request
+import raws_json.upload
+import raws_json.upload_cache
+from raws_json.raws_service import RequestError
+from raws_json.rass.service import RassService, AsyncRassService
+from raws_json.rats.service import RatsService
+from tests.server import StandInServer
+
+DATA = ''.join([chr(i % 253) for i in xrange(2500003)])
+MD5 = hashlib.md5(DATA).hexdigest()
+
+
+class UploadTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.server = StandInServer()
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'up.bin')
+    fd = open(self.path, 'wb')
+    fd.write(DATA)
+    fd.close()
+    self.rass = RassService('u', 'p', '127.0.0.1')
+    self.rass.port = self.server.port
+
+  def tearDown(self):
+    self.rass.connection_pool.clear()
+    self.server.stop()
+    shutil.rmtree(self.directory)
+
+
+class SendFileTest(UploadTestCase):
+
+  def setUp(self):
+    UploadTestCase.setUp(self)
+    self.calls = []
+    self.sendfile = raws_json._sendfile
+    if self.sendfile is not None:
+      def _Counted(*args):
+        self.calls.append(args[3])
+        return self.sendfile(*args)
+      raws_json._sendfile = _Counted
+
+  def tearDown(self):
+    raws_json._sendfile = self.sendfile
+    UploadTestCase.tearDown(self)
+
+  def testFileIsSentWithSendFile(self):
+    entry = self.rass.createItem('d/', 'up.bin', self.path, False)['entry']
+    self.assertEqual((entry['len'], entry['md5']), (len(DATA), MD5))
+    if sys.platform.startswith('linux'):
+      self.assertTrue(self.calls)
+
+  def testBufferedWithoutSendFile(self):
+    raws_json._sendfile = None
+    entry = self.rass.createItem('d/', 'up.bin', self.path, False)['entry']
+    self.assertEqual((entry['len'], entry['md5']), (len(DATA), MD5))
+
+  def testSendFileStartsAtFilePosition(self):
+    media_source = raws_json.MediaSource()
+    media_source.setFile(self.path, 'application/octet-stream')
+    media_source.file_handle.seek(1000)
+    media_source.content_length = len(DATA) - 1000
+    entry = self.rass.Put(None, '/item/d/up.bin',
+        media_source=media_source)['entry']
+    self.assertEqual(entry['md5'], hashlib.md5(DATA[1000:]).hexdigest())
+
+
+def _Pieces(data, size=70001):
+  for offset in xrange(0, len(data), size):
+    yield data[offset:offset + size]
+
+
+class StreamTest(UploadTestCase):
+
+  def testGeneratorIsSentChunked(self):
+    entry = self.rass.createItemFromStream('d/', 'up.bin', _Pieces(DATA),
+        'application/octet-stream')['entry']
+    self.assertEqual((entry['len'], entry['md5']), (len(DATA), MD5))
+    self.assertEqual(entry['transfer_encoding'], 'chunked')
+
+  def testFileIsSentChunked(self):
+    entry = self.rass.createItemFromStream('d/', 'up.bin',
+        open(self.path, 'rb'), 'application/octet-stream', False)['entry']
+    self.assertEqual((entry['len'], entry['md5']), (len(DATA), MD5))
+    self.assertEqual(entry['transfer_encoding'], 'chunked')
+
+  def testAsyncGeneratorIsSentChunked(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    future = rass.createItemFromStream('d/', 'up.bin', _Pieces(DATA),
+        'application/octet-stream')
+    entry = loop.run_until_complete(future)['entry']
+    self.assertEqual((entry['len'], entry['md5']), (len(DATA), MD5))
+    self.assertEqual(entry['transfer_encoding'], 'chunked')
+
+
+class MultipartTest(UploadTestCase):
+
+  def _MediaSource(self, use_mmap=False):
+    return raws_json.MediaSource(file_path=self.path,
+        content_type='video/mp4', use_mmap=use_mmap)
+
+  def _Parts(self, path):
+    headers = self.server.log[-1][2]
+    self.assertEqual(int(headers['content-length']),
+        len(self.server.bodies[path]))
+    message = email.message_from_string('Content-Type: %s\r\n\r\n%s' % (
+        headers['content-type'], self.server.bodies[path]))
+    return [(part.get_content_type(), part.get_payload())
+        for part in message.get_payload()]
+
+  def testHeadersAreSentInOnePart(self):
+    media_source = self._MediaSource()
+    body = raws_json.MultipartBody()
+    body.addPart('application/json', '{"a": 1}')
+    body.addPart('video/mp4', media_source)
+    parts = body.getParts()
+    self.assertEqual(len(parts), 3)
+    self.assertTrue(parts[1] is media_source)
+    self.assertEqual(body.getLength(),
+        len(parts[0]) + len(DATA) + len(parts[2]))
+
+  def testEntryAndFile(self):
+    entry = {'entry': {'content': {'params': {'title': 'a'}}}}
+    self.rass.Post(entry, '/item/d/', media_source=self._MediaSource())
+    parts = self._Parts('/item/d/')
+    self.assertEqual([part[0] for part in parts],
+        ['application/json', 'video/mp4'])
+    self.assertEqual(json.loads(parts[0][1]), entry)
+    self.assertEqual(parts[1][1], DATA)
+
+  def testMappedFile(self):
+    entry = {'entry': {'content': {'params': {'title': 'b'}}}}
+    self.rass.Put(entry, '/item/d/up.bin',
+        media_source=self._MediaSource(True))
+    self.assertEqual(self._Parts('/item/d/up.bin')[1][1], DATA)
+
+  def testAsyncEntryAndFile(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    entry = {'entry': {'content': {'params': {'title': 'c'}}}}
+    loop.run_until_complete(rass.Post(entry, '/item/d/',
+        media_source=self._MediaSource()))
+    parts = self._Parts('/item/d/')
+    self.assertEqual(json.loads(parts[0][1]), entry)
+    self.assertEqual(parts[1][1], DATA)
+
+
+class StaleConnectionTest(UploadTestCase):
+
+  def _Progress(self, service):
+    service.stats = raws_json.TransferStats()
+    # Slow enough for the server to close the connection halfway through
+    # the body, a request which was sent completely isn't sent again.
+    service.upload_limit = raws_json.BandwidthLimiter(10000000, burst=0.01)
+    progress = raws_json.TransferProgress()
+    media_source = raws_json.MediaSource(file_path=self.path)
+    return (progress, media_source)
+
+  def testRetryIsntCountedTwice(self):
+    (progress, media_source) = self._Progress(self.rass)
+    self.rass.Get('/dir/')
+    self.server.drop_posts = 1
+    entry = self.rass.Post(None, '/item/d/', media_source=media_source,
+        progress=progress)['entry']
+    self.assertEqual(entry['md5'], MD5)
+    self.assertEqual(self.server.connections, 2)
+    self.assertEqual(progress.bytes, len(DATA))
+    self.assertEqual(self.rass.stats.get('upload_bytes'), len(DATA))
+
+  def testAsyncRetryIsntCountedTwice(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    (progress, media_source) = self._Progress(rass)
+    loop.run_until_complete(rass.Get('/dir/'))
+    self.server.drop_posts = 1
+    entry = loop.run_until_complete(rass.Post(None, '/item/d/',
+        media_source=media_source, progress=progress))['entry']
+    self.assertEqual(entry['md5'], MD5)
+    self.assertEqual(self.server.connections, 2)
+    self.assertEqual(progress.bytes, len(DATA))
+    self.assertEqual(rass.stats.get('upload_bytes'), len(DATA))
+
+
+class _CountingHandler(object):
+  """Request handler which counts the requests it passes on."""
+
+  def __init__(self):
+    self.requests = 0
+
+  def HttpRequest(self, *args, **kwargs):
+    self.requests += 1
+    return raws_json.HttpRequest(*args, **kwargs)
+
+
+class _SlowFilePool(raws_json.FilePool):
+  """FilePool which takes its time to hand out a slot, so threads opening
+  the same file overlap."""
+
+  def acquire(self):
+    raws_json.FilePool.acquire(self)
+    time.sleep(0.2)
+
+
+class ResumableTest(UploadTestCase):
+
+  uri = '/item/d/up.bin'
+
+  def _Upload(self, **kwargs):
+    return self._Put(self.rass, **kwargs)['entry']
+
+  def _Put(self, rass, **kwargs):
+    media_source = raws_json.MediaSource(file_path=self.path)
+    kwargs.setdefault('chunk_size', 1048576)
+    kwargs.setdefault('backoff', 0)
+    return rass.PutResumable(self.uri, media_source, **kwargs)
+
+  def _Puts(self):
+    return [entry for entry in self.server.log if entry[0] == 'PUT']
+
+  def testUploadInChunks(self):
+    entry = self._Upload()
+    self.assertEqual((entry['len'], entry['md5']), (len(DATA), MD5))
+    self.assertEqual(self.server.uploaded(self.uri), DATA)
+    self.assertEqual([puts[2]['content-range'] for puts in self._Puts()],
+        ['bytes 0-1048575/2500003', 'bytes 1048576-2097151/2500003',
+         'bytes 2097152-2500002/2500003'])
+
+  def testContinuesAfterDroppedChunk(self):
+    self.server.drop_puts = 1
+    self.assertEqual(self._Upload()['md5'], MD5)
+    self.assertEqual(self.server.uploaded(self.uri), DATA)
+    self.assertTrue('bytes */2500003' in
+        [puts[2]['content-range'] for puts in self._Puts()])
+
+  def testRetriesBusyServer(self):
+    self.server.busy_puts = 2
+    self.assertEqual(self._Upload()['md5'], MD5)
+    self.assertEqual(self.server.busy_puts, 0)
+    self.assertEqual(self.server.uploaded(self.uri), DATA)
+
+  def testStateFileContinuesEarlierRun(self):
+    state_file = os.path.join(self.directory, 'up.state')
+    state = raws_json.upload.UploadState(state_file)
+    state.load(self.uri, len(DATA))
+    state.save(2000000)
+    self.server.uploads[self.uri] = {'parts': {0: DATA[:2000000]}}
+    self.assertEqual(self._Upload(state_file=state_file)['md5'], MD5)
+    self.assertFalse(os.path.exists(state_file))
+    self.assertEqual([puts[2]['content-range'] for puts in self._Puts()],
+        ['bytes */2500003', 'bytes 2000000-2500002/2500003'])
+
+  def testGivesUpAfterMaxRetries(self):
+    self.server.busy_puts = 10
+    self.assertRaises(RequestError, self._Upload, max_retries=1)
+    self.assertEqual(self.server.busy_puts, 8)
+
+  def testGivesUpWithoutProgress(self):
+    self.server.stall_puts = 100
+    self.assertRaises(RequestError, self._Upload, max_retries=2)
+    self.assertEqual(len(self._Puts()), 3)
+
+  def testStateFileIsReplacedWhole(self):
+    state_file = os.path.join(self.directory, 'up.state')
+    state = raws_json.upload.UploadState(state_file)
+    state.load(self.uri, len(DATA))
+    state.save(1048576)
+    dump = json.dump
+    def _Crash(value, fd):
+      fd.write('{"uri": ')
+      raise IOError('No space left on device')
+    json.dump = _Crash
+    try:
+      self.assertRaises(IOError, state.save, 2097152)
+    finally:
+      json.dump = dump
+    self.assertEqual(raws_json.upload.UploadState(state_file).load(self.uri,
+        len(DATA)), 1048576)
+    self.assertEqual(sorted(os.listdir(self.directory)),
+        ['up.bin', 'up.state'])
+
+  def testRequestsGoThroughServiceHandler(self):
+    self.rass.handler = _CountingHandler()
+    self._Upload()
+    self.assertEqual(self.rass.handler.requests, 3)
+
+  def testAsyncServiceUploadsOnThread(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    future = self._Put(rass)
+    self.assertEqual(loop.run_until_complete(future)['entry']['md5'], MD5)
+    self.assertEqual(self.server.uploaded(self.uri), DATA)
+    future = rass.createItem('e/', 'up.bin', self.path, resumable=True)
+    self.assertEqual(loop.run_until_complete(future)['entry']['md5'], MD5)
+
+
+class ParallelTest(ResumableTest):
+
+  def _Put(self, rass, **kwargs):
+    kwargs.setdefault('streams', 3)
+    kwargs.setdefault('chunk_size', 524288)
+    return ResumableTest._Put(self, rass, **kwargs)
+
+  def _Parts(self):
+    return sorted([puts[2]['content-range'] for puts in self._Puts()
+        if puts[2].get('x-upload-part')])
+
+  def testUploadInChunks(self):
+    entry = self._Upload()
+    self.assertEqual((entry['len'], entry['md5']), (len(DATA), MD5))
+    self.assertEqual(self.server.uploaded(self.uri), DATA)
+    self.assertEqual(len(self._Parts()), 5)
+    self.assertEqual(self._Puts()[-1][2]['content-range'], 'bytes */2500003')
+
+  def testContinuesAfterDroppedChunk(self):
+    self.server.drop_puts = 1
+    self.assertEqual(self._Upload()['md5'], MD5)
+    self.assertEqual(self.server.uploaded(self.uri), DATA)
+
+  def testStateFileContinuesEarlierRun(self):
+    state_file = os.path.join(self.directory, 'up.state')
+    state = raws_json.upload.UploadState(state_file)
+    state.load(self.uri, len(DATA))
+    state.addPart(524288, 1572864)
+    self.server.uploads[self.uri] = {
+        'parts': {524288: DATA[524288:1572864]}}
+    self.assertEqual(self._Upload(state_file=state_file)['md5'], MD5)
+    self.assertFalse(os.path.exists(state_file))
+    self.assertEqual(self._Parts(), ['bytes 0-524287/2500003',
+        'bytes 1572864-2097151/2500003', 'bytes 2097152-2500002/2500003'])
+
+  def testGivesUpAfterMaxRetries(self):
+    self.server.busy_puts = 10
+    self.assertRaises(RequestError, self._Upload, max_retries=1)
+    self.assertEqual(self.server.uploads, {})
+
+  def testRequestsGoThroughServiceHandler(self):
+    self.rass.handler = _CountingHandler()
+    self._Upload()
+    self.assertEqual(self.rass.handler.requests, 6)
+
+  def testGivesUpWithoutProgress(self):
+    # A 308 to a part confirms it, the commit finds the file incomplete.
+    self.server.stall_puts = 100
+    self.assertRaises(RequestError, self._Upload, max_retries=2)
+    self.assertEqual(len(self._Parts()), 5)
+
+  def testMappedFileIsOpenedOnce(self):
+    file_pool = _SlowFilePool(1)
+    results = []
+    media_source = raws_json.MediaSource(file_path=self.path, use_mmap=True,
+        file_pool=file_pool)
+    def _Upload():
+      results.append(self.rass.PutResumable(self.uri, media_source,
+          chunk_size=262144, streams=4))
+    thread = threading.Thread(target=_Upload)
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(results[0]['entry']['md5'], MD5)
+    self.assertEqual(file_pool.open_files, 0)
+
+
+class _CountingFilePool(raws_json.FilePool):
+  """FilePool which counts the files opened through it."""
+
+  acquired = 0
+
+  def acquire(self):
+    raws_json.FilePool.acquire(self)
+    self.acquired += 1
+
+
+class SrcTest(UploadTestCase):
+
+  def setUp(self):
+    UploadTestCase.setUp(self)
+    self.rats = RatsService('u', 'p', '127.0.0.1')
+    self.rats.port = self.server.port
+    self.progress = raws_json.TransferProgress()
+    self.file_pool = _CountingFilePool(1)
+
+  def _Check(self, entry):
+    self.assertEqual((entry['len'], entry['md5']), (len(DATA), MD5))
+    self.assertEqual(self.progress.bytes, len(DATA))
+    self.assertTrue(self.file_pool.acquired > 0)
+    self.assertEqual(self.file_pool.open_files, 0)
+
+  def testSrcWithProgressAndFilePool(self):
+    self._Check(self.rats.createSrc('up.bin', self.path, use_mmap=True,
+        file_pool=self.file_pool, progress=self.progress)['entry'])
+    self.assertEqual(self.server.log[-1][:2], ('PUT', '/src/'))
+
+  def testResumableSrcWithProgressAndFilePool(self):
+    entry = self.rats.createSrc('up.bin', self.path, resumable=True,
+        streams=2, use_mmap=True, file_pool=self.file_pool,
+        progress=self.progress)['entry']
+    self._Check(entry)
+    self.assertEqual(self.server.uploaded('/src/'), DATA)
+
+
+class _HeldUploadCache(raws_json.upload_cache.UploadCache):
+  """UploadCache which only hashes a file once release is set."""
+
+  def __init__(self, *args, **kwargs):
+    raws_json.upload_cache.UploadCache.__init__(self, *args, **kwargs)
+    self.release = threading.Event()
+
+  def digest(self, local_path):
+    self.release.wait(30)
+    return raws_json.upload_cache.UploadCache.digest(self, local_path)
+
+
+class UploadCacheTest(UploadTestCase):
+
+  def setUp(self):
+    UploadTestCase.setUp(self)
+    self.cache = _HeldUploadCache(os.path.join(self.directory, 'uploads.db'))
+    self.cache.release.set()
+    self.items = [('d/', 'up.bin', self.path), ('e/', 'up.bin', self.path)]
+
+  def tearDown(self):
+    self.cache.close()
+    UploadTestCase.tearDown(self)
+
+  def _Posts(self):
+    return len([entry for entry in self.server.log if entry[0] == 'POST'])
+
+  def testUnchangedFilesAreSkipped(self):
+    first = self.rass.createItems(self.items, upload_cache=self.cache)
+    self.assertEqual(self._Posts(), 2)
+    self.assertEqual(self.rass.createItems(self.items,
+        upload_cache=self.cache), first)
+    self.assertEqual(self._Posts(), 2)
+    self.rass.createItems(self.items[:1])
+    self.assertEqual(self._Posts(), 3)
+
+  def testAsyncUnchangedFilesAreSkipped(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    first = loop.run_until_complete(rass.createItems(self.items,
+        upload_cache=self.cache))
+    self.assertEqual([entry['entry']['md5'] for entry in first], [MD5] * 2)
+    self.assertEqual(self._Posts(), 2)
+    self.assertEqual(loop.run_until_complete(rass.createItems(self.items,
+        upload_cache=self.cache)), first)
+    self.assertEqual(self._Posts(), 2)
+
+  def testTouchedFileIsHashed(self):
+    first = self.rass.createItem('d/', 'up.bin', self.path,
+        upload_cache=self.cache)
+    os.utime(self.path, (1000000000, 1000000000))
+    self.assertEqual(self.rass.createItem('d/', 'up.bin', self.path,
+        upload_cache=self.cache), first)
+    self.assertEqual(self._Posts(), 1)
+
+  def testFileIsHashedWhileUploaded(self):
+    self.cache.release.clear()
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        self.rass.createItem('d/', 'up.bin', self.path,
+            upload_cache=self.cache)))
+    thread.start()
+    for i in xrange(300):
+      if self._Posts():
+        break
+      time.sleep(0.01)
+    self.assertEqual(self._Posts(), 1)
+    self.cache.release.set()
+    thread.join(30)
+    self.assertEqual(results[0]['entry']['md5'], MD5)
+    self.assertEqual(self.cache.lookup(self.rass.server, '/item/d/up.bin',
+        self.path)[1][2], MD5)
+
+  def testAsyncHashingDoesntBlockTheLoop(self):
+    loop = raws_json.async_request.EventLoop()
+    rass = AsyncRassService('u', 'p', '127.0.0.1', loop=loop)
+    rass.port = self.server.port
+    loop.run_until_complete(rass.createItem('d/', 'up.bin', self.path,
+        upload_cache=self.cache))
+    os.utime(self.path, (1000000000, 1000000000))
+    self.cache.release.clear()
+    future = rass.createItem('d/', 'up.bin', self.path,
+        upload_cache=self.cache)
+    feed = loop.run_until_complete(rass.Get('/dir/'))
+    self.assertEqual(len(feed['feed']['entry']), 200)
+    self.assertFalse(future.done())
+    self.cache.release.set()
+    self.assertEqual(loop.run_until_complete(future)['entry']['md5'], MD5)
+    self.assertEqual(self._Posts(), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()